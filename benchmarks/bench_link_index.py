@@ -0,0 +1,81 @@
+"""链接与文件名对应关系的查找耗时随链接数的变化
+
+对比原来逐个链接做子串判断的线性查找和 LinkIndex 的哈希查找：
+命中查找会统计结果是否正确（线性查找常被会话ID中的数字提前误命中），
+未命中查找（如找不到链接的临时文件）是线性查找的最坏情况，需要扫描全部链接。
+
+用法:
+    python benchmarks/bench_link_index.py
+    python benchmarks/bench_link_index.py --sizes 1000 10000 50000 --lookups 2000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from tdl_engine import LinkIndex  # noqa: E402
+
+
+def make_links(count):
+    """生成分布在若干会话中的消息链接"""
+    chats = [str(1000000000 + i * 7919) for i in range(max(1, count // 1000))]
+    return [f"https://t.me/c/{chats[i % len(chats)]}/{100 + i}" for i in range(count)]
+
+
+def make_names(links, count):
+    """按 tdl 的输出格式生成完成行中的文件名，返回 (文件名, 正确链接) 列表"""
+    names = []
+    for link in random.sample(links, min(count, len(links))):
+        chat, message = link.split('/')[-2:]
+        names.append((f"频道({chat}):{message}", link))
+    return names
+
+
+def linear_lookup(links_map, name):
+    """原实现：遍历映射逐个做子串判断"""
+    for fname, link in links_map.items():
+        if fname in name or name in fname:
+            return link
+    return None
+
+
+def measure(func, names):
+    """返回平均每次查找的耗时和结果正确的比例"""
+    correct = 0
+    start = time.perf_counter()
+    for name, expected in names:
+        if func(name) == expected:
+            correct += 1
+    return (time.perf_counter() - start) / len(names), correct / len(names)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000, 50000], help="链接数")
+    arg_parser.add_argument("--lookups", type=int, default=1000, help="每种规模的查找次数")
+    args = arg_parser.parse_args()
+
+    random.seed(0)
+    print(f"{'链接数':>8} | {'线性命中(us)':>12} {'正确率':>7} {'线性未命中(us)':>14} | "
+          f"{'索引命中(us)':>12} {'正确率':>7} {'索引未命中(us)':>14}")
+    for size in args.sizes:
+        links = make_links(size)
+        names = make_names(links, args.lookups)
+        misses = [(f"video_{i}_final.mp4.tmp", None) for i in range(args.lookups)]
+        links_map = {link.split('/')[-1]: link for link in links}
+        index = LinkIndex(links)
+        linear, linear_accuracy = measure(lambda name: linear_lookup(links_map, name), names)
+        linear_miss, _ = measure(lambda name: linear_lookup(links_map, name), misses)
+        indexed, indexed_accuracy = measure(index.lookup, names)
+        indexed_miss, _ = measure(index.lookup, misses)
+        print(f"{size:>8} | {linear * 1e6:>12.1f} {linear_accuracy:>7.1%} {linear_miss * 1e6:>14.1f} | "
+              f"{indexed * 1e6:>12.2f} {indexed_accuracy:>7.1%} {indexed_miss * 1e6:>14.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
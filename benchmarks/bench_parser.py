@@ -0,0 +1,96 @@
+"""tdl 输出解析器的黄金语料校验和吞吐量测试
+
+用法:
+    python benchmarks/bench_parser.py                 # 校验语料并测量吞吐量
+    python benchmarks/bench_parser.py --update        # 解析结果有意变化时更新黄金文件
+    python benchmarks/bench_parser.py --min-rate 200000  # 吞吐量低于阈值时返回非零
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from tdl_parser import TdlOutputParser  # noqa: E402
+
+CORPUS_FILE = os.path.join(BENCH_DIR, "tdl_output_corpus.txt")
+GOLDEN_FILE = os.path.join(BENCH_DIR, "tdl_output_golden.jsonl")
+
+
+def load_corpus():
+    with open(CORPUS_FILE, "rb") as f:
+        return f.read().split(b"\n")
+
+
+def event_to_dict(event):
+    if event is None:
+        return None
+    result = {"kind": event.kind}
+    for key in ("name", "percent", "speed", "aggregate", "index", "total", "done_bytes", "path",
+                "return_code"):
+        value = getattr(event, key)
+        if value is None or value is False:
+            continue
+        result[key] = round(value, 2) if isinstance(value, float) else value
+    return result
+
+
+def check_golden(parser, lines, update=False):
+    """逐行比对解析结果和黄金文件，返回不一致的行数"""
+    results = [event_to_dict(parser.parse(line)) for line in lines]
+    if update or not os.path.exists(GOLDEN_FILE):
+        with open(GOLDEN_FILE, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        print(f"已写入黄金文件: {GOLDEN_FILE}")
+        return 0
+    with open(GOLDEN_FILE, encoding="utf-8") as f:
+        expected = [json.loads(line) for line in f]
+    mismatches = 0
+    if len(expected) != len(results):
+        print(f"行数不一致: 语料 {len(results)} 行，黄金文件 {len(expected)} 行")
+        return max(1, abs(len(expected) - len(results)))
+    for number, (line, want, got) in enumerate(zip(lines, expected, results), 1):
+        if want != got:
+            mismatches += 1
+            print(f"第 {number} 行不一致: {line!r}\n  期望: {want}\n  实际: {got}")
+    return mismatches
+
+
+def measure(parser, lines, repeat):
+    """重复解析语料，返回每秒解析的行数"""
+    parse = parser.parse
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            parse(line)
+    elapsed = time.perf_counter() - start
+    return len(lines) * repeat / elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--update", action="store_true", help="用当前解析结果更新黄金文件")
+    arg_parser.add_argument("--repeat", type=int, default=2000, help="语料重复解析次数")
+    arg_parser.add_argument("--min-rate", type=float, default=0, help="最低吞吐量（行/秒）")
+    args = arg_parser.parse_args()
+
+    parser = TdlOutputParser()
+    lines = load_corpus()
+    mismatches = check_golden(parser, lines, args.update)
+    rate = measure(parser, lines, args.repeat)
+    print(f"语料 {len(lines)} 行 x {args.repeat} 次，吞吐量: {rate:,.0f} 行/秒")
+    if mismatches:
+        print(f"解析结果与黄金文件不一致: {mismatches} 行")
+        return 1
+    if args.min_rate and rate < args.min_rate:
+        print(f"吞吐量低于阈值 {args.min_rate:,.0f} 行/秒")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
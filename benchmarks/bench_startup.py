@@ -0,0 +1,106 @@
+"""启动耗时：导入耗时和到第一帧的耗时
+
+每轮在新的 Python 进程中依次测量：
+    导入 tdl_flet（含 flet）、构造 TDLDownloaderApp、main() 构建界面并 page.add()、
+    刷新循环推送第一帧。
+页面用一个不连接 flet 客户端的替身，测的是本程序自己的启动路径，不含 flet 客户端窗口的启动时间。
+程序目录指向临时目录，不会在仓库中留下 downloads、logs 目录。
+
+用法:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --record benchmarks/startup_history.jsonl --label v1.2.0
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+STAGES = ("import", "init", "main", "first_frame")
+
+# 子进程中执行的测量脚本
+CHILD_SCRIPT = r'''
+import os, sys, json, time, tempfile
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import tdl_flet
+imported = time.perf_counter()
+
+class Page:
+    """只记录控件的页面替身"""
+    def __init__(self):
+        self.controls = []
+        self.overlay = []
+        self.dialog = None
+        self.snack_bar = None
+    def add(self, *controls):
+        self.controls.extend(controls)
+    def update(self, *controls):
+        pass
+    def run_thread(self, func, *args):
+        func(*args)
+
+base_dir = tempfile.mkdtemp(prefix="tdl_startup_")
+sys.frozen = True
+sys.executable = os.path.join(base_dir, "tdl_gui.exe")
+app = tdl_flet.TDLDownloaderApp()
+initialized = time.perf_counter()
+page = Page()
+app.main(page)
+built = time.perf_counter()
+app.renderer.flush()
+flushed = time.perf_counter()
+app.session_log.close()
+print(json.dumps({
+    "import": imported - start,
+    "init": initialized - imported,
+    "main": built - initialized,
+    "first_frame": flushed - built,
+}))
+'''
+
+
+def run_once():
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD_SCRIPT, ROOT_DIR],
+        capture_output=True, text=True, check=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process"] = time.perf_counter() - start
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--runs", type=int, default=5, help="测量轮数，取中位数")
+    arg_parser.add_argument("--record", help="把本次结果追加到 JSONL 文件，便于按版本对比")
+    arg_parser.add_argument("--label", default="", help="记录中的版本标签")
+    args = arg_parser.parse_args()
+
+    runs = [run_once() for _ in range(max(1, args.runs))]
+    medians = {key: statistics.median(run[key] for run in runs) for key in STAGES + ("process",)}
+    medians["to_first_frame"] = sum(medians[key] for key in STAGES)
+    for key in STAGES:
+        print(f"{key:>14}: {medians[key] * 1000:8.1f} ms")
+    print(f"{'to_first_frame':>14}: {medians['to_first_frame'] * 1000:8.1f} ms")
+    print(f"{'process':>14}: {medians['process'] * 1000:8.1f} ms  (含解释器启动和退出)")
+
+    if args.record:
+        with open(args.record, "a", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "label": args.label,
+                "runs": len(runs),
+                "ms": {key: round(value * 1000, 1) for key, value in medians.items()},
+            }, ensure_ascii=False) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1855 @@
+"""tdl 下载引擎：不依赖 flet 的任务队列、调度器与 tdl 进程执行器"""
+import os
+import re
+import json
+import math
+import time
+import threading
+import subprocess
+from urllib.parse import parse_qs
+import itertools
+from array import array
+from collections import deque
+from tdl_parser import (
+    TdlOutputParser, TdlOutputReader,
+    EVENT_STARTED, EVENT_PROGRESS, EVENT_SPEED, EVENT_DONE, EVENT_ERROR, EVENT_SYSINFO, EVENT_LOG,
+)
+
+# 任务状态
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+# 下载清单中被用户移出队列的链接
+JOB_REMOVED = "removed"
+
+# tdl 输出中的 "会话名(会话ID):消息ID"，如 "频道(123456):789 -> ..."
+_PEER_MESSAGE_PATTERN = re.compile(r'\((-?\d+)\):(\d+)')
+# tdl 默认的文件名模板 "{会话ID}_{消息ID}_{文件名}"
+_FILE_NAME_PATTERN = re.compile(r'(?:^|[\\/\s])(-?\d+)_(\d+)(?=[_.]|$)')
+# 文件名中的独立数字，用于只按消息ID匹配
+_NUMBER_TOKEN_PATTERN = re.compile(r'(?<![\d.])\d+(?!\d|\.\d)')
+
+
+def parse_link(link):
+    """从消息链接中解析会话和消息ID
+    Args:
+        link: 如 https://t.me/c/123456/789、https://t.me/name/789
+    Returns:
+        (会话, 消息ID)，无法解析时返回 None
+    """
+    path = link.split('?')[0].split('#')[0].rstrip('/')
+    if '://' in path:
+        path = path.split('://', 1)[1]
+    parts = path.split('/')[1:]
+    if len(parts) < 2 or not parts[-1].isdigit():
+        return None
+    if parts[0] == 'c' and len(parts) >= 3:
+        return parts[1], parts[-1]
+    return parts[0], parts[-1]
+
+
+_TELEGRAM_HOSTS = ('t.me', 'telegram.me', 'telegram.dog')
+_USERNAME_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9_]{3,31}$')
+
+
+def canonical_link(line):
+    """把各种形式的消息链接规范化
+    支持 https://t.me/c/123/456、t.me/name/456、带话题ID的链接、?single 等查询参数，
+    以及 tg://privatepost?channel=123&post=456、tg://resolve?domain=name&post=456。
+    Args:
+        line: 一行输入
+    Returns:
+        ((会话, 消息ID), 规范化的链接)，不是有效的消息链接时返回 None
+    """
+    text = line.strip().strip('<>"\'')
+    if not text:
+        return None
+    text = text.split('#')[0]
+    path, _, query = text.partition('?')
+    params = parse_qs(query)
+    comment = None
+    if path.lower().startswith('tg://'):
+        action = path[5:].rstrip('/').lower()
+        post = params.get('post', [''])[0]
+        if action == 'privatepost':
+            chat = params.get('channel', [''])[0]
+            if not chat.isdigit():
+                return None
+        elif action == 'resolve':
+            chat = params.get('domain', [''])[0]
+            if not _USERNAME_PATTERN.match(chat):
+                return None
+            chat = chat.lower()
+        else:
+            return None
+        message = post
+    else:
+        if '://' in path:
+            scheme, path = path.split('://', 1)
+            if scheme.lower() not in ('http', 'https'):
+                return None
+        parts = [part for part in path.split('/') if part]
+        if len(parts) < 3:
+            return None
+        host = parts[0].lower()
+        if host.startswith('www.'):
+            host = host[4:]
+        if host not in _TELEGRAM_HOSTS:
+            return None
+        parts = parts[1:]
+        # t.me/s/name/123 是网页预览链接
+        if parts[0] == 's':
+            parts = parts[1:]
+        if len(parts) >= 3 and parts[0] == 'c':
+            chat = parts[1]
+            if not chat.isdigit():
+                return None
+        elif len(parts) >= 2 and parts[0] != 'c':
+            chat = parts[0]
+            if not _USERNAME_PATTERN.match(chat):
+                return None
+            chat = chat.lower()
+        else:
+            return None
+        # 话题链接 t.me/c/123/话题ID/消息ID 中只保留消息ID
+        if len(parts) > (4 if parts[0] == 'c' else 3):
+            return None
+        message = parts[-1]
+        comment = params.get('comment', [None])[0]
+    if not message.isdigit() or int(message) <= 0:
+        return None
+    message = str(int(message))
+    link = f"https://t.me/c/{chat}/{message}" if chat.isdigit() else f"https://t.me/{chat}/{message}"
+    key = (chat, int(message))
+    # 评论链接指向讨论组中的另一条消息，单独保留
+    if comment is not None and comment.isdigit():
+        link += f"?comment={comment}"
+        key += (int(comment),)
+    return key, link
+
+
+class LinkRange:
+    """同一会话中连续消息ID的范围，按需逐个生成链接"""
+    __slots__ = ("chat", "start", "end")
+
+    def __init__(self, chat, start, end):
+        self.chat = chat
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start + 1
+
+    def __contains__(self, message):
+        return self.start <= message <= self.end
+
+    def link(self, message):
+        if self.chat.isdigit():
+            return f"https://t.me/c/{self.chat}/{message}"
+        return f"https://t.me/{self.chat}/{message}"
+
+    def __iter__(self):
+        for message in range(self.start, self.end + 1):
+            yield self.link(message)
+
+    def text(self):
+        """范围的链接写法，如 https://t.me/c/123/100-50000，可以用 parse_range 解析回来"""
+        return f"{self.link(self.start)}-{self.end}"
+
+    def __repr__(self):
+        return f"LinkRange({self.chat!r}, {self.start}, {self.end})"
+
+
+# 链接末尾的消息ID范围，如 https://t.me/c/123/100-50000
+_LINK_RANGE_PATTERN = re.compile(r'^(.*/)(\d+)\s*-\s*(\d+)/?$')
+# 简写形式，如 chat:123 ids:100..50000、chat:name ids:1-20
+_CHAT_RANGE_PATTERN = re.compile(r'^chat:\s*(\S+)\s+ids:\s*(\d+)\s*(?:\.\.|-)\s*(\d+)$', re.I)
+
+
+def parse_range(line):
+    """解析消息范围
+    Returns:
+        LinkRange，不是范围写法或范围无效时返回 None
+    """
+    text = line.strip()
+    match = _CHAT_RANGE_PATTERN.match(text)
+    if match:
+        chat, start, end = match.groups()
+        parsed = canonical_link(f"https://t.me/c/{chat}/{start}" if chat.isdigit() else f"https://t.me/{chat}/{start}")
+    else:
+        match = _LINK_RANGE_PATTERN.match(text.split('?')[0])
+        if not match:
+            return None
+        prefix, start, end = match.groups()
+        parsed = canonical_link(prefix + start)
+    if parsed is None or len(parsed[0]) != 2:
+        return None
+    start, end = int(start), int(end)
+    if start <= 0 or end < start:
+        return None
+    return LinkRange(parsed[0][0], start, end)
+
+
+def _merge_ranges(ranges):
+    """合并同一会话中重叠或相邻的范围"""
+    by_chat = {}
+    for item in ranges:
+        by_chat.setdefault(item.chat, []).append(item)
+    merged = []
+    for items in by_chat.values():
+        items.sort(key=lambda item: item.start)
+        current = LinkRange(items[0].chat, items[0].start, items[0].end)
+        for item in items[1:]:
+            if item.start <= current.end + 1:
+                current.end = max(current.end, item.end)
+            else:
+                merged.append(current)
+                current = LinkRange(item.chat, item.start, item.end)
+        merged.append(current)
+    return merged
+
+
+def normalize_links(lines, exclude=()):
+    """规范化、去重并按会话分组排序链接
+    Args:
+        lines: 输入的行
+        exclude: 已经在队列中的链接，不再重复加入
+    Returns:
+        (链接列表, 消息范围列表, 重复的行数, 无法识别的行列表)
+        链接按会话首次出现的顺序分组，组内按消息ID升序排列；
+        范围只做合并，不会展开，落在范围内的单个链接视为重复
+    """
+    groups = {}
+    seen = set()
+    duplicates = 0
+    rejected = []
+    ranges = []
+    for line in lines:
+        if not line.strip():
+            continue
+        parsed = canonical_link(line)
+        if parsed is None:
+            link_range = parse_range(line)
+            if link_range is not None:
+                ranges.append(link_range)
+            else:
+                rejected.append(line.strip())
+            continue
+        key, link = parsed
+        if key in seen or link in exclude:
+            duplicates += 1
+            continue
+        seen.add(key)
+        groups.setdefault(key[0], []).append((key[1:], link))
+    ranges = _merge_ranges(ranges)
+    ranges_by_chat = {}
+    for link_range in ranges:
+        ranges_by_chat.setdefault(link_range.chat, []).append(link_range)
+    links = []
+    for chat, items in groups.items():
+        items.sort()
+        for key, link in items:
+            if len(key) == 1 and any(key[0] in link_range for link_range in ranges_by_chat.get(chat, ())):
+                duplicates += 1
+                continue
+            links.append(link)
+    return links, ranges, duplicates, rejected
+
+
+class DownloadJob:
+    """单个下载任务（一个链接）"""
+    __slots__ = ("job_id", "link", "threads", "limit", "state", "return_code", "attempts", "resume")
+
+    def __init__(self, job_id, link, threads=1, limit=1, resume=False):
+        self.job_id = job_id
+        self.link = link
+        self.threads = threads
+        # 同一个 tdl 进程内的并发文件数（tdl dl -l）
+        self.limit = limit
+        self.state = JOB_PENDING
+        self.return_code = None
+        self.attempts = 0
+        # 是否续传上次留下的临时文件（tdl dl --continue）
+        self.resume = resume
+
+    def __repr__(self):
+        return f"DownloadJob({self.job_id}, {self.link!r}, {self.state})"
+
+
+class TaskTable:
+    """一个 tdl 进程内各任务的状态表
+
+    用数组按任务序号保存状态，另用两个有序队列记录尚未开始和已开始的任务，
+    取下一个未开始的任务、标记开始和完成都是均摊 O(1)。
+    """
+    PENDING = 0
+    STARTED = 1
+    FINISHED = 2
+
+    def __init__(self, count):
+        self.states = bytearray(count)
+        self.finished = 0
+        self._unstarted = deque(range(count))
+        self._started = deque()
+
+    def __len__(self):
+        return len(self.states)
+
+    def next_unstarted(self):
+        """标记并返回下一个尚未开始的任务序号，没有时返回 None"""
+        while self._unstarted:
+            index = self._unstarted.popleft()
+            if self.states[index] == self.PENDING:
+                self.mark_started(index)
+                return index
+        return None
+
+    def mark_started(self, index):
+        """标记任务开始，返回是否为新开始的任务"""
+        if self.states[index] != self.PENDING:
+            return False
+        self.states[index] = self.STARTED
+        self._started.append(index)
+        return True
+
+    def mark_finished(self, index=None):
+        """标记任务完成
+        Args:
+            index: 任务序号，为 None 时表示无法确定是哪个任务，按开始顺序取最早未完成的任务
+        Returns:
+            完成的任务序号，没有可完成的任务时返回 None
+        """
+        if index is None:
+            index = self._oldest_unfinished()
+            if index is None:
+                return None
+        if self.states[index] == self.FINISHED:
+            return None
+        self.states[index] = self.FINISHED
+        self.finished += 1
+        return index
+
+    def _oldest_unfinished(self):
+        for queue in (self._started, self._unstarted):
+            while queue:
+                index = queue[0]
+                if self.states[index] != self.FINISHED:
+                    return index
+                queue.popleft()
+        return None
+
+
+class TaskProgress:
+    """单个文件的实时进度"""
+    __slots__ = ("key", "group", "name", "link", "percent", "done_bytes", "total_bytes",
+                 "speed", "state", "started", "updated")
+
+    def __init__(self, key, group, name, link=None):
+        self.key = key
+        # 所属的 tdl 进程（任务ID），进程结束时整组移除
+        self.group = group
+        self.name = name
+        self.link = link
+        self.percent = 0.0
+        self.done_bytes = 0.0
+        # 由已传输量和百分比推算的文件大小，未知时为 None
+        self.total_bytes = None
+        self.speed = 0.0
+        self.state = JOB_RUNNING
+        self.started = self.updated = time.monotonic()
+
+
+class ProgressBoard:
+    """所有正在下载的文件的进度表，由输出解析更新，由界面按帧读取"""
+
+    def __init__(self, stall_seconds=15):
+        """
+        Args:
+            stall_seconds: 超过这个时间没有进度更新的文件视为停滞
+        """
+        self.stall_seconds = stall_seconds
+        self._lock = threading.Lock()
+        self._tasks = {}
+        # 每次修改递增，视图据此判断是否需要重绘
+        self.version = 0
+
+    def update(self, group, name, link=None, percent=None, done_bytes=None, speed=None):
+        """记录一个文件的最新进度"""
+        key = (group, name)
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is None:
+                task = self._tasks[key] = TaskProgress(key, group, name, link)
+            if percent is not None:
+                task.percent = percent
+            if done_bytes is not None:
+                task.done_bytes = done_bytes
+                if task.percent > 0:
+                    task.total_bytes = done_bytes * 100 / task.percent
+            if speed is not None:
+                task.speed = speed
+            task.updated = time.monotonic()
+            self.version += 1
+
+    def finish(self, group, name):
+        """文件下载完成，从进度表中移除"""
+        with self._lock:
+            if self._tasks.pop((group, name), None) is not None:
+                self.version += 1
+
+    def remove_group(self, group):
+        """移除一个 tdl 进程的所有文件"""
+        with self._lock:
+            keys = [key for key, task in self._tasks.items() if task.group == group]
+            for key in keys:
+                del self._tasks[key]
+            if keys:
+                self.version += 1
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def is_stalled(self, task, now=None):
+        return (now or time.monotonic()) - task.updated >= self.stall_seconds
+
+    def snapshot(self):
+        """按 停滞的在前、开始时间先后 排序的进度快照"""
+        now = time.monotonic()
+        with self._lock:
+            tasks = list(self._tasks.values())
+        tasks.sort(key=lambda task: (not self.is_stalled(task, now), task.started))
+        return tasks
+
+
+def size_tolerance(size):
+    """tdl 输出的文件大小保留两位小数（如 48.00 MB），返回这一舍入带来的最大误差（字节）"""
+    unit = 1
+    while unit < 1024 ** 4 and unit * 1024 <= size:
+        unit *= 1024
+    return unit * 0.005
+
+
+class ByteProgress:
+    """按字节计算的总体进度和平滑的剩余时间
+
+    每个文件记录已传输字节数和文件大小（未知时为 None），
+    总体大小 = 已知大小之和 + 未知大小的文件数 × 已知文件的平均大小。
+    速度取指数加权平均，剩余时间 = 剩余字节数 / 平滑速度。
+    """
+
+    def __init__(self, smoothing=0.3, sample_interval=0.5):
+        """
+        Args:
+            smoothing: 速度平滑系数，越大越跟随瞬时速度
+            sample_interval: 两次速度采样的最小间隔（秒）
+        """
+        self.smoothing = smoothing
+        self.sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, count=0):
+        """开始新一轮统计
+        Args:
+            count: 预计的文件总数
+        """
+        with self._lock:
+            self.count = count
+            # 文件 -> [已传输字节数, 文件大小]
+            self._items = {}
+            self._done = 0.0
+            self._known_total = 0.0
+            self._known_count = 0
+            self._rate = None
+            self._last_sample = None
+
+    def set_count(self, count):
+        with self._lock:
+            self.count = count
+
+    def set_total(self, key, total):
+        """登记文件大小（如上传前通过 os.stat 得到）"""
+        self.update(key, None, total)
+
+    def update(self, key, done=None, total=None):
+        """更新一个文件的已传输字节数，total 为 None 时保留原来的大小"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                item = self._items[key] = [0.0, None]
+            if total is not None and total > 0:
+                if item[1] is None:
+                    self._known_count += 1
+                    self._known_total += total
+                else:
+                    self._known_total += total - item[1]
+                item[1] = total
+            if done is not None:
+                if item[1] is not None:
+                    done = min(done, item[1])
+                self._done += done - item[0]
+                item[0] = done
+            self._sample()
+
+    def finish(self, key, total=None):
+        """文件传输完成，已传输字节数记为文件大小"""
+        with self._lock:
+            item = self._items.get(key)
+            size = total if total is not None else (item[1] if item and item[1] is not None else (item[0] if item else 0))
+        self.update(key, size, size if size else None)
+
+    def _sample(self):
+        now = time.monotonic()
+        if self._last_sample is None:
+            self._last_sample = (now, self._done)
+            return
+        elapsed = now - self._last_sample[0]
+        if elapsed < self.sample_interval:
+            return
+        rate = max(0.0, (self._done - self._last_sample[1]) / elapsed)
+        self._rate = rate if self._rate is None else self.smoothing * rate + (1 - self.smoothing) * self._rate
+        self._last_sample = (now, self._done)
+
+    @property
+    def done_bytes(self):
+        return self._done
+
+    def total_bytes(self):
+        """估算的总字节数，还没有任何已知大小时返回 None"""
+        with self._lock:
+            return self._estimated_total()
+
+    def _estimated_total(self):
+        if not self._known_count:
+            return None
+        unknown = max(0, self.count - self._known_count)
+        return self._known_total + unknown * (self._known_total / self._known_count)
+
+    def fraction(self):
+        """总体进度（0-1），还没有任何已知大小时返回 None"""
+        with self._lock:
+            total = self._estimated_total()
+            if not total:
+                return None
+            return min(1.0, self._done / total)
+
+    def eta(self):
+        """剩余时间（秒），速度未知时返回 None"""
+        with self._lock:
+            total = self._estimated_total()
+            if not total or not self._rate:
+                return None
+            return max(0.0, total - self._done) / self._rate
+
+    def expected_size(self, key):
+        """记录的文件大小，未知时返回 None"""
+        with self._lock:
+            item = self._items.get(key)
+            return item[1] if item is not None else None
+
+
+class ThroughputHistory:
+    """固定容量的吞吐量历史
+
+    record() 只记下最新的瞬时速度，tick() 按固定间隔采样一次，
+    采样值经过指数加权平均后写入定长数组组成的环形缓冲区，内存占用固定。
+    """
+
+    def __init__(self, capacity=60, interval=1.0, smoothing=0.3):
+        """
+        Args:
+            capacity: 保留的采样点数
+            interval: 采样间隔（秒）
+            smoothing: 平滑系数，越大越跟随瞬时速度
+        """
+        self.capacity = capacity
+        self.interval = interval
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        self._samples = array('d', bytes(8 * self.capacity))
+        self._next = 0
+        self._count = 0
+        self._sum = 0.0
+        self._current = 0.0
+        self._smoothed = None
+        self._last_tick = None
+
+    def record(self, speed):
+        """记录最新的瞬时速度（字节每秒）"""
+        self._current = max(0.0, speed)
+
+    def tick(self, now=None):
+        """到了采样时间就采样一次
+        Returns:
+            是否产生了新的采样点
+        """
+        now = time.monotonic() if now is None else now
+        if self._last_tick is not None and now - self._last_tick < self.interval:
+            return False
+        self._last_tick = now
+        if self._smoothed is None:
+            self._smoothed = self._current
+        else:
+            self._smoothed = self.smoothing * self._current + (1 - self.smoothing) * self._smoothed
+        if self._count == self.capacity:
+            self._sum -= self._samples[self._next]
+        else:
+            self._count += 1
+        self._samples[self._next] = self._smoothed
+        self._sum += self._smoothed
+        self._next = (self._next + 1) % self.capacity
+        return True
+
+    def values(self):
+        """从旧到新的采样值"""
+        start = (self._next - self._count) % self.capacity
+        return [self._samples[(start + i) % self.capacity] for i in range(self._count)]
+
+    @property
+    def current(self):
+        """最近一次记录的瞬时速度"""
+        return self._current
+
+    @property
+    def latest(self):
+        return self._samples[(self._next - 1) % self.capacity] if self._count else 0.0
+
+    @property
+    def average(self):
+        return self._sum / self._count if self._count else 0.0
+
+    @property
+    def peak(self):
+        return max(self.values(), default=0.0)
+
+    @property
+    def minimum(self):
+        return min(self.values(), default=0.0)
+
+
+class DownloadQueue:
+    """线程安全、可持续追加的下载队列
+
+    下载进行中也可以追加、调整顺序或移除等待中的任务，
+    工作线程通过 take() 领取任务，完成后调用 finish()。
+    消息范围这类大批量链接以来源的形式加入，等待任务不足 chunk_size 时才按块展开为任务。
+    """
+
+    def __init__(self, chunk_size=500):
+        """
+        Args:
+            chunk_size: 按需展开链接来源时，等待任务的目标数量
+        """
+        self.chunk_size = chunk_size
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._running = {}
+        # 尚未展开的链接来源：[迭代器, 剩余数量, 线程数, 并发数, 展开回调, 是否续传, 移除回调]
+        self._sources = deque()
+        # 已展开、尚未通知的 (展开回调, 链接列表)，在释放队列锁后按展开顺序调用，
+        # 回调中的磁盘写入（如下载清单）不会阻塞队列的其它操作
+        self._expanded = deque()
+        self._callback_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._closed = False
+        # 本轮下载的统计，用于计算总体进度，新一轮开始时调用 reset_stats()
+        self.total_added = 0
+        self.total_finished = 0
+        self.total_failed = 0
+
+    def reset_stats(self):
+        with self._cond:
+            self.total_added = len(self._pending) + len(self._running) + self._source_remaining()
+            self.total_finished = 0
+            self.total_failed = 0
+
+    def add(self, links, threads=1, limit=1, resume=False):
+        """追加链接，返回新建的任务列表
+        Args:
+            links: 链接列表
+            threads: 每个任务的线程数
+            limit: 同一个 tdl 进程内的并发文件数
+            resume: 是否续传已有的临时文件
+        """
+        with self._cond:
+            jobs = [DownloadJob(next(self._ids), link, threads, limit, resume) for link in links]
+            self._pending.extend(jobs)
+            self.total_added += len(jobs)
+            self._cond.notify_all()
+            return jobs
+
+    def add_source(self, links, count, threads=1, limit=1, on_expand=None, resume=False, on_discard=None):
+        """追加一个按需展开的链接来源，链接不会一次性全部生成
+        Args:
+            links: 链接的可迭代对象（通常是生成器）
+            count: 链接总数，用于计算进度
+            threads: 每个任务的线程数
+            limit: 同一个 tdl 进程内的并发文件数
+            on_expand: 每展开一块链接时调用，参数为这一块的链接列表
+            resume: 展开的任务是否续传已有的临时文件
+            on_discard: 来源在展开完之前被清空时调用
+        """
+        with self._cond:
+            self._sources.append([iter(links), count, threads, limit, on_expand, resume, on_discard])
+            self.total_added += count
+            self._cond.notify_all()
+
+    def _source_remaining(self):
+        return sum(source[1] for source in self._sources)
+
+    def _expand_sources(self):
+        """等待任务不足时从链接来源展开下一块，需在锁内调用"""
+        while len(self._pending) < self.chunk_size and self._sources:
+            source = self._sources[0]
+            links = list(itertools.islice(source[0], self.chunk_size - len(self._pending)))
+            if not links:
+                # 来源提前结束时修正总数
+                self.total_added -= max(0, source[1])
+                self._sources.popleft()
+                continue
+            source[1] -= len(links)
+            self._pending.extend(DownloadJob(next(self._ids), link, source[2], source[3], source[5]) for link in links)
+            if source[4] is not None:
+                self._expanded.append((source[4], links))
+
+    def _notify_expanded(self):
+        """调用展开回调，需在队列锁外调用
+
+        回调按展开的先后顺序执行：先展开的一块一定先写入下载清单。
+        """
+        with self._callback_lock:
+            while True:
+                with self._cond:
+                    if not self._expanded:
+                        return
+                    callback, links = self._expanded.popleft()
+                try:
+                    callback(links)
+                except Exception as e:
+                    print(f"展开链接来源时出错: {str(e)}")
+
+    def remove(self, job_id):
+        """移除等待中的任务，正在下载的任务不能移除
+        Returns:
+            被移除的任务，找不到时返回 None
+        """
+        with self._cond:
+            for job in self._pending:
+                if job.job_id == job_id:
+                    self._pending.remove(job)
+                    self.total_added -= 1
+                    return job
+            return None
+
+    def clear_pending(self):
+        """清空所有等待中的任务和尚未展开的链接来源，返回被移除的任务列表"""
+        with self._cond:
+            jobs = list(self._pending)
+            self._pending.clear()
+            self.total_added -= len(jobs) + self._source_remaining()
+            sources = list(self._sources)
+            self._sources.clear()
+        # 先写完已展开的块，再记录剩余范围被移除
+        self._notify_expanded()
+        for source in sources:
+            if source[6] is not None:
+                try:
+                    source[6]()
+                except Exception as e:
+                    print(f"移除链接来源时出错: {str(e)}")
+        return jobs
+
+    def move(self, job_id, offset):
+        """调整等待中任务的位置，offset 为负数时前移"""
+        with self._cond:
+            for index, job in enumerate(self._pending):
+                if job.job_id == job_id:
+                    new_index = max(0, min(len(self._pending) - 1, index + offset))
+                    if new_index == index:
+                        return False
+                    del self._pending[index]
+                    self._pending.insert(new_index, job)
+                    return True
+            return False
+
+    def pending(self):
+        """等待中任务的快照，不包括尚未展开的链接来源"""
+        with self._cond:
+            return list(self._pending)
+
+    def running(self):
+        """正在下载任务的快照"""
+        with self._cond:
+            return list(self._running.values())
+
+    def pending_count(self):
+        """等待中的任务数，包括尚未展开的链接"""
+        with self._cond:
+            return len(self._pending) + self._source_remaining()
+
+    def unexpanded_count(self):
+        """尚未展开的链接数"""
+        with self._cond:
+            return self._source_remaining()
+
+    def take(self, max_items=1, timeout=None):
+        """领取最多 max_items 个任务，队列为空时等待
+
+        Args:
+            max_items: 最多领取的任务数，也可以是根据当前等待任务数计算领取数量的函数
+            timeout: 等待超时时间（秒）
+        Returns:
+            任务列表，超时或队列已关闭时返回空列表
+        """
+        with self._cond:
+            self._expand_sources()
+            if not self._pending and not self._closed:
+                self._cond.wait(timeout)
+                self._expand_sources()
+            jobs = []
+            if not self._closed and self._pending:
+                if callable(max_items):
+                    max_items = max(1, max_items(len(self._pending)))
+                while self._pending and len(jobs) < max_items:
+                    job = self._pending.popleft()
+                    job.state = JOB_RUNNING
+                    self._running[job.job_id] = job
+                    jobs.append(job)
+        # 任务交给 runner 之前，展开的链接已经写入下载清单
+        self._notify_expanded()
+        return jobs
+
+    def finish(self, jobs, return_code, max_retries=0):
+        """标记任务结束
+
+        进程异常退出时，尚未完成且重试次数未用完的任务会重新放回队列头部。
+        runner 在看到任务完成时可以提前把 job.state 设为 JOB_DONE。
+
+        Returns:
+            队列是否因此变为空闲（没有等待和正在下载的任务）
+        """
+        with self._cond:
+            retried = []
+            for job in jobs:
+                if self._running.pop(job.job_id, None) is None:
+                    continue
+                if return_code != 0 and job.state != JOB_DONE and job.attempts < max_retries:
+                    job.attempts += 1
+                    job.state = JOB_PENDING
+                    # 重试时接着上次中断留下的临时文件下载
+                    job.resume = True
+                    retried.append(job)
+                    continue
+                job.return_code = return_code
+                if return_code != 0 and job.state != JOB_DONE:
+                    job.state = JOB_FAILED
+                    self.total_failed += 1
+                else:
+                    job.state = JOB_DONE
+                self.total_finished += 1
+            if retried:
+                self._pending.extendleft(reversed(retried))
+                self._cond.notify_all()
+            return not self._pending and not self._running and not self._sources
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def is_idle(self):
+        with self._cond:
+            return not self._pending and not self._running and not self._sources
+
+    def close(self):
+        """关闭队列，唤醒所有等待中的工作线程"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class DownloadScheduler:
+    """下载调度器
+
+    维护若干工作槽位，每个槽位是一个常驻线程，
+    空闲槽位会立即从队列领取新任务并交给 runner 执行。
+
+    分片模式下每个槽位领取一批链接交给一个 tdl 进程，
+    批大小按 等待任务数 / 空闲槽位数 计算，使各分片尽量均衡，
+    且不超过 max_batch，避免命令行超过系统长度限制（Windows 约 32K 字符），
+    链接更多时分成多次调用；分片进程异常退出时，未完成的链接会重新入队一次。
+    """
+
+    def __init__(self, queue, runner, on_idle=None, on_change=None, slots=1, max_batch=300):
+        """
+        Args:
+            queue: DownloadQueue
+            runner: 执行任务的回调，参数为任务列表，返回进程返回码
+            on_idle: 队列全部完成时的回调
+            on_change: 任务被领取或结束时的回调，用于刷新界面
+            slots: 并行槽位数
+            max_batch: 分片模式下单个 tdl 进程最多领取的链接数
+        """
+        self.queue = queue
+        self.runner = runner
+        self.on_idle = on_idle
+        self.on_change = on_change
+        self.slots = max(1, slots)
+        self.max_batch = max(1, max_batch)
+        self.shard = False
+        self.max_retries = 0
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._busy = 0
+
+    def set_slots(self, slots, shard=False, max_retries=None):
+        """调整槽位数，增加时立即启动新的工作线程，减少时多余线程在任务结束后退出
+        Args:
+            slots: 槽位数
+            shard: 是否启用分片模式
+            max_retries: 分片进程异常退出时未完成任务的重试次数，默认分片模式重试一次
+        """
+        with self._lock:
+            self.slots = max(1, slots)
+            self.shard = shard
+            self.max_retries = (1 if shard else 0) if max_retries is None else max_retries
+            while self._workers < self.slots:
+                self._workers += 1
+                threading.Thread(target=self._worker, daemon=True).start()
+
+    def start(self):
+        self.set_slots(self.slots)
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if self._workers > self.slots:
+                    self._workers -= 1
+                    return
+            jobs = self.queue.take(max_items=self._claim_batch, timeout=1.0)
+            if not jobs:
+                if self.queue.closed:
+                    with self._lock:
+                        self._workers -= 1
+                    return
+                continue
+            self._notify(self.on_change)
+            try:
+                return_code = self.runner(jobs)
+            except Exception as e:
+                print(f"执行下载任务时出错: {str(e)}")
+                return_code = -1
+            finally:
+                with self._lock:
+                    self._busy -= 1
+            idle = self.queue.finish(jobs, return_code, self.max_retries)
+            self._notify(self.on_change)
+            if idle:
+                self._notify(self.on_idle)
+
+    def _claim_batch(self, pending_count):
+        """占用一个槽位并计算本次领取的任务数，由 take() 在队列锁内调用"""
+        with self._lock:
+            free = max(1, self.slots - self._busy)
+            self._busy += 1
+            shard = self.shard
+        if not shard:
+            return 1
+        return min(self.max_batch, math.ceil(pending_count / free))
+
+    def _notify(self, callback):
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as e:
+            print(f"调度器回调出错: {str(e)}")
+
+
+class EventChannel:
+    """读取线程与界面消费线程之间的有界事件通道
+
+    读取线程只负责解析并调用 put() 投递事件，永远不会被阻塞：
+    进度、速度这类可合并的事件每个来源只保留最新一条；
+    其它事件按顺序排队，队列满时丢弃可丢弃的普通日志。
+    消费线程按顺序取出事件并调用对应的处理函数。
+    """
+
+    def __init__(self, capacity=10000, on_batch=None):
+        """
+        Args:
+            capacity: 普通事件队列的容量
+            on_batch: 每处理完一批事件调用一次，用于合并磁盘写入（如下载清单落盘）
+        """
+        self.capacity = capacity
+        self.on_batch = on_batch
+        self._cond = threading.Condition()
+        self._events = deque()
+        # 来源 -> {事件类型: (handler, event)}，只保留最新一条
+        self._latest = {}
+        self._running = False
+        # 统计：被合并的事件数和被丢弃的事件数
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, handler, event, key=None, coalesce=False, droppable=False):
+        """投递事件
+        Args:
+            handler: 处理函数，消费线程会调用 handler(event)
+            event: 事件对象
+            key: 事件来源（如任务ID），同一来源的事件保持先后顺序
+            coalesce: 是否可与同来源、同类型的事件合并；也可以传入子键（如文件名），
+                只与子键相同的事件合并
+            droppable: 队列满时是否可以丢弃
+        """
+        with self._cond:
+            if coalesce:
+                slots = self._latest.setdefault(key, {})
+                slot = getattr(event, 'kind', None)
+                if coalesce is not True:
+                    slot = (slot, coalesce)
+                if slot in slots:
+                    self.coalesced += 1
+                slots[slot] = (handler, event)
+            else:
+                # 先把同来源尚未处理的合并事件放回队列，保证先后顺序
+                slots = self._latest.pop(key, None)
+                if slots:
+                    self._events.extend(slots.values())
+                if droppable and len(self._events) >= self.capacity:
+                    self.dropped += 1
+                    return
+                self._events.append((handler, event))
+            self._cond.notify()
+
+    def barrier(self, key=None):
+        """投递一个屏障，消费线程处理到这里时返回的 Event 会被置位"""
+        reached = threading.Event()
+        self.put(None, reached, key=key)
+        return reached
+
+    def pending(self):
+        """尚未处理的事件数"""
+        with self._cond:
+            return len(self._events) + sum(len(slots) for slots in self._latest.values())
+
+    def start(self):
+        """启动消费线程"""
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        threading.Thread(target=self._consume, daemon=True).start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def _take_all(self):
+        with self._cond:
+            while self._running and not self._events and not self._latest:
+                self._cond.wait()
+            batch = list(self._events)
+            self._events.clear()
+            for slots in self._latest.values():
+                batch.extend(slots.values())
+            self._latest.clear()
+            return batch
+
+    def _consume(self):
+        while self._running:
+            batch = self._take_all()
+            for handler, event in batch:
+                if handler is None:
+                    event.set()
+                    continue
+                try:
+                    handler(event)
+                except Exception as e:
+                    print(f"处理事件时出错: {str(e)}")
+            if batch and self.on_batch is not None:
+                try:
+                    self.on_batch()
+                except Exception as e:
+                    print(f"处理事件时出错: {str(e)}")
+
+
+class LinkIndex:
+    """下载链接与 tdl 输出中文件名的对应索引
+
+    按 (会话ID, 消息ID) 和消息ID 建立哈希索引，查询时只从文本中提取
+    这几个标识再查表，耗时与链接总数无关；
+    无法解析的链接退回到按链接末段的文本标记匹配。
+    """
+
+    def __init__(self, links=()):
+        self._by_peer = {}
+        self._by_message = {}
+        self._by_name = {}
+        self._links = set()
+        # 会话 -> 消息范围列表，范围内的链接不逐个建立索引
+        self._ranges = {}
+        for link in links:
+            self.add(link)
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, link):
+        return link in self._links
+
+    def add(self, link):
+        """加入一个链接，返回用于日志显示的文件名标识"""
+        self._links.add(link)
+        parsed = parse_link(link)
+        if parsed is None:
+            name = link.split('?')[0].rstrip('/').split('/')[-1]
+            self._by_name.setdefault(name, link)
+            return name
+        chat, message = parsed
+        self._by_peer.setdefault((chat, message), link)
+        self._by_message.setdefault(message, []).append(link)
+        return message
+
+    def add_range(self, link_range):
+        """加入一个消息范围"""
+        self._ranges.setdefault(link_range.chat, []).append(link_range)
+
+    def _lookup_range(self, chat, message):
+        message = int(message)
+        if chat is not None:
+            ranges = self._ranges.get(chat, ())
+        else:
+            ranges = [link_range for items in self._ranges.values() for link_range in items]
+        for link_range in ranges:
+            if message in link_range:
+                return link_range.link(message)
+        return None
+
+    def clear(self):
+        self._by_peer.clear()
+        self._by_message.clear()
+        self._by_name.clear()
+        self._links.clear()
+        self._ranges.clear()
+
+    def lookup(self, text):
+        """查找输出文本或文件名对应的链接
+        Args:
+            text: 如 "频道(123456):789"、"123456_789_video.mp4.tmp"
+        Returns:
+            链接，找不到时返回 None
+        """
+        if not text:
+            return None
+        # 会话ID和消息ID都能对上时最可靠
+        pairs = _PEER_MESSAGE_PATTERN.findall(text) or _FILE_NAME_PATTERN.findall(text)
+        for chat, message in pairs:
+            link = self._by_peer.get((chat.lstrip('-'), message))
+            if link is None and self._ranges:
+                link = self._lookup_range(chat.lstrip('-'), message)
+            if link is not None:
+                return link
+        # 公开频道的链接是用户名，只能按消息ID匹配
+        for _, message in pairs:
+            links = self._by_message.get(message)
+            if links:
+                return links[0]
+            if self._ranges:
+                link = self._lookup_range(None, message)
+                if link is not None:
+                    return link
+        if not pairs:
+            for token in _NUMBER_TOKEN_PATTERN.findall(text):
+                links = self._by_message.get(token)
+                if links:
+                    return links[0]
+        if self._by_name:
+            for token in re.split(r'[\s\\/:()]+', text):
+                link = self._by_name.get(token)
+                if link is not None:
+                    return link
+        return None
+
+
+class DownloadManifest:
+    """崩溃安全的下载清单
+
+    以追加写入的 JSONL 日志记录每个链接的状态变化，每批记录写入后立即落盘，
+    程序崩溃或被强制结束后，重放日志即可知道哪些链接还没有完成。
+    加载时如果日志中的历史记录过多，会压缩为每个链接一条记录。
+    """
+
+    def __init__(self, path, lazy=False):
+        """
+        Args:
+            path: 清单文件路径
+            lazy: 为 True 时不在构造时重放日志，首次使用或调用 load() 时再加载
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # 链接 -> 最新状态，保持首次加入的顺序
+        self._states = {}
+        # 尚未落盘的记录行
+        self._buffer = []
+        self._file = None
+        self._loaded = False
+        if not lazy:
+            self.load()
+
+    def load(self):
+        """重放清单日志，已加载时什么也不做"""
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        records = 0
+        with open(self.path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    self._states[record["link"]] = record["state"]
+                    records += 1
+                except (ValueError, KeyError, TypeError):
+                    # 崩溃时可能留下写了一半的最后一行
+                    continue
+        if records > 2 * len(self._states) + 1000:
+            self._compact()
+
+    def _compact(self):
+        """把日志重写为每个链接一条记录"""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for link, state in self._states.items():
+                f.write(json.dumps({"link": link, "state": state}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def record(self, links, state, sync=True):
+        """记录一批链接的新状态
+        Args:
+            links: 链接列表
+            state: JOB_PENDING / JOB_RUNNING / JOB_DONE / JOB_FAILED / JOB_REMOVED
+            sync: 为 True 时连同缓冲中的记录立即写入并落盘；
+                为 False 时只放进缓冲，由 flush() 或下一次同步写入一起落盘，
+                用于下载过程中逐个文件的状态变化，进程结束时的最终状态仍然同步写入
+        """
+        if not links:
+            return
+        self.load()
+        lines = [json.dumps({"link": link, "state": state}, ensure_ascii=False) + "\n" for link in links]
+        with self._lock:
+            for link in links:
+                self._states[link] = state
+            self._buffer.extend(lines)
+            if sync:
+                self._write_buffer()
+
+    def flush(self):
+        """把缓冲中的记录写入并落盘"""
+        with self._lock:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        """需在锁内调用"""
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+                # 上次崩溃留下的半行不能和新记录拼在一起
+                if not self._ends_with_newline():
+                    lines.insert(0, "\n")
+            self._file.write("".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            print(f"写入下载清单失败: {str(e)}")
+
+    def _ends_with_newline(self):
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() == 0:
+                    return True
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) == b"\n"
+        except OSError:
+            return True
+
+    def state(self, link):
+        self.load()
+        with self._lock:
+            return self._states.get(link)
+
+    def unfinished(self):
+        """尚未完成的链接（等待中、下载中或失败），按加入顺序排列"""
+        self.load()
+        with self._lock:
+            return [link for link, state in self._states.items()
+                    if state in (JOB_PENDING, JOB_RUNNING, JOB_FAILED)]
+
+    def close(self):
+        with self._lock:
+            self._write_buffer()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class RangeProgress:
+    """在下载清单中记录消息范围尚未展开的部分
+
+    范围加入队列时就以 https://t.me/c/123/100-50000 的形式记入清单，
+    每展开一块，就把展开的链接和剩余的范围一起写入，旧的范围记为已移除。
+    程序在范围展开到一半时崩溃，恢复任务仍能从清单中找回剩余的消息。
+    """
+
+    def __init__(self, manifest, link_range):
+        """
+        Args:
+            manifest: DownloadManifest
+            link_range: LinkRange
+        """
+        self.manifest = manifest
+        self._range = LinkRange(link_range.chat, link_range.start, link_range.end)
+        self.remainder = self._range.text()
+        manifest.record([self.remainder], JOB_PENDING)
+
+    def expanded(self, links):
+        """展开一块链接后调用（DownloadQueue.add_source 的 on_expand）"""
+        previous = self.remainder
+        self._range.start += len(links)
+        self.remainder = self._range.text() if self._range.start <= self._range.end else None
+        # 先写入新的链接和剩余范围，再移除旧范围，中途崩溃时最多留下重叠的范围
+        self.manifest.record(list(links) + ([self.remainder] if self.remainder else []), JOB_PENDING)
+        if previous:
+            self.manifest.record([previous], JOB_REMOVED)
+
+    def discard(self):
+        """范围在展开完之前被移出队列时调用（DownloadQueue.add_source 的 on_discard）"""
+        if self.remainder:
+            self.manifest.record([self.remainder], JOB_REMOVED)
+            self.remainder = None
+
+
+def tdl_environment(env_vars):
+    """启动 tdl 时使用的环境变量
+    Args:
+        env_vars: 额外的环境变量，如代理、存储路径
+    """
+    env = os.environ.copy()
+    env['PYTHONIOENCODING'] = 'utf-8'
+    if os.name == 'nt':
+        env['PYTHONLEGACYWINDOWSSTDIO'] = '1'  # 修复Windows下的编码问题
+    env.update(env_vars)
+    return env
+
+
+def start_tdl(cmd, env):
+    """启动 tdl，标准输出和错误输出合并为一个管道，Windows 下不弹出控制台窗口"""
+    startupinfo = None
+    if os.name == 'nt':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    return subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=False,  # 二进制读取，由解析器处理编码
+        startupinfo=startupinfo,
+        env=env
+    )
+
+
+def stop_process(process, timeout=5):
+    """结束 tdl 进程并等待退出，超时后强制结束"""
+    try:
+        process.terminate()
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    except OSError:
+        pass
+
+
+class TdlRunner:
+    """启动 tdl 并把解析后的输出事件投递到事件通道
+
+    读取线程只负责按块读取、解析和投递事件，事件在 EventChannel 的消费线程中处理，
+    前端卡顿时进度事件会被合并，不会反过来阻塞管道和 tdl 本身。
+    """
+
+    def __init__(self, channel, processes=None, lines=None):
+        """
+        Args:
+            channel: EventChannel
+            processes: 正在运行的 tdl 进程列表，进程启动时加入、结束时移除
+            lines: 统计已解析输出行数的计数器（有 add() 方法），可以为 None
+        """
+        self.channel = channel
+        self.processes = processes if processes is not None else []
+        self.lines = lines
+
+    def _spawn(self, cmd, env):
+        process = start_tdl(cmd, env)
+        self.processes.append(process)
+        return process
+
+    def _pump(self, process, handler, key):
+        """读取进程输出直到进程结束
+        Returns:
+            进程返回码，返回前已等待消费线程处理完本进程的事件
+        """
+        parser = TdlOutputParser()
+        for line in TdlOutputReader(process.stdout):
+            if self.lines is not None:
+                self.lines.add()
+            try:
+                event = parser.parse(line)
+            except Exception as e:
+                print(f"Debug - 日志解析错误: {str(e)}")
+                continue
+            if event is None or event.kind == EVENT_SYSINFO:
+                continue
+            self.channel.put(
+                handler, event, key=key,
+                # 同时传输多个文件时按文件分别合并进度，每个文件保留最新一条
+                coalesce=(event.name or True) if event.kind in (EVENT_PROGRESS, EVENT_SPEED) else False,
+                droppable=event.kind == EVENT_LOG
+            )
+        return_code = process.wait()
+        self.channel.barrier(key).wait(timeout=30)
+        return return_code
+
+    def _release(self, process, finished):
+        """关闭管道并从进程列表中移除
+        Args:
+            finished: 进程是否已正常读完输出并退出，为 False 时先结束 tdl
+        """
+        if not finished and process.poll() is None:
+            stop_process(process)
+        process.stdout.close()
+        if process in self.processes:
+            self.processes.remove(process)
+
+
+class DownloadBatch:
+    """交给一个 tdl 下载进程的一批任务及其运行状态"""
+
+    def __init__(self, jobs):
+        self.key = jobs[0].job_id
+        self.jobs = jobs
+        self.links = [job.link for job in jobs]
+        # 本批次的文件名索引和任务状态表，用于对应输出中的文件和标记完成的任务
+        self.index = LinkIndex()
+        self.names = []
+        self.positions = {}
+        for position, job in enumerate(jobs):
+            self.names.append(self.index.add(job.link))
+            self.positions[job.link] = position
+        self.tasks = TaskTable(len(jobs))
+        # 最近开始下载的文件名
+        self.current_task = None
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def lookup(self, name):
+        """Returns: (本批次中对应的链接, 任务序号)，找不到时为 (None, None)"""
+        link = self.index.lookup(name)
+        return link, self.positions.get(link)
+
+
+class DownloadListener:
+    """DownloadRunner 的回调，前端覆盖需要的方法，默认什么也不做
+
+    started/progress/done/error 在事件通道的消费线程中按输出顺序调用，
+    command/failed/exited 在执行任务的调度器线程中调用。
+    """
+
+    def command(self, batch, cmd):
+        """即将启动 tdl"""
+
+    def started(self, batch, name, link, first):
+        """tdl 开始下载一个文件
+        Args:
+            link: 本批次中对应的链接，找不到时为 None
+            first: 该链接是否第一次开始（已开始过的任务不必重复提示）
+        """
+
+    def progress(self, batch, event, link):
+        """单个文件或整个进程的进度、速度"""
+
+    def done(self, batch, event, link, position):
+        """完成一个文件
+        Args:
+            link: 本批次中对应的链接，找不到时为 None
+            position: 被标记为完成的任务序号，没有可完成的任务时为 None
+        """
+
+    def error(self, batch, text):
+        """tdl 输出的错误行"""
+
+    def failed(self, batch, error):
+        """启动 tdl 或处理输出时出错"""
+
+    def exited(self, batch, return_code):
+        """进程已结束，本批次的最终状态已写入下载清单"""
+
+
+class DownloadRunner(TdlRunner):
+    """执行下载任务：启动 tdl、读取并解析输出、维护下载清单和按字节计算的进度
+
+    界面和命令行模式共用，通过 DownloadListener 接收日志和进度。
+    """
+
+    def __init__(self, channel, listener, manifest, progress, processes=None, lines=None):
+        """
+        Args:
+            channel: EventChannel，消费线程每处理完一批事件应调用 manifest.flush()
+            listener: DownloadListener
+            manifest: DownloadManifest
+            progress: ByteProgress，按链接记录已下载的字节数
+        """
+        super().__init__(channel, processes, lines)
+        self.listener = listener
+        self.manifest = manifest
+        self.progress = progress
+        # 看到完成行的链接 -> 完成行中的文件大小（可能为 None），与按百分比推算的大小分开记录
+        self._completed = {}
+        self._completed_lock = threading.Lock()
+
+    def reset(self):
+        """开始新一轮下载时清除完成记录"""
+        with self._completed_lock:
+            self._completed.clear()
+
+    def is_complete(self, link, size):
+        """链接是否已看到完成行，且文件大小与完成行中的大小一致
+
+        只有这样的临时文件才能改为正式文件名，按百分比推算的大小误差太大，不作为依据。
+        tdl 输出的大小保留两位小数（如 48.00 MB），比较时允许这一舍入误差。
+        """
+        with self._completed_lock:
+            if link not in self._completed:
+                return False
+            expected = self._completed[link]
+        return not expected or abs(size - expected) <= size_tolerance(expected)
+
+    @staticmethod
+    def build_command(batch, tdl_path, downloads_dir):
+        cmd = [tdl_path, "dl", "-d", downloads_dir]
+        if batch.jobs[0].threads > 1:
+            cmd.extend(["-t", str(batch.jobs[0].threads)])
+        if batch.jobs[0].limit > 1:
+            cmd.extend(["-l", str(batch.jobs[0].limit)])
+        if any(job.resume for job in batch.jobs):
+            # 续传上次中断留下的临时文件，不再询问是否继续
+            cmd.append("--continue")
+        for link in batch.links:
+            cmd.extend(["-u", link])
+        return cmd
+
+    def run(self, jobs, tdl_path, downloads_dir, env):
+        """用一个 tdl 进程下载一组任务（DownloadScheduler 的 runner）
+        Args:
+            jobs: 本次领取的任务列表
+            tdl_path: tdl 可执行文件路径
+            downloads_dir: 下载目录
+            env: tdl 进程的环境变量
+        Returns:
+            tdl 进程的返回码，启动或处理输出出错时为 -1
+        """
+        batch = DownloadBatch(jobs)
+        cmd = self.build_command(batch, tdl_path, downloads_dir)
+        process = None
+        return_code = None
+        try:
+            self.listener.command(batch, cmd)
+            process = self._spawn(cmd, env)
+            return_code = self._pump(process, lambda event: self._handle(batch, event), batch.key)
+        except Exception as e:
+            # 本批次未完成的链接记为失败
+            self.listener.failed(batch, e)
+        finally:
+            if process is not None:
+                self._release(process, return_code is not None)
+            if return_code is None:
+                return_code = -1
+            try:
+                # 进程正常退出时未能对应上的链接也视为完成
+                done_links = [job.link for job in jobs if job.state == JOB_DONE or return_code == 0]
+                self.manifest.record(done_links, JOB_DONE)
+                if len(done_links) < len(jobs):
+                    self.manifest.record([job.link for job in jobs if job.state != JOB_DONE], JOB_FAILED)
+            finally:
+                self.listener.exited(batch, return_code)
+        return return_code
+
+    def _handle(self, batch, event):
+        """处理一个输出事件（在消费线程中执行）"""
+        try:
+            if event.kind == EVENT_STARTED:
+                batch.current_task = event.name
+                link, position = batch.lookup(event.name)
+                first = True
+                if position is not None:
+                    self.manifest.record([link], JOB_RUNNING, sync=False)
+                    first = batch.tasks.mark_started(position)
+                self.listener.started(batch, event.name, link, first)
+
+            elif event.kind == EVENT_DONE:
+                name = event.name or ""
+                link, position = batch.lookup(name)
+                if link is not None:
+                    with self._completed_lock:
+                        self._completed[link] = event.done_bytes
+                # 对应不上时按开始顺序取最早未完成的任务，分片进程异常退出时不再重试
+                position = batch.tasks.mark_finished(position)
+                if position is not None:
+                    batch.jobs[position].state = JOB_DONE
+                    self.manifest.record([batch.jobs[position].link], JOB_DONE, sync=False)
+                self.progress.finish(link or name, event.done_bytes)
+                if batch.current_task == name:
+                    batch.current_task = None
+                self.listener.done(batch, event, link, position)
+
+            elif event.kind in (EVENT_PROGRESS, EVENT_SPEED):
+                link = None
+                if event.name and not event.aggregate:
+                    link, _ = batch.lookup(event.name)
+                    # 由已传输量和百分比推算文件大小，计入按字节的总体进度
+                    if event.done_bytes is not None:
+                        total_bytes = event.done_bytes * 100 / event.percent if event.percent else None
+                        self.progress.update(link or event.name, event.done_bytes, total_bytes)
+                self.listener.progress(batch, event, link)
+
+            elif event.kind == EVENT_ERROR:
+                self.listener.error(batch, event.text)
+        except Exception as e:
+            self.listener.error(batch, f"[日志解析错误: {str(e)}]")
+            print(f"Debug - 日志解析错误: {str(e)}")
+
+
+class UploadBatch:
+    """一次上传的文件及其运行状态"""
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.sizes = []
+        self._positions = {}
+        # tdl 的完成行可能只带文件名，按文件名再建一份索引（重名时取第一个）
+        self._name_positions = {}
+        for position, path in enumerate(self.paths):
+            try:
+                self.sizes.append(os.stat(path).st_size)
+            except OSError:
+                self.sizes.append(0)
+            self._positions[os.path.normcase(os.path.abspath(path))] = position
+            self._name_positions.setdefault(os.path.normcase(os.path.basename(path)), position)
+        # 已结束的文件数、上传成功的文件序号，逐个上传时的当前文件序号
+        self.completed = 0
+        self.succeeded = []
+        # 已按文件大小记入已上传字节数的文件序号
+        self.finished = set()
+        self.current = None
+        self.return_code = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def find(self, name):
+        """按 tdl 输出中的路径或文件名找到对应的文件序号，找不到时返回 None"""
+        if not name:
+            return None
+        position = self._positions.get(os.path.normcase(os.path.abspath(name)))
+        if position is None:
+            position = self._name_positions.get(os.path.normcase(os.path.basename(name.replace("\\", "/"))))
+        return position
+
+
+class UploadListener:
+    """UploadRunner 的回调，前端覆盖需要的方法，默认什么也不做
+
+    progress/done/output 在事件通道的消费线程中按输出顺序调用
+    （逐个上传时 done 在上传线程中调用），其余方法在上传线程中调用。
+    """
+
+    def command(self, batch, cmd):
+        """即将启动 tdl"""
+
+    def started(self, batch, position):
+        """逐个上传时开始上传一个文件"""
+
+    def progress(self, batch, event, position):
+        """进度、速度
+        Args:
+            position: 对应的文件序号，整体进度或对应不上时为 None
+        """
+
+    def done(self, batch, position, return_code):
+        """一个文件上传结束
+        Args:
+            position: 文件序号，完成行对应不上文件时为 None
+            return_code: 逐个上传时为该文件 tdl 的返回码，一次上传全部文件时为 0
+        """
+
+    def output(self, batch, event):
+        """tdl 输出的其它行（错误、普通日志）"""
+
+    def failed(self, batch, error):
+        """启动 tdl 或处理输出时出错"""
+
+    def exited(self, batch, return_code):
+        """上传结束"""
+
+
+class UploadRunner(TdlRunner):
+    """执行上传：启动 tdl、读取并解析输出、维护按字节计算的进度
+
+    可以用一个 tdl 进程上传全部文件（tdl 按 -l 并发），
+    也可以逐个文件启动 tdl，按每个文件的返回码确认是否上传成功。
+    """
+
+    def __init__(self, channel, listener, progress, processes=None, lines=None):
+        """
+        Args:
+            channel: EventChannel
+            listener: UploadListener
+            progress: ByteProgress，按文件序号记录已上传的字节数
+        """
+        super().__init__(channel, processes, lines)
+        self.listener = listener
+        self.progress = progress
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """逐个上传时不再启动后面的文件（正在运行的 tdl 由调用方结束）"""
+        self._cancelled.set()
+
+    def run(self, paths, tdl_path, env, chat=None, threads=1, concurrent=1, as_photo=False, delete_after=False,
+            per_file=False):
+        """上传文件
+        Args:
+            paths: 文件路径列表
+            tdl_path: tdl 可执行文件路径
+            env: tdl 进程的环境变量
+            chat: 目标聊天，为空时上传到收藏夹
+            threads: 线程数
+            concurrent: 一个 tdl 进程同时上传的文件数
+            as_photo: 作为照片上传
+            delete_after: 上传后删除原文件
+            per_file: 逐个文件启动 tdl
+        Returns:
+            UploadBatch，return_code 为最后一个失败的返回码（全部成功时为 0），
+            succeeded 为确认上传成功的文件序号
+        """
+        self._cancelled.clear()
+        batch = UploadBatch(paths)
+        self.progress.reset(len(batch))
+        for position, size in enumerate(batch.sizes):
+            self.progress.set_total(position, size)
+        options = []
+        if chat:
+            options.extend(["-c", chat])
+        if as_photo:
+            options.append("--photo")
+        if delete_after:
+            options.append("--rm")
+        try:
+            if per_file:
+                batch.return_code = 0
+                for position, path in enumerate(batch.paths):
+                    if self._cancelled.is_set():
+                        batch.return_code = batch.return_code or -1
+                        break
+                    batch.current = position
+                    self.listener.started(batch, position)
+                    return_code = self._upload(batch, [tdl_path, "up", "-p", path] + options, env,
+                                               lambda event: self._handle_single(batch, event))
+                    batch.completed += 1
+                    if return_code == 0:
+                        self.progress.finish(position, batch.sizes[position])
+                        batch.succeeded.append(position)
+                    else:
+                        batch.return_code = return_code
+                    self.listener.done(batch, position, return_code)
+            else:
+                cmd = [tdl_path, "up", "-t", str(threads), "-l", str(concurrent)]
+                for path in batch.paths:
+                    cmd.extend(["-p", path])
+                batch.return_code = self._upload(batch, cmd + options, env, lambda event: self._handle(batch, event))
+                if batch.return_code == 0:
+                    batch.succeeded = list(range(len(batch)))
+        except Exception as e:
+            batch.return_code = -1
+            self.listener.failed(batch, e)
+        finally:
+            if batch.return_code is None:
+                batch.return_code = -1
+            self.listener.exited(batch, batch.return_code)
+        return batch
+
+    def _upload(self, batch, cmd, env, handler):
+        """启动一个 tdl 上传进程并读取输出，返回返回码"""
+        self.listener.command(batch, cmd)
+        process = self._spawn(cmd, env)
+        return_code = None
+        try:
+            return_code = self._pump(process, handler, id(process))
+        finally:
+            self._release(process, return_code is not None)
+        return return_code
+
+    def _handle(self, batch, event):
+        """一次上传全部文件时处理一个输出事件（在消费线程中执行）"""
+        if event.kind == EVENT_DONE and not event.name:
+            # 不带文件名的汇总行（如 "Successfully uploaded 3 files"）：
+            # 把还没完成的文件一次性记为完成，不计入完成的文件数
+            for position in range(len(batch)):
+                if position not in batch.finished:
+                    batch.finished.add(position)
+                    self.progress.finish(position, batch.sizes[position])
+            self.listener.output(batch, event)
+        elif event.kind == EVENT_DONE:
+            batch.completed += 1
+            # 完成的文件按文件大小记入已上传字节数
+            position = batch.find(event.name)
+            if position is not None:
+                batch.finished.add(position)
+                self.progress.finish(position, batch.sizes[position])
+            self.listener.done(batch, position, 0)
+        elif event.kind in (EVENT_PROGRESS, EVENT_SPEED):
+            # 单个文件的进度行以文件路径开头，按路径找到对应文件记入已上传字节数
+            position = None
+            if event.name and not event.aggregate:
+                position = batch.find(event.name)
+            if position is not None and event.percent is not None:
+                done = event.done_bytes
+                if done is None:
+                    done = batch.sizes[position] * event.percent / 100
+                self.progress.update(position, done)
+            self.listener.progress(batch, event, position)
+        else:
+            self.listener.output(batch, event)
+
+    def _handle_single(self, batch, event):
+        """逐个上传时处理一个输出事件，文件是否成功由 tdl 的返回码决定"""
+        position = batch.current
+        if event.kind in (EVENT_PROGRESS, EVENT_SPEED):
+            if event.aggregate and event.percent is not None:
+                self.progress.update(position, batch.sizes[position] * event.percent / 100)
+            self.listener.progress(batch, event, position)
+        elif event.kind != EVENT_DONE:
+            self.listener.output(batch, event)
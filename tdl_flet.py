@@ -1,20 +1,526 @@
+import sys
+
+# 无界面模式（python tdl_flet.py --headless dl links.txt）在导入 flet 之前分流，不加载任何界面依赖
+if __name__ == "__main__" and "--headless" in sys.argv[1:]:
+    from tdl_headless import main as headless_main
+    sys.exit(headless_main([arg for arg in sys.argv[1:] if arg != "--headless"]))
+
 import flet as ft
+import flet.canvas as cv
 import subprocess
 import os
 import threading
-import re
 import time
 import signal
-import locale
-import sys
-import psutil
 from datetime import datetime
+from tdl_engine import (
+    ByteProgress, DownloadListener, DownloadManifest, DownloadQueue, DownloadRunner, DownloadScheduler, EventChannel,
+    LinkIndex, ProgressBoard, RangeProgress, ThroughputHistory, UploadListener, UploadRunner,
+    normalize_links, tdl_environment,
+    JOB_PENDING, JOB_DONE, JOB_FAILED, JOB_REMOVED,
+)
+from tdl_render import RenderLoop
+from tdl_logs import LogStore, SessionLogWriter
+from tdl_maintenance import MaintenanceService
+from tdl_upload_cache import UploadCache, UploadFile
+from tdl_verify import STATUS_TEXT, VERIFY_OK, VERIFY_UNKNOWN_SIZE, shutdown_pool, summarize, verify_files, write_report
+from tdl_metrics import MetricsRegistry, RateMeter, start_metrics
+from tdl_parser import decode_output, strip_control_chars, is_sysinfo, EVENT_PROGRESS
+
+class LogViewport:
+    """日志视图：只为可见的行创建控件
+
+    日志保存在 LogStore 中，视图固定只有一个文本控件，
+    滚轮滚动时从缓冲区取出对应窗口的行重新填充，历史行数再多也不会增加控件数量。
+    新日志先进入暂存区，每帧只写入缓冲区并重绘一次，暂存行数达到阈值时提前写入缓冲区。
+    """
+
+    def __init__(self, store, renderer, rows=20, scroll_step=3, stage_limit=500):
+        """
+        Args:
+            store: LogStore
+            renderer: RenderLoop，用于按帧刷新
+            rows: 可见行数
+            scroll_step: 每格滚轮滚动的行数
+            stage_limit: 暂存区的最大行数
+        """
+        self.store = store
+        self.renderer = renderer
+        self.rows = rows
+        self.scroll_step = scroll_step
+        self.stage_limit = stage_limit
+        self._staged = []
+        self._stage_lock = threading.Lock()
+        self._dirty = False
+        # 可见区域首行的绝对序号，None 表示跟随最新日志
+        self.top = None
+        self.text = ft.Text(
+            "",
+            selectable=True,
+            no_wrap=True,
+            style=ft.TextStyle(
+                size=13,
+                weight=ft.FontWeight.W_400,
+                color=ft.Colors.GREY_800,
+                font_family="Consolas"  # 使用等宽字体
+            )
+        )
+        self.position_text = ft.Text("", size=11, color=ft.Colors.GREY_600)
+        self.control = ft.Column(
+            [
+                ft.GestureDetector(
+                    content=ft.Container(
+                        content=self.text,
+                        alignment=ft.alignment.top_left,
+                        clip_behavior=ft.ClipBehavior.HARD_EDGE,
+                        expand=True
+                    ),
+                    on_scroll=self._on_scroll,
+                    expand=True
+                ),
+                ft.Row(
+                    [
+                        self.position_text,
+                        ft.Container(expand=True),
+                        ft.IconButton(
+                            icon=ft.Icons.VERTICAL_ALIGN_BOTTOM_ROUNDED,
+                            icon_size=16,
+                            tooltip="回到最新日志",
+                            on_click=lambda e: self.scroll_to_end()
+                        )
+                    ],
+                    height=24
+                )
+            ],
+            spacing=2,
+            expand=True
+        )
+        renderer.add_hook(self._on_frame)
+
+    def append(self, line, replace_last=False):
+        """暂存一行日志，在下一帧统一写入并刷新
+        Args:
+            line: 日志文本
+            replace_last: 是否替换最后一行
+        """
+        with self._stage_lock:
+            if replace_last and self._staged:
+                self._staged[-1] = line
+            elif replace_last:
+                self.store.replace_last(line)
+            else:
+                self._staged.append(line)
+                if len(self._staged) >= self.stage_limit:
+                    self.store.extend(self._staged)
+                    self._staged = []
+            self._dirty = True
+
+    def commit(self):
+        """把暂存的日志写入缓冲区"""
+        with self._stage_lock:
+            if self._staged:
+                self.store.extend(self._staged)
+                self._staged = []
+
+    def clear(self):
+        with self._stage_lock:
+            self._staged = []
+            self.store.clear()
+            self._dirty = True
+
+    def _on_frame(self):
+        self.commit()
+        if self._dirty:
+            self._dirty = False
+            self.refresh()
+
+    def _first_visible(self):
+        first = self.store.first_index
+        last_top = max(first, self.store.end_index - self.rows)
+        if self.top is None:
+            return last_top
+        return max(first, min(self.top, last_top))
+
+    def refresh(self):
+        """按当前滚动位置重新填充可见行（在下一帧刷新）"""
+        start, lines = self.store.window(self._first_visible(), self.rows)
+        self.renderer.set(self.text, value="\n".join(lines))
+        total = len(self.store)
+        if total:
+            position = f"{start - self.store.first_index + 1}-{start - self.store.first_index + len(lines)} / {total}"
+        else:
+            position = ""
+        self.renderer.set(self.position_text, value=position)
+
+    def scroll_to_end(self):
+        self.top = None
+        self.refresh()
+
+    def _on_scroll(self, e):
+        delta = e.scroll_delta_y or 0
+        if not delta:
+            return
+        step = self.scroll_step if delta > 0 else -self.scroll_step
+        top = self._first_visible() + step
+        # 滚到底部后恢复跟随最新日志
+        if top >= self.store.end_index - self.rows:
+            self.top = None
+        else:
+            self.top = max(self.store.first_index, top)
+        self.refresh()
+
+
+class TaskProgressView:
+    """正在下载的文件列表：固定数量的行控件循环复用
+
+    不管同时下载多少个文件，界面上都只有 rows 行控件，
+    每帧按滚动位置把进度表中对应的文件填进这些行，停滞的文件排在最前面。
+    """
+
+    def __init__(self, board, renderer, format_size, format_speed, rows=6):
+        """
+        Args:
+            board: ProgressBoard
+            renderer: RenderLoop，用于按帧刷新
+            format_size: 格式化文件大小的函数
+            format_speed: 格式化速度的函数
+            rows: 可见行数
+        """
+        self.board = board
+        self.renderer = renderer
+        self.format_size = format_size
+        self.format_speed = format_speed
+        self.rows = rows
+        self.offset = 0
+        self._version = -1
+        self._last_refresh = 0
+        text_style = ft.TextStyle(size=12, weight=ft.FontWeight.W_400, color=ft.Colors.GREY_800)
+        self.summary_text = ft.Text("", size=12, color=ft.Colors.GREY_600)
+        self._row_controls = []
+        row_widgets = []
+        for _ in range(rows):
+            name_text = ft.Text("", style=text_style, expand=True, no_wrap=True, overflow=ft.TextOverflow.ELLIPSIS)
+            bar = ft.ProgressBar(value=0, width=100, height=6, bar_height=6, color=ft.Colors.BLUE_400, bgcolor=ft.Colors.BLUE_50)
+            info_text = ft.Text("", style=text_style, width=190, no_wrap=True)
+            row = ft.Row([name_text, bar, info_text], spacing=8, visible=False)
+            self._row_controls.append((row, name_text, bar, info_text))
+            row_widgets.append(row)
+        self.control = ft.Column(
+            [
+                self.summary_text,
+                ft.GestureDetector(
+                    content=ft.Column(row_widgets, spacing=2),
+                    on_scroll=self._on_scroll
+                )
+            ],
+            spacing=4,
+            visible=False
+        )
+        renderer.add_hook(self._on_frame)
+
+    def _on_scroll(self, e):
+        delta = e.scroll_delta_y or 0
+        if delta:
+            self.offset = max(0, min(len(self.board) - self.rows, self.offset + (1 if delta > 0 else -1)))
+            self.refresh()
+
+    def _on_frame(self):
+        # 进度有变化时重绘；没有变化时每秒检查一次，以便显示新停滞的文件
+        now = time.monotonic()
+        if self.board.version != self._version or now - self._last_refresh >= 1:
+            self.refresh()
+
+    def refresh(self):
+        self._version = self.board.version
+        self._last_refresh = time.monotonic()
+        tasks = self.board.snapshot()
+        self.offset = max(0, min(self.offset, len(tasks) - self.rows))
+        stalled = sum(1 for task in tasks if self.board.is_stalled(task))
+        self.renderer.set(self.control, visible=bool(tasks))
+        summary = f"正在下载 {len(tasks)} 个文件"
+        if stalled:
+            summary += f"，其中 {stalled} 个超过 {self.board.stall_seconds} 秒没有进度"
+        self.renderer.set(self.summary_text, value=summary)
+        visible = tasks[self.offset:self.offset + self.rows]
+        for index, (row, name_text, bar, info_text) in enumerate(self._row_controls):
+            if index >= len(visible):
+                self.renderer.set(row, visible=False)
+                continue
+            task = visible[index]
+            is_stalled = self.board.is_stalled(task)
+            info = f"{task.percent:.1f}%  {self.format_speed(task.speed)}"
+            if task.total_bytes:
+                info = f"{task.percent:.1f}% / {self.format_size(task.total_bytes)}  {self.format_speed(task.speed)}"
+            if is_stalled:
+                info = f"停滞 {int(time.monotonic() - task.updated)}s  {task.percent:.1f}%"
+            self.renderer.set(row, visible=True)
+            self.renderer.set(name_text, value=task.name, tooltip=task.link or task.name)
+            self.renderer.set(bar, value=task.percent / 100, color=ft.Colors.ORANGE_400 if is_stalled else ft.Colors.BLUE_400)
+            self.renderer.set(info_text, value=info, color=ft.Colors.ORANGE_700 if is_stalled else ft.Colors.GREY_800)
+
+
+class SpeedSparkline:
+    """速度曲线：在速度文字旁用一条折线显示最近一段时间的吞吐量
+
+    每帧让 ThroughputHistory 按自己的间隔采样，产生新采样点时才重建折线，
+    折线只有一个 Path 形状，悬停时显示窗口内的最低、平均和峰值速度。
+    """
+
+    def __init__(self, history, renderer, format_speed, width=90, height=20, color=ft.Colors.GREEN_400):
+        """
+        Args:
+            history: ThroughputHistory
+            renderer: RenderLoop，用于按帧刷新
+            format_speed: 格式化速度的函数
+            width: 曲线宽度
+            height: 曲线高度
+            color: 折线颜色
+        """
+        self.history = history
+        self.renderer = renderer
+        self.format_speed = format_speed
+        self.width = width
+        self.height = height
+        self._paint = ft.Paint(stroke_width=1.5, color=color, style=ft.PaintingStyle.STROKE)
+        self.canvas = cv.Canvas(shapes=[], width=width, height=height)
+        self.control = ft.Container(
+            content=self.canvas,
+            width=width,
+            height=height,
+            bgcolor=ft.Colors.GREEN_50,
+            border_radius=3,
+            tooltip="暂无速度记录"
+        )
+        renderer.add_hook(self._on_frame)
+
+    def _on_frame(self):
+        if self.history.tick():
+            self.refresh()
+
+    def refresh(self):
+        values = self.history.values()
+        if len(values) < 2:
+            self.renderer.set(self.canvas, shapes=[])
+            return
+        # 以峰值为顶部，上下各留一个像素，x 轴按容量等分，数据从右侧向左增长
+        peak = max(values) or 1.0
+        step = self.width / max(1, self.history.capacity - 1)
+        x = self.width - step * (len(values) - 1)
+        elements = []
+        for value in values:
+            y = 1 + (self.height - 2) * (1 - value / peak)
+            elements.append(cv.Path.LineTo(x, y) if elements else cv.Path.MoveTo(x, y))
+            x += step
+        self.renderer.set(self.canvas, shapes=[cv.Path(elements, paint=self._paint)])
+        self.renderer.set(
+            self.control,
+            tooltip=(f"最近 {int(len(values) * self.history.interval)} 秒\n"
+                     f"最低 {self.format_speed(self.history.minimum)}\n"
+                     f"平均 {self.format_speed(self.history.average)}\n"
+                     f"峰值 {self.format_speed(self.history.peak)}")
+        )
+
+
+class AppDownloadListener(DownloadListener):
+    """把下载任务的事件显示到界面：下载日志、下载队列卡片中的进度表和总体进度"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def command(self, batch, cmd):
+        if len(batch) > 3:
+            # 长命令只显示开头几个链接，避免刷屏
+            shown = cmd[:-2 * (len(batch) - 3)]
+            self.app.add_log(f"添加下载命令: {' '.join(shown)} ...（共 {len(batch)} 个链接）")
+        else:
+            self.app.add_log(f"添加下载命令: {' '.join(cmd)}")
+
+    def started(self, batch, name, link, first):
+        # 已经输出过开始日志的任务不再重复输出
+        if not first:
+            return
+        if link is None:
+            link = self.app.link_index.lookup(name)
+        if link:
+            self.app.add_log(f"→ 开始下载: {name} ({link})")
+        else:
+            self.app.add_log(f"→ 开始下载: {name}")
+
+    def done(self, batch, event, link, position):
+        app = self.app
+        filename = event.name or ""
+        if link is None:
+            link = app.link_index.lookup(filename)
+        app.partial_files.pop(link, None)
+        if event.path:
+            app.completed_downloads.append((event.path, event.done_bytes, link))
+        app.files_completed["download"] += 1
+        if link:
+            app.add_log(f"√ 完成下载: {filename} ({link})")
+        else:
+            app.add_log(f"√ 完成下载: {filename}")
+        app.progress_board.finish(batch.key, filename)
+        self._set_job_state(batch, progress=batch.tasks.finished)
+
+    def progress(self, batch, event, link):
+        app = self.app
+        # 单个文件的进度记入进度表，在下载队列卡片中逐行显示
+        if event.name and not event.aggregate:
+            app.progress_board.update(
+                batch.key, event.name, link,
+                percent=event.percent, done_bytes=event.done_bytes, speed=event.speed
+            )
+        if app.enable_multi_task and not event.aggregate:
+            # 多任务模式只使用总体进度条
+            return
+        progress = None
+        if event.aggregate:
+            # 进度条是整个进程的总体进度，按本批次任务数折算
+            progress = event.percent / 100 * len(batch)
+        elif event.percent is not None:
+            # 当前文件的进度加上本批次已完成的文件数
+            progress = batch.tasks.finished + event.percent / 100
+        self._set_job_state(batch, progress=progress, speed=event.speed)
+        # 检查是否有新任务需要输出开始日志
+        position = batch.tasks.next_unstarted()
+        if position is not None:
+            app.add_log(f"→ 开始下载: {batch.names[position]} ({batch.jobs[position].link})")
+            batch.current_task = batch.names[position]
+
+    def error(self, batch, text):
+        self.app.add_log(text)
+
+    def failed(self, batch, error):
+        self.app.add_log(f"执行下载任务时出错: {str(error)}")
+
+    def exited(self, batch, return_code):
+        app = self.app
+        with app._job_lock:
+            app._job_progress.pop(batch.key, None)
+            app._job_speed.pop(batch.key, None)
+        app.progress_board.remove_group(batch.key)
+        # 去掉已结束进程的速度后重新计算总速度，速度曲线和速度文字不再停留在旧值
+        app._update_total_download_progress()
+        for job in batch.jobs:
+            app.session_log.write(
+                "download", None, event="job_exit", link=job.link,
+                done=job.state == JOB_DONE, return_code=return_code
+            )
+        if return_code != 0:
+            if len(batch) > 1:
+                unfinished = sum(1 for job in batch.jobs if job.state != JOB_DONE)
+                app.add_log(f"tdl进程异常退出，返回码: {return_code}，未完成 {unfinished}/{len(batch)} 个链接")
+            else:
+                app.add_log(f"下载过程中出现错误，返回码: {return_code} ({batch.links[0]})")
+
+    def _set_job_state(self, batch, progress=None, speed=None):
+        """记录本槽位的进度和速度并刷新总体进度
+        Args:
+            progress: 本批次已完成的任务量（以任务数计，可以是小数）
+            speed: 本进程的下载速度（字节每秒）
+        """
+        app = self.app
+        with app._job_lock:
+            if progress is not None:
+                app._job_progress[batch.key] = min(len(batch), progress)
+            if speed is not None:
+                app._job_speed[batch.key] = speed
+        app._update_total_download_progress()
+
+
+class AppUploadListener(UploadListener):
+    """把上传的事件显示到界面：上传日志、当前文件进度和总体进度"""
+
+    def __init__(self, app, multi):
+        """
+        Args:
+            app: TDLDownloaderApp
+            multi: 是否为一个tdl进程上传所有文件的多任务上传
+        """
+        self.app = app
+        self.multi = multi
+        self.is_uploading = False
+        self.last_progress = 0
+
+    def _report_total(self, count_progress):
+        """更新总体进度，有文件大小时按字节计算，否则使用按文件数计算的进度"""
+        fraction = self.app.upload_bytes.fraction()
+        total_value = fraction * 100 if fraction is not None else count_progress
+        self.app.update_upload_progress(total_value=total_value, eta=self.app.upload_bytes.eta())
+
+    def command(self, batch, cmd):
+        self.app.add_upload_log(f"执行命令: {' '.join(cmd)}")
+
+    def started(self, batch, position):
+        app = self.app
+        app.update_network_speed(0, False)
+        self.is_uploading = True
+        app.add_upload_log(f"正在上传: {os.path.basename(batch.paths[position])}")
+        app.update_upload_progress(current_value=0, text=f"上传文件 {position + 1}/{len(batch)}")
+        self._report_total(batch.completed / len(batch) * 100)
+
+    def progress(self, batch, event, position):
+        app = self.app
+        total_files = len(batch)
+        if not self.multi:
+            # 逐个上传时只刷新卡片，不进日志
+            if event.speed is not None:
+                app.update_network_speed(event.speed, False)
+            if event.aggregate and event.percent is not None:
+                app.update_upload_progress(current_value=event.percent)
+                self._report_total((batch.completed + event.percent / 100) / total_files * 100)
+            return
+        # 检测上传开始 - 当看到进度信息时认为开始上传
+        if event.kind == EVENT_PROGRESS and not self.is_uploading:
+            app.update_network_speed(0, False)
+            self.is_uploading = True
+            app.add_upload_log(f"正在多任务上传（共{total_files}个文件）")
+            app.update_upload_progress(current_value=0, text=f"多任务上传 1/{total_files}")
+            self._report_total(batch.completed / total_files * 100)
+            self.last_progress = 0
+        elif self.is_uploading:
+            if event.aggregate:
+                # 多任务上传时，优先使用总体进度条：[##########################.......................................] [8s; 6.54 MB/s]
+                app.update_upload_progress(current_value=event.percent, total_value=event.percent,
+                                           eta=app.upload_bytes.eta())
+            elif event.percent is not None and abs(event.percent - self.last_progress) >= 1.0:
+                # 只有当进度变化超过1%时才更新，避免频繁闪烁
+                app.update_upload_progress(current_value=event.percent)
+                self._report_total((batch.completed + event.percent / 100) / total_files * 100)
+                self.last_progress = event.percent
+            if event.speed is not None:
+                app.update_network_speed(event.speed, False)
+
+    def done(self, batch, position, return_code):
+        app = self.app
+        app.update_network_speed(0, False)
+        self.is_uploading = False
+        if self.multi:
+            app.files_completed["upload"] += 1
+            app.add_upload_log(f"完成多任务上传（{batch.completed}/{len(batch)}）")
+            self.last_progress = 100
+        elif return_code:
+            app.add_upload_log(f"上传失败: {os.path.basename(batch.paths[position])}（返回码: {return_code}）")
+        else:
+            app.files_completed["upload"] += 1
+            app.add_upload_log(f"完成上传: {os.path.basename(batch.paths[position])}")
+        app.update_upload_progress(current_value=100)
+        self._report_total(batch.completed / len(batch) * 100)
+
+    def output(self, batch, event):
+        # 过滤掉不需要显示的日志
+        if event.text and not event.text.startswith("Files count:"):
+            self.app.add_upload_log(event.text)
+
+    def failed(self, batch, error):
+        self.app.add_upload_log(f"执行上传时出错: {str(error)}")
+
+    def exited(self, batch, return_code):
+        self.app.update_network_speed(0, False)
+
 
 class TDLDownloaderApp:
     def __init__(self):
-        # 获取系统默认编码
-        self.system_encoding = locale.getpreferredencoding()
-        
         # 初始化网络速度显示相关的属性
         self.download_speed_text = ft.Text("0 B/s", style=ft.TextStyle(
             size=14,
@@ -40,6 +546,11 @@ class TDLDownloaderApp:
         # 保存基础路径
         self.base_path = base_path
         
+        # 会话日志：所有下载、上传日志由后台线程写入 logs 目录，按大小轮转并压缩
+        self.logs_dir = os.path.join(base_path, "logs")
+        self.session_log = SessionLogWriter(self.logs_dir)
+        self.session_log.start()
+        
         self.downloads_dir = os.path.join(base_path, "downloads")
         os.makedirs(self.downloads_dir, exist_ok=True)
         
@@ -47,7 +558,42 @@ class TDLDownloaderApp:
         self.running_processes = []
         
         # 存储下载链接和文件名的映射关系
-        self.download_links_map = {}
+        self.link_index = LinkIndex()
+        
+        # 下载清单，记录每个链接的状态，程序重启后可以只恢复未完成的链接
+        self.manifest = DownloadManifest(os.path.join(self.downloads_dir, "download_manifest.jsonl"), lazy=True)
+        # 队列中尚未展开完的消息范围，恢复任务时跳过它们在清单中的剩余部分
+        self.range_sources = []
+        # 下载目录中保留的未完成临时文件：链接 -> (文件名, 已下载字节数)，恢复任务时续传
+        self.partial_files = {}
+        # 上传去重缓存，记录每个聊天已上传过的文件，首次上传时才加载
+        self.upload_cache = UploadCache(os.path.join(base_path, "upload_cache.jsonl"))
+        # 最近一次下载使用的 (线程数, 并发数, 分片进程数)，恢复任务时沿用
+        self.last_download_settings = (1, 1, 1)
+        
+        # 正在下载的各个文件的实时进度
+        self.progress_board = ProgressBoard()
+        # 按字节计算的总体下载、上传进度和剩余时间
+        self.download_bytes = ByteProgress()
+        self.upload_bytes = ByteProgress()
+        
+        # 下载目录维护服务，清理和检查临时文件在后台线程中分批进行
+        self.maintenance = MaintenanceService(
+            on_error=lambda name, e: self.add_log(f"维护任务 {name} 出错: {str(e)}")
+        )
+        # 每轮下载结束后校验完成的文件，为 None 时只核对大小不计算哈希
+        self.verify_algorithm = "sha256"
+        # 本轮下载完成的文件 (tdl 输出的路径, tdl 记录的大小, 链接)，队列空闲时一起校验
+        self.completed_downloads = []
+        
+        # 常驻下载队列和调度器，下载进行中也可以继续追加链接
+        self.download_queue = DownloadQueue()
+        self.download_scheduler = None
+        self.download_page = None
+        # 各任务当前的进度和速度，用于合并多个槽位的总体进度
+        self._job_progress = {}
+        self._job_speed = {}
+        self._job_lock = threading.Lock()
         
         # 环境变量
         self.env_vars = {
@@ -64,7 +610,6 @@ class TDLDownloaderApp:
             self.tdl_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tdl.exe")
 
         # 初始化上传相关的变量
-        self.upload_log_view = None
         self.upload_current_task_text = None
         self.upload_current_progress = None
         self.upload_current_progress_text = None
@@ -75,13 +620,17 @@ class TDLDownloaderApp:
         # 初始化多任务下载设置
         self.enable_multi_task = False
         
-        # 初始化下载进度显示
-        self.download_speed_text = ft.Text("0 B/s", style=ft.TextStyle(
-            size=14,
-            weight=ft.FontWeight.W_400,
-            color=ft.Colors.GREEN_400
-        ))
-        self.current_download_speed = "0 B/s"
+        # 界面刷新循环，进度和速度按固定帧率合并刷新
+        self.ui_refresh_rate = 10  # 每秒刷新次数
+        self.renderer = RenderLoop(fps=self.ui_refresh_rate)
+        # 下载队列显示只在队列变化后标记为脏，每帧最多重建一次
+        self._queue_view_dirty = True
+        self.renderer.add_hook(self._render_queue_view)
+        
+        # 输出读取线程与界面处理之间的事件通道，界面卡顿时不会阻塞tdl的输出管道
+        # 每处理完一批事件，把这批事件中的下载清单记录一起落盘
+        self.event_channel = EventChannel(capacity=10000, on_batch=self.manifest.flush)
+        self.event_channel.start()
         
         # 初始化总体进度条
         self.total_progress_bar = ft.ProgressBar(
@@ -92,55 +641,49 @@ class TDLDownloaderApp:
             bgcolor=ft.Colors.BLUE_50,
             color=ft.Colors.BLUE,
         )
-        self.total_progress_text = ft.Text(
-            "0%",
-            style=ft.TextStyle(
-                size=14,
-                weight=ft.FontWeight.BOLD,  # 加粗显示进度
-                color=ft.Colors.BLUE_700
-            )
-        )
+        # 总体进度文字在创建下载标签页时创建
+        self.total_progress_text = None
         
         # 初始化任务进度
         self.total_tasks = 0
         self.completed_tasks = 0
         self.current_task_progress = 0
 
-        # 日志缓存队列，防止初始化早期log_view未创建时报错
-        self._pending_logs = []
-
-        # 检查并删除残留的 tdl_download.bat 文件
-        tdl_bat_path = os.path.join(self.base_path, "tdl_download.bat")
-        if os.path.exists(tdl_bat_path):
-            try:
-                os.remove(tdl_bat_path)
-                self.add_log("已自动删除残留的 tdl_download.bat 文件")
-            except Exception as e:
-                self.add_log(f"删除残留 tdl_download.bat 文件失败: {e}")
-
-        # 检查并删除下载目录中的所有 .tmp 文件
-        try:
-            for fname in os.listdir(self.downloads_dir):
-                if fname.endswith('.tmp'):
-                    tmp_path = os.path.join(self.downloads_dir, fname)
-                    try:
-                        os.remove(tmp_path)
-                        self.add_log(f"已自动删除残留的临时文件: {fname}")
-                    except Exception as e:
-                        self.add_log(f"删除临时文件 {fname} 失败: {e}")
-        except Exception as e:
-            self.add_log(f"扫描下载目录删除临时文件时出错: {e}")
-
-        # 检查并删除残留的 tdl_upload.bat 文件
-        tdl_upload_bat_path = os.path.join(self.base_path, "tdl_upload.bat")
-        if os.path.exists(tdl_upload_bat_path):
-            try:
-                os.remove(tdl_upload_bat_path)
-                self.add_log("已自动删除残留的 tdl_upload.bat 文件")
-            except Exception as e:
-                self.add_log(f"删除残留 tdl_upload.bat 文件失败: {e}")
+        # 日志保存在环形缓冲区中，视图只渲染可见的行
+        self.log_store = LogStore(capacity=100000)
+        self.log_viewport = LogViewport(self.log_store, self.renderer)
+        self.upload_log_store = LogStore(capacity=100000)
+        self.upload_log_viewport = LogViewport(self.upload_log_store, self.renderer)
+        self.file_progress_view = TaskProgressView(
+            self.progress_board, self.renderer, self._format_file_size, self._format_speed
+        )
+        # 平滑后的上传、下载速度历史，显示为速度文字旁的曲线
+        self.download_throughput = ThroughputHistory()
+        self.upload_throughput = ThroughputHistory()
+        self.download_sparkline = SpeedSparkline(self.download_throughput, self.renderer, self._format_speed)
+        self.upload_sparkline = SpeedSparkline(self.upload_throughput, self.renderer, self._format_speed)
+        
+        # 运行指标：设置环境变量 TDLGUI_METRICS_PORT 时在本机端口提供 /metrics，
+        # 设置 TDLGUI_METRICS_FILE 时定期重写 JSON 文件，都不设置时不启动
+        self.download_lines = RateMeter()
+        self.upload_lines = RateMeter()
+        self.files_completed = {"download": 0, "upload": 0}
+        # 下载的执行器：启动tdl、解析输出，事件交给界面的回调显示；上传的执行器在每次上传时创建
+        self.upload_runner = None
+        self.download_runner = DownloadRunner(
+            self.event_channel, AppDownloadListener(self), self.manifest, self.download_bytes,
+            processes=self.running_processes, lines=self.download_lines
+        )
+        self.metrics = MetricsRegistry()
+        self._register_metrics()
+        self.metrics_services = start_metrics(
+            self.metrics, os.environ.get("TDLGUI_METRICS_PORT"), os.environ.get("TDLGUI_METRICS_FILE")
+        )
 
     def main(self, page: ft.Page):
+        # 启动界面刷新循环
+        self.renderer.attach(page)
+        
         # 设置页面属性
         page.title = "TDL下载器"
         page.theme_mode = ft.ThemeMode.LIGHT
@@ -237,15 +780,30 @@ class TDLDownloaderApp:
             
             # 创建任务列表容器
             self.tasks_container = ft.Container(
-                content=ft.Column([], spacing=10),
+                content=ft.ListView([], spacing=4),
                 bgcolor=ft.Colors.BLUE_50,
                 border_radius=8,
                 padding=10,
-                expand=True,
-                height=300,  # 增加高度以显示更多任务
+                height=180,  # 下载队列区域高度
                 border=ft.border.all(1, ft.Colors.BLUE_200),
             )
             
+            # 恢复未完成任务按钮
+            resume_button = ft.TextButton(
+                "恢复未完成任务",
+                icon=ft.Icons.RESTORE_ROUNDED,
+                on_click=self.resume_unfinished_downloads,
+                style=text_button_style
+            )
+            
+            # 清空等待队列按钮
+            clear_queue_button = ft.TextButton(
+                "清空等待队列",
+                icon=ft.Icons.PLAYLIST_REMOVE_ROUNDED,
+                on_click=self.clear_download_queue,
+                style=text_button_style
+            )
+            
             # 状态栏
             # self.status_text.value = "就绪" # This line is removed
             # self.status_text.color = ft.Colors.BLUE # This line is removed
@@ -304,68 +862,9 @@ class TDLDownloaderApp:
                 **textfield_style
             )
             
-            # 进度条样式
-            progress_style = {
-                "bgcolor": ft.Colors.BLUE_50,
-                "color": ft.Colors.BLUE,
-            }
-            
-            # 进度条
-            self.current_task_text = ft.Text("无任务", style=normal_text_style)
-            
-            self.current_progress = ft.ProgressBar(
-                width=650,
-                value=0,
-                height=8,
-                bar_height=8,
-                tooltip="当前文件下载进度",
-                **progress_style
-            )
-            self.current_progress_text = ft.Text("0%", style=normal_text_style)
-            
-            self.total_progress = ft.ProgressBar(
-                width=650,
-                value=0,
-                height=10,
-                bar_height=10,
-                tooltip="总体下载进度",
-                **progress_style
-            )
+            # 总体进度文字，进度条为 __init__ 中创建的 total_progress_bar
             self.total_progress_text = ft.Text("0%", style=normal_text_style, weight=ft.FontWeight.BOLD)
             
-            # 日志输出
-            self.log_view = ft.ListView(
-                expand=True,
-                spacing=2,
-                auto_scroll=True,
-                height=450,  # 增加日志区域的高度
-                padding=10
-            )
-            # >>>> 在log_view创建后，写入所有pending日志
-            if hasattr(self, '_pending_logs') and self._pending_logs:
-                for log, replace_last in self._pending_logs:
-                    # 只传递内容部分，时间戳已包含
-                    if replace_last and len(self.log_view.controls) > 0:
-                        self.log_view.controls[-1].content.value = log
-                        self.log_view.controls[-1].content.update()
-                    else:
-                        self.log_view.controls.append(
-                            ft.Container(
-                                content=ft.Text(log, selectable=True, style=ft.TextStyle(
-                                    size=13,
-                                    weight=ft.FontWeight.W_400,
-                                    color=ft.Colors.GREY_800,
-                                    font_family="Consolas"
-                                )),
-                                padding=ft.padding.symmetric(vertical=2)
-                            )
-                        )
-                self._pending_logs.clear()
-                try:
-                    self.log_view.update()
-                except:
-                    pass
-            # <<<<
             
             # 下载按钮
             download_button = ft.ElevatedButton(
@@ -507,6 +1006,23 @@ class TDLDownloaderApp:
                                                                 selection_color=ft.Colors.BLUE_100,
                                                                 disabled=True,
                                                             ),
+                                                            ft.TextField(
+                                                                label="分片进程数",
+                                                                value="1",
+                                                                hint_text="大于1时将链接均分给多个tdl进程",
+                                                                prefix_icon=ft.Icons.CALL_SPLIT_ROUNDED,
+                                                                expand=True,
+                                                                border_radius=8,
+                                                                filled=True,
+                                                                bgcolor=ft.Colors.BLUE_50,
+                                                                border_color=ft.Colors.BLUE_200,
+                                                                focused_border_color=ft.Colors.BLUE,
+                                                                focused_bgcolor=ft.Colors.WHITE,
+                                                                text_size=14,
+                                                                cursor_color=ft.Colors.BLUE,
+                                                                selection_color=ft.Colors.BLUE_100,
+                                                                disabled=True,
+                                                            ),
                                                         ],
                                                         spacing=10
                                                     ),
@@ -567,6 +1083,7 @@ class TDLDownloaderApp:
                                                                                color=ft.Colors.GREEN_400,
                                                                                size=16),
                                                                         self.download_speed_text,
+                                                                        self.download_sparkline.control,
                                                                     ],
                                                                 ),
                                                                 ft.Container(expand=True),
@@ -599,6 +1116,30 @@ class TDLDownloaderApp:
                                         surface_tint_color=ft.Colors.WHITE
                                     ),
                                     
+                                    # 下载队列卡片
+                                    ft.Card(
+                                        content=ft.Container(
+                                            content=ft.Column([
+                                                ft.Row(
+                                                    [
+                                                        ft.Icon(ft.Icons.QUEUE_ROUNDED, color=ft.Colors.INDIGO_400),
+                                                        ft.Text("下载队列", style=subtitle_style),
+                                                        ft.Container(expand=True),
+                                                        resume_button,
+                                                        clear_queue_button
+                                                    ]
+                                                ),
+                                                ft.Divider(height=1, thickness=1, color=ft.Colors.BLACK12),
+                                                self.file_progress_view.control,
+                                                self.tasks_container,
+                                            ]),
+                                            padding=15
+                                        ),
+                                        elevation=2,
+                                        margin=ft.margin.only(top=15),
+                                        surface_tint_color=ft.Colors.WHITE
+                                    ),
+                                    
                                     # 输出日志卡片
                                     ft.Card(
                                         content=ft.Container(
@@ -624,7 +1165,7 @@ class TDLDownloaderApp:
                                                 ),
                                                 ft.Divider(height=1, thickness=1, color=ft.Colors.BLACK12),
                                                 ft.Container(
-                                                    content=self.log_view,
+                                                    content=self.log_viewport.control,
                                                     border=ft.border.all(1, ft.Colors.BLUE_50),
                                                     border_radius=8,
                                                     bgcolor=ft.Colors.BLUE_50,
@@ -677,12 +1218,14 @@ class TDLDownloaderApp:
                                     multi_task_container = download_card.content.content.controls[4]
                                     thread_field = multi_task_container.content.controls[0]
                                     concurrent_field = multi_task_container.content.controls[1]
+                                    shard_field = multi_task_container.content.controls[2]
                                     break
             
             if multi_task_container and thread_field and concurrent_field:
                 multi_task_container.visible = self.enable_multi_task
                 thread_field.disabled = not self.enable_multi_task
                 concurrent_field.disabled = not self.enable_multi_task
+                shard_field.disabled = not self.enable_multi_task
                 page.update()
 
         # 创建上传标签页内容
@@ -925,6 +1468,11 @@ class TDLDownloaderApp:
                 label="上传成功后删除本地文件",
                 value=False
             )
+
+            skip_uploaded = ft.Checkbox(
+                label="跳过已上传到该聊天的文件",
+                value=True
+            )
             
             # 进度条样式
             progress_style = {
@@ -955,15 +1503,6 @@ class TDLDownloaderApp:
             )
             self.upload_total_progress_text = ft.Text("0%", style=normal_text_style, weight=ft.FontWeight.BOLD)
             
-            # 上传日志输出
-            self.upload_log_view = ft.ListView(
-                expand=True,
-                spacing=2,
-                auto_scroll=True,
-                height=450,  # 增加日志区域的高度
-                padding=10
-            )
-            
             def start_upload(e):
                 try:
                     if not self.selected_files:
@@ -986,6 +1525,7 @@ class TDLDownloaderApp:
                     self.add_upload_log(f"线程数: {threads}, 并发数: {concurrent}")
                     self.add_upload_log(f"以照片形式上传: {'是' if upload_as_photo.value else '否'}")
                     self.add_upload_log(f"上传后删除: {'是' if delete_after_upload.value else '否'}")
+                    self.add_upload_log(f"跳过已上传的文件: {'是' if skip_uploaded.value else '否'}")
                     threading.Thread(
                         target=self._upload_thread,
                         args=(
@@ -996,7 +1536,8 @@ class TDLDownloaderApp:
                             upload_as_photo.value,
                             delete_after_upload.value,
                             page,
-                            self.enable_multi_upload
+                            self.enable_multi_upload,
+                            skip_uploaded.value
                         ),
                         daemon=True
                     ).start()
@@ -1128,7 +1669,7 @@ class TDLDownloaderApp:
                                                 multi_upload_params_container,
                                                 ft.Container(height=2),
                                                 ft.Row(
-                                                    [upload_as_photo, delete_after_upload],
+                                                    [upload_as_photo, delete_after_upload, skip_uploaded],
                                                     spacing=5
                                                 ),
                                                 ft.Container(height=2),
@@ -1181,6 +1722,7 @@ class TDLDownloaderApp:
                                                                     ),
                                                                     ft.Icon(ft.Icons.SPEED_ROUNDED, color=ft.Colors.GREEN_400, size=16),
                                                                     self.upload_speed_text,
+                                                                    self.upload_sparkline.control,
                                                                 ]),
                                                                 ft.Container(expand=True),
                                                                 ft.Row([
@@ -1224,7 +1766,7 @@ class TDLDownloaderApp:
                                                 ),
                                                 ft.Divider(height=1, thickness=1, color=ft.Colors.BLACK12),
                                                 ft.Container(
-                                                    content=self.upload_log_view,
+                                                    content=self.upload_log_viewport.control,
                                                     border=ft.border.all(1, ft.Colors.BLUE_50),
                                                     border_radius=8,
                                                     bgcolor=ft.Colors.BLUE_50,
@@ -1367,6 +1909,35 @@ class TDLDownloaderApp:
         self.add_log(f"系统编码: {self.system_encoding}")
         self.add_log(f"下载目录: {self.downloads_dir}")
         self.add_log("准备就绪，请输入下载链接并点击「开始下载」按钮")
+        
+        # 清理残留文件、加载下载清单等与界面无关的工作在窗口显示后再在后台进行
+        threading.Thread(target=self._deferred_startup, daemon=True).start()
+    
+    @property
+    def system_encoding(self):
+        """系统默认编码，用到时才导入 locale"""
+        import locale
+        return locale.getpreferredencoding()
+    
+    def _deferred_startup(self):
+        """窗口显示后在后台执行的启动工作"""
+        # 检查并删除残留的 tdl_download.bat、tdl_upload.bat 文件
+        for bat_name in ("tdl_download.bat", "tdl_upload.bat"):
+            bat_path = os.path.join(self.base_path, bat_name)
+            if os.path.exists(bat_path):
+                try:
+                    os.remove(bat_path)
+                    self.add_log(f"已自动删除残留的 {bat_name} 文件")
+                except Exception as e:
+                    self.add_log(f"删除残留 {bat_name} 文件失败: {e}")
+        
+        # 上次运行留下的 .tmp 文件不再删除，找到对应的链接，恢复任务时续传
+        self.maintenance.submit("扫描未完成的临时文件", self._scan_partial_files)
+        
+        # 重放下载清单
+        unfinished = len(self.manifest.unfinished())
+        if unfinished:
+            self.add_log(f"下载清单中有 {unfinished} 个未完成的链接，可点击「恢复未完成任务」继续下载")
     
     def show_snackbar(self, page, message):
         """显示提示消息"""
@@ -1387,7 +1958,7 @@ class TDLDownloaderApp:
     
     def clear_logs(self, e):
         """清空日志"""
-        self.log_view.controls.clear()
+        self.log_viewport.clear()
         self.add_log("日志已清空")
         self.add_log(f"系统编码: {self.system_encoding}")
         self.add_log(f"下载目录: {self.downloads_dir}")
@@ -1406,74 +1977,13 @@ class TDLDownloaderApp:
             elif isinstance(text, str):
                 # 尝试重新编码解码来处理潜在的乱码
                 text = text.encode('utf-8', errors='replace').decode('utf-8')
-            from datetime import datetime
             timestamp = datetime.now().strftime("%H:%M:%S")
-            log_text_style = ft.TextStyle(
-                size=13,
-                weight=ft.FontWeight.W_400,
-                color=ft.Colors.GREY_800,
-                font_family="Consolas"  # 使用等宽字体
-            )
-            # 日志控件未初始化时，先缓存日志
-            if not hasattr(self, 'log_view') or self.log_view is None:
-                self._pending_logs.append((f"[{timestamp}] {text}", replace_last))
-                return
-            # 如果需要替换最后一行
-            if replace_last and len(self.log_view.controls) > 0:
-                self.log_view.controls[-1].content.value = f"[{timestamp}] {text}"
-                self.log_view.controls[-1].content.update()
-            else:
-                self.log_view.controls.append(
-                    ft.Container(
-                        content=ft.Text(f"[{timestamp}] {text}", selectable=True, style=log_text_style),
-                        padding=ft.padding.symmetric(vertical=2)
-                    )
-                )
-            if len(self.log_view.controls) > 1000:  # 限制日志数量
-                self.log_view.controls.pop(0)
-            try:
-                self.log_view.update()
-            except:
-                pass
+            # 暂存日志，由刷新循环每帧统一写入
+            self.log_viewport.append(f"[{timestamp}] {text}", replace_last)
+            self.session_log.write("download", text)
         except Exception as e:
             print(f"添加日志时出错: {str(e)}")
 
-    def update_progress(self, current_value=None, total_value=None, text=None):
-        """更新进度条"""
-        try:
-            if current_value is not None:
-                # 确保进度值在有效范围内
-                current_value = max(0, min(100, current_value))
-                # 使用极小的阈值，几乎实时更新
-                if abs(self.current_progress.value * 100 - current_value) >= 0.01:
-                    self.current_progress.value = current_value / 100
-                    # 只在整数值变化时更新文本
-                    new_text = f"{int(current_value)}%"
-                    if self.current_progress_text.value != new_text:
-                        self.current_progress_text.value = new_text
-                        self.current_progress_text.update()
-                    self.current_progress.update()
-            
-            if total_value is not None:
-                # 确保进度值在有效范围内
-                total_value = max(0, min(100, total_value))
-                # 使用极小的阈值，几乎实时更新
-                if abs(self.total_progress.value * 100 - total_value) >= 0.01:
-                    self.total_progress.value = total_value / 100
-                    # 只在整数值变化时更新文本
-                    new_text = f"{int(total_value)}%"
-                    if self.total_progress_text.value != new_text:
-                        self.total_progress_text.value = new_text
-                        self.total_progress_text.update()
-                    self.total_progress.update()
-            
-            if text and self.current_task_text.value != text:
-                self.current_task_text.value = text
-                self.current_task_text.update()
-
-        except Exception as e:
-            print(f"更新进度条时出错: {str(e)}")
-    
     def open_download_folder(self, e=None):
         """打开下载文件夹"""
         try:
@@ -1498,6 +2008,7 @@ class TDLDownloaderApp:
             links_field = None
             threads_field = None
             concurrent_field = None
+            shard_field = None
             multi_task_checkbox = None
             
             # 遍历页面寻找输入框
@@ -1520,6 +2031,7 @@ class TDLDownloaderApp:
                                     if multi_task_container.visible:  # 如果多任务设置可见
                                         threads_field = multi_task_container.content.controls[0]  # 获取线程数输入框
                                         concurrent_field = multi_task_container.content.controls[1]  # 获取并发数输入框
+                                        shard_field = multi_task_container.content.controls[2]  # 获取分片进程数输入框
                                     break
             
             if not links_field:
@@ -1533,398 +2045,315 @@ class TDLDownloaderApp:
             # 获取线程数和并发数（如果启用了多任务下载）
             threads = 1
             concurrent = 1
+            shards = 1
             if multi_task_checkbox and multi_task_checkbox.value:
                 try:
                     threads = int(threads_field.value)
                     concurrent = int(concurrent_field.value)
-                    if threads < 1 or concurrent < 1:
+                    shards = int(shard_field.value)
+                    if threads < 1 or concurrent < 1 or shards < 1:
                         raise ValueError()
                 except:
-                    self.show_snackbar(e.page, "线程数和并发数必须是大于0的整数")
+                    self.show_snackbar(e.page, "线程数、并发数和分片进程数必须是大于0的整数")
                     return
             
-            # 分割多行链接
-            links = [link.strip() for link in links_text.split("\n") if link.strip()]
-            
-            # 禁用按钮
-            download_button = None
-            for control in e.page.controls:
-                if isinstance(control, ft.Container):
-                    content_column = control.content
-                    if isinstance(content_column, ft.Column):
-                        main_content = content_column.controls[1]  # 获取主要内容区域
-                        if isinstance(main_content, ft.Container):
-                            stack = main_content.content.content  # 获取Stack控件
-                            if isinstance(stack, ft.Stack):
-                                download_tab = stack.controls[0]  # 获取下载标签页
-                                if download_tab.visible:  # 确保是当前可见的标签页
-                                    left_panel = download_tab.content.content.controls[0]  # 获取左侧面板
-                                    download_card = left_panel.content.controls[1]  # 获取下载设置卡片
-                                    download_button = download_card.content.content.controls[5].controls[0]  # 获取下载按钮
-                                    break
-            
-            if download_button:
-                download_button.disabled = True
-                download_button.update()
+            # 分割多行链接，规范化后去掉重复和已在队列中的链接，并按会话分组排序
+            queued = {job.link for job in self.download_queue.pending() + self.download_queue.running()}
+            links, ranges, duplicates, rejected = normalize_links(links_text.split("\n"), exclude=queued)
+            if rejected:
+                self.add_log(f"忽略 {len(rejected)} 行无法识别的链接:")
+                for line in rejected[:20]:
+                    self.add_log(f"  × {line}")
+                if len(rejected) > 20:
+                    self.add_log(f"  …… 其余 {len(rejected) - 20} 行未显示")
+            if duplicates:
+                self.add_log(f"跳过 {duplicates} 个重复的链接")
+            if not links and not ranges:
+                self.show_snackbar(e.page, "没有可下载的有效链接")
+                return
             
             # 确保下载目录存在
             os.makedirs(self.downloads_dir, exist_ok=True)
             
-            # 启动下载线程
-            threading.Thread(target=self._download_thread, args=(links, threads, concurrent, e.page), daemon=True).start()
+            # 加入下载队列，空闲槽位会立即开始下载
+            self.enqueue_downloads(links, threads, concurrent, e.page, shards, ranges)
+            
+            # 清空输入框，方便继续追加新的链接
+            links_field.value = ""
+            links_field.update()
         
         except Exception as ex:
             self.add_log(f"启动下载时出错: {str(ex)}")
             self.show_snackbar(e.page, f"启动下载时出错: {str(ex)}")
     
-    def _download_thread(self, links, threads, concurrent, page):
-        try:
-            # 保存链接和文件名的映射关系
-            self.download_links_map.clear()  # 清除旧的映射
-            for link in links:
-                # 从链接中提取文件名
-                filename = link.split('/')[-1].split('?')[0]
-                self.download_links_map[filename] = link
-                self.add_log(f"记录文件映射: {filename} -> {link}")
-            # 反向映射，便于完成时查找
-            self.filename_to_link = {filename: link for filename, link in self.download_links_map.items()}
-
-            print("开始下载...")  # 调试输出
+    def enqueue_downloads(self, links, threads, concurrent, page, shards=1, ranges=(), resume=False):
+        """将链接追加到下载队列
+        Args:
+            links: 下载链接列表
+            threads: 每个任务的线程数
+            concurrent: 并发任务数（多任务模式下为每个tdl进程同时下载的文件数）
+            page: 当前页面
+            shards: 分片进程数，大于1时将链接均分给多个tdl进程同时下载
+            ranges: 消息范围列表（LinkRange），在队列中按块展开，不会一次性生成全部链接
+            resume: 是否续传下载目录中已有的临时文件
+        """
+        self.download_page = page
+        new_round = self.download_queue.is_idle()
+        if new_round:
+            # 新一轮下载，清除旧的映射和状态
+            self.link_index.clear()
+            self.download_bytes.reset()
+            self.download_runner.reset()
+            self.download_queue.reset_stats()
+            self.reset_download_status()
             self.add_log(f"下载保存目录: {self.downloads_dir}")
-            self.add_log(f"下载线程数: {threads}, 并发任务数: {concurrent}")
-            
-            # 创建批处理文件内容
-            batch_content = "@echo off\n"
-            batch_content += "chcp 65001\n"  # 设置CMD编码为UTF-8
-            batch_content += "set PYTHONIOENCODING=utf-8\n"  # 设置Python输出编码
-            
-            # 添加环境变量设置命令
-            for var_name, var_value in self.env_vars.items():
-                batch_content += f"set {var_name}={var_value}\n"
-            
-            # 添加下载命令
-            total_links = len(links)
-            
-            if self.enable_multi_task:
-                # 多任务模式：将所有链接合并到一个命令中
-                dl_cmd = f"tdl.exe dl -t {threads} -l {concurrent}"
-                for link in links:
-                    dl_cmd += f" -u {link}"
-                batch_content += f"{dl_cmd}\n"
-            else:
-                # 单任务模式：每个链接一个命令
-                for link in links:
-                    dl_cmd = f"tdl.exe dl -u {link}"
-                    batch_content += f"{dl_cmd}\n"
-            
-            self.add_log(f"添加下载命令: {dl_cmd}")
-            
-            # 创建临时批处理文件
-            batch_file = os.path.join(self.base_path, "tdl_download.bat")
-            with open(batch_file, "w", encoding="utf-8") as f:
-                f.write(batch_content)
-            
-            self.add_log(f"已创建批处理文件: {batch_file}")
-            
-            # 执行批处理文件
-            startupinfo = None
-            if os.name == 'nt':
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            
-            # 设置环境变量
-            env = os.environ.copy()
-            env['PYTHONIOENCODING'] = 'utf-8'
-            if os.name == 'nt':
-                env['PYTHONLEGACYWINDOWSSTDIO'] = '1'  # 修复Windows下的编码问题
-            
-            process = subprocess.Popen(
-                batch_file,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                bufsize=1,
-                universal_newlines=False,  # 改为False以手动处理编码
-                shell=True,
-                startupinfo=startupinfo,
-                env=env
+        
+        # 保存链接和文件名的映射关系，按会话ID/消息ID建立索引
+        for link in links:
+            filename = self.link_index.add(link)
+            self.add_log(f"记录文件映射: {filename} -> {link}")
+        
+        self.add_log(f"下载线程数: {threads}, 并发任务数: {concurrent}")
+        shard_mode = self.enable_multi_task and shards > 1
+        if shard_mode:
+            self.add_log(f"分片模式: {shards} 个tdl进程同时下载，每个进程并发 {concurrent} 个文件")
+        # 多任务模式由tdl自己按 -l 并发下载，单任务模式一次只下载一个文件
+        limit = concurrent if self.enable_multi_task else 1
+        self.download_queue.add(links, threads=threads, limit=limit, resume=resume)
+        self.manifest.record(links, JOB_PENDING)
+        self.range_sources = [source for source in self.range_sources if source.remainder]
+        for link_range in ranges:
+            self.link_index.add_range(link_range)
+            # 范围本身立即写入下载清单，其中的链接展开时才逐块写入
+            source = RangeProgress(self.manifest, link_range)
+            self.range_sources.append(source)
+            self.download_queue.add_source(
+                link_range, len(link_range), threads=threads, limit=limit,
+                on_expand=source.expanded, resume=resume, on_discard=source.discard
             )
-            
-            # 将进程添加到列表中
-            self.running_processes.append(process)
-            
-            # 初始化变量
-            current_task = None
-            self.finished_files = set()
-            self.started_files = set()
-            
-            # 正则表达式模式
-            start_pattern = re.compile(rb'Downloading\s+(.+?)\s+to\s+')
-            done_pattern = re.compile(rb'(.+?)\s*->\s*.+?\s*done!')
-            # 添加系统信息匹配模式
-            system_info_pattern = re.compile(rb'CPU: \d+\.\d+% Memory: \d+\.\d+ MB Goroutines: \d+')
-            # 添加控制字符匹配模式
-            control_chars_pattern = re.compile(rb'\x1b\[[0-9;]*[a-zA-Z]|\[A\[K')
-            # 添加进度匹配模式
-            progress_pattern = re.compile(rb'(\d+(?:\.\d+)?)%')
-            speed_pattern = re.compile(rb'(\d+(?:\.\d+)?)\s*([KMGT]?B)/s')
-            
-            def decode_bytes(b):
-                """解码字节流，优先utf-8，再gbk，最后fallback"""
-                try:
-                    b = control_chars_pattern.sub(b'', b)
-                    # 先尝试utf-8
-                    try:
-                        return b.decode('utf-8')
-                    except UnicodeDecodeError:
-                        pass
-                    # 再尝试gbk
-                    try:
-                        return b.decode('gbk')
-                    except UnicodeDecodeError:
-                        pass
-                    # 最后用系统默认
-                    try:
-                        return b.decode(locale.getpreferredencoding())
-                    except UnicodeDecodeError:
-                        pass
-                    # fallback
-                    return b.decode('utf-8', errors='replace')
-                except Exception as e:
-                    print(f"解码错误: {str(e)}")
-                    return b.decode('utf-8', errors='replace')
-            
-            # 初始化下载状态
-            self.reset_download_status()
-            total_links = len(links)
-            self.total_tasks = total_links
-            self.completed_tasks = 0
-            
-            # 新增多任务正则
-            multi_task_progress_pattern = re.compile(rb'(?:Total:)?\s*(\d+(?:\.\d+)?)%')
-            multi_task_speed_pattern = re.compile(rb'(\d+(?:\.\d+)?)\s*([KMGT]?B)/s')
-            while True:
-                try:
-                    line = process.stdout.readline()
-                    if not line and process.poll() is not None:
-                        break
-                    
-                    if line:
-                        # 处理编码问题
-                        line = line.rstrip(b'\r\n')  # 使用二进制模式处理换行符
-                        
-                        if line:
-                            # 跳过系统信息
-                            if system_info_pattern.search(line):
-                                continue
-                            
-                            # 检测新任务开始
-                            start_match = start_pattern.search(line)
-                            if start_match:
-                                filename_bytes = start_match.group(1)
-                                # 尝试解码文件名
-                                current_task = decode_bytes(filename_bytes)
-                                # 移除可能的控制字符
-                                current_task = re.sub(r'\x1b\[[0-9;]*[a-zA-Z]|\[A\[K', '', current_task)
-                                # 尝试找到对应链接
-                                matched_link = None
-                                for fname, link in self.download_links_map.items():
-                                    if fname in current_task:
-                                        matched_link = link
-                                        break
-                                if matched_link:
-                                    self.add_log(f"→ 开始下载: {current_task} ({matched_link})")
-                                else:
-                                    self.add_log(f"→ 开始下载: {current_task}")
-                                last_reported_task = current_task
-                                continue
-                            
-                            # 检测任务完成
-                            done_match = done_pattern.search(line)
-                            if done_match:
-                                filename_bytes = done_match.group(1)
-                                # 尝试解码文件名
-                                filename = decode_bytes(filename_bytes)
-                                # 移除可能的控制字符
-                                filename = re.sub(r'\x1b\[[0-9;]*[a-zA-Z]|\[A\[K', '', filename)
-                                self.finished_files.add(filename)
-                                # 尝试找到对应链接
-                                matched_link = None
-                                for fname, link in self.download_links_map.items():
-                                    if fname in filename or filename in fname:
-                                        matched_link = link
-                                        break
-                                if matched_link:
-                                    self.add_log(f"√ 完成下载: {filename} ({matched_link})")
-                                else:
-                                    self.add_log(f"√ 完成下载: {filename}")
-                                self.completed_tasks += 1
-                                if current_task == filename:
-                                    current_task = None
-                                # 更新总进度
-                                total_progress = (self.completed_tasks / self.total_tasks) * 100
-                                self.update_download_progress(progress=total_progress)
-                                continue
-                            
-                            # 检测进度和速度
-                            progress_match = progress_pattern.search(line)
-                            speed_match = speed_pattern.search(line)
-                            
-                            # 只更新进度条和速度，不再add_log进度和速度日志
-                            if self.enable_multi_task:
-                                bar_speed_pattern = re.compile(rb'\[(#+)([\. ]+)\]\s*\[(\d+)s;\s*([\d\.]+)\s*([KMGT]?B)/s\]', re.I)
-                                match = bar_speed_pattern.search(line)
-                                if match:
-                                    bar_count = len(match.group(1))
-                                    total_count = bar_count + len(match.group(2))
-                                    progress = (bar_count / total_count) * 100 if total_count > 0 else 0
-                                    speed_value = float(match.group(4).decode('ascii'))
-                                    speed_unit = match.group(5).decode('ascii').upper()
-                                    multiplier = {
-                                        'B': 1,
-                                        'KB': 1024,
-                                        'MB': 1024 * 1024,
-                                        'GB': 1024 * 1024 * 1024,
-                                        'TB': 1024 * 1024 * 1024 * 1024
-                                    }.get(speed_unit, 1)
-                                    speed_in_bytes = speed_value * multiplier
-                                    speed = self._format_speed(speed_in_bytes)
-                                    self.update_download_progress(progress=progress, speed=speed)
-                                    self.update_network_speed(speed_in_bytes, True)
-                                    # 检查是否有新任务需要输出开始日志
-                                    for fname in self.download_links_map:
-                                        if fname not in self.started_files and fname not in self.finished_files:
-                                            self.add_log(f"→ 开始下载: {fname} ({self.download_links_map.get(fname, '')})")
-                                            self.started_files.add(fname)
-                                            current_task = fname
-                                            break
-                                    continue  # 不再add_log
-                            else:
-                                if progress_match or speed_match:
-                                    progress = None
-                                    speed = None
-                                    if progress_match:
-                                        current_progress = float(progress_match.group(1))
-                                        completed_progress = (self.completed_tasks / self.total_tasks) * 100
-                                        current_contribution = (current_progress / 100) * (100 / self.total_tasks)
-                                        total_progress = completed_progress + current_contribution
-                                        progress = total_progress
-                                    if speed_match:
-                                        speed_value = float(speed_match.group(1).decode('ascii'))
-                                        speed_unit = speed_match.group(2).decode('ascii')
-                                        unit = speed_unit.upper()
-                                        multiplier = {
-                                            'B': 1,
-                                            'KB': 1024,
-                                            'MB': 1024 * 1024,
-                                            'GB': 1024 * 1024 * 1024,
-                                            'TB': 1024 * 1024 * 1024 * 1024
-                                        }.get(unit, 1)
-                                        speed_in_bytes = speed_value * multiplier
-                                        self.update_network_speed(speed_in_bytes, True)
-                                        speed = self._format_speed(speed_in_bytes)
-                                    self.update_download_progress(
-                                        progress=progress,
-                                        speed=speed
-                                    )
-                                    # 检查是否有新任务需要输出开始日志
-                                    for fname in self.download_links_map:
-                                        if fname not in self.started_files and fname not in self.finished_files:
-                                            self.add_log(f"→ 开始下载: {fname} ({self.download_links_map.get(fname, '')})")
-                                            self.started_files.add(fname)
-                                            current_task = fname
-                                            break
-                                    continue  # 不再add_log
-                            # 其它日志依旧保留
-                            # decoded_line = decode_bytes(line)
-                            # decoded_line = re.sub(r'\x1b\[[0-9;]*[a-zA-Z]|\[A\[K', '', decoded_line)
-                            # if current_task and decoded_line:
-                            #     if '%' in decoded_line:
-                            #         self.add_log(f"  [{current_task}] {decoded_line}")
-                            #     else:
-                            #         self.add_log(f"  {decoded_line}")
-                            # elif decoded_line:
-                            #     self.add_log(decoded_line)
-                except Exception as e:
-                    self.add_log(f"[日志解析错误: {str(e)}]")
-                    print(f"Debug - 日志解析错误: {str(e)}")
-            
-            # 删除临时批处理文件
-            try:
-                os.remove(batch_file)
-                self.add_log("已删除临时批处理文件")
-            except:
-                self.add_log("无法删除临时批处理文件")
-            
-            # 检查临时文件
-            self.check_temp_files()
-            
-            return_code = process.poll()
-            if return_code == 0:
+            self.add_log(f"已加入消息范围: {link_range.link(link_range.start)} - {link_range.end}，共 {len(link_range)} 条消息")
+        self.last_download_settings = (threads, concurrent, shards)
+        self.add_log(f"已加入下载队列: {len(links)} 个链接，当前等待 {self.download_queue.pending_count()} 个")
+        
+        # 单任务模式每个链接启动一个tdl进程，依次下载；
+        # 多任务模式把链接成批交给一个tdl进程，分片模式按分片数同时启动多个进程
+        slots = shards if shard_mode else 1
+        if self.download_scheduler is None:
+            self.download_scheduler = DownloadScheduler(
+                self.download_queue,
+                runner=self._run_download_job,
+                on_idle=self._on_download_queue_idle,
+                on_change=self.refresh_queue_view,
+                slots=slots
+            )
+        if self.enable_multi_task:
+            # 多任务模式只有一个进程时不重试，与一次性调用tdl时的行为一致
+            self.download_scheduler.set_slots(slots, shard=True, max_retries=None if shard_mode else 0)
+        else:
+            self.download_scheduler.set_slots(slots)
+        self.refresh_queue_view()
+        self._update_total_download_progress()
+    
+    def _run_download_job(self, jobs):
+        """在调度器槽位中执行一组下载任务
+        Args:
+            jobs: 本次领取的任务列表
+        Returns:
+            tdl 进程的返回码
+        """
+        return self.download_runner.run(jobs, self.tdl_path, self.downloads_dir, tdl_environment(self.env_vars))
+    
+    def _on_download_queue_idle(self):
+        """下载队列全部完成后的收尾处理"""
+        try:
+            page = self.download_page
+            
+            # 检查临时文件（在维护服务的后台线程中进行，不占用下载槽位）
+            self.maintenance.submit("检查临时文件", self.check_temp_files)
+            # 校验本轮完成的文件，哈希由共用的进程池并行计算，整轮只写一份校验记录
+            with self._job_lock:
+                completed, self.completed_downloads = self.completed_downloads, []
+            if completed:
+                self.maintenance.submit("校验下载文件", self._verify_downloaded_files, completed)
+            
+            failed = self.download_queue.total_failed
+            if failed == 0:
                 self.add_log("所有链接下载成功!")
-                self.show_snackbar(page, "下载完成！")
+                if page:
+                    self.show_snackbar(page, "下载完成！")
             else:
-                self.add_log(f"下载过程中出现错误，返回码: {return_code}")
-                self.show_snackbar(page, f"下载出现错误，返回码: {return_code}")
-            
-            # 从列表中移除已完成的进程
-            if process in self.running_processes:
-                self.running_processes.remove(process)
+                self.add_log(f"下载过程中出现错误，失败任务数: {failed}")
+                if page:
+                    self.show_snackbar(page, f"下载出现错误，失败任务数: {failed}")
             
             # 完成所有下载，重置状态
             self.reset_download_status()
-            self.download_speed_text.value = "0 B/s"
-            self.total_progress_bar.value = 0
-            self.total_progress_text.value = "0%"
-            self.download_speed_text.update()
-            self.total_progress_bar.update()
-            self.total_progress_text.update()
             
             self.add_log("所有下载任务已完成")
             self.add_log(f"下载文件保存在: {self.downloads_dir}")
             self.add_log("您可以点击「打开下载文件夹」按钮查看下载的文件")
-                
         except Exception as e:
             self.add_log(f"发生错误: {str(e)}")
-            self.show_snackbar(page, f"发生错误: {str(e)}")
             print(f"Debug - 发生错误: {str(e)}")
-        finally:
-            try:
-                # 尝试在标签页内容中查找下载按钮
-                download_button = None
-                for control in page.controls:
-                    if isinstance(control, ft.Container):
-                        content_column = control.content
-                        if isinstance(content_column, ft.Column):
-                            main_content = content_column.controls[1]  # 获取主要内容区域
-                            if isinstance(main_content, ft.Container):
-                                stack = main_content.content.content  # 获取Stack控件
-                                if isinstance(stack, ft.Stack):
-                                    download_tab = stack.controls[0]  # 获取下载标签页
-                                    if download_tab.visible:  # 确保是当前可见的标签页
-                                        left_panel = download_tab.content.content.controls[0]  # 获取左侧面板
-                                        download_card = left_panel.content.controls[1]  # 获取下载设置卡片
-                                        download_button = download_card.content.content.controls[5].controls[0]  # 获取下载按钮
-                                        break
-                
-                if download_button:
-                    download_button.disabled = False
-                    download_button.update()
-                else:
-                    print("无法找到下载按钮")
-            except Exception as e:
-                print(f"重新启用下载按钮时出错: {str(e)}")
+    
+    def _update_total_download_progress(self):
+        """合并队列完成数和各槽位的当前进度，更新总体进度和速度"""
+        total = self.download_queue.total_added
+        finished = self.download_queue.total_finished
+        with self._job_lock:
+            running_progress = sum(self._job_progress.values())
+            speed_in_bytes = sum(self._job_speed.values())
+        self.total_tasks = total
+        self.completed_tasks = finished
+        if total > 0:
+            # 有文件大小信息时按字节计算进度，否则按任务数计算
+            self.download_bytes.set_count(total)
+            fraction = self.download_bytes.fraction()
+            if fraction is not None:
+                total_progress = fraction * 100
+            else:
+                total_progress = min(100, (finished + running_progress) / total * 100)
+            self.update_download_progress(progress=total_progress, eta=self.download_bytes.eta())
+        self.update_network_speed(speed_in_bytes, True)
+    
+    def refresh_queue_view(self):
+        """标记下载队列显示需要刷新，在下一帧统一重建（可在任意线程调用）"""
+        self._queue_view_dirty = True
+    
+    def _render_queue_view(self):
+        """重建下载队列显示（每帧刷新前调用）"""
+        if not self._queue_view_dirty or getattr(self, 'tasks_container', None) is None:
+            return
+        self._queue_view_dirty = False
+        try:
+            queue_text_style = ft.TextStyle(
+                size=13,
+                weight=ft.FontWeight.W_400,
+                color=ft.Colors.GREY_800
+            )
+            rows = []
+            for job in self.download_queue.running():
+                rows.append(ft.Row(
+                    [
+                        ft.Icon(ft.Icons.DOWNLOADING_ROUNDED, color=ft.Colors.GREEN_400, size=16),
+                        ft.Text(job.link, style=queue_text_style, expand=True, no_wrap=True,
+                                overflow=ft.TextOverflow.ELLIPSIS),
+                        ft.Text("下载中", style=queue_text_style, color=ft.Colors.GREEN_700),
+                    ],
+                    spacing=5
+                ))
+            pending = self.download_queue.pending()
+            max_rows = 100  # 只显示前100个等待中的任务
+            for job in pending[:max_rows]:
+                rows.append(ft.Row(
+                    [
+                        ft.Icon(ft.Icons.SCHEDULE_ROUNDED, color=ft.Colors.GREY_500, size=16),
+                        ft.Text(job.link, style=queue_text_style, expand=True, no_wrap=True,
+                                overflow=ft.TextOverflow.ELLIPSIS),
+                        ft.IconButton(ft.Icons.ARROW_UPWARD_ROUNDED, icon_size=16, tooltip="上移",
+                                      on_click=lambda e, job_id=job.job_id: self.move_queued_job(job_id, -1)),
+                        ft.IconButton(ft.Icons.ARROW_DOWNWARD_ROUNDED, icon_size=16, tooltip="下移",
+                                      on_click=lambda e, job_id=job.job_id: self.move_queued_job(job_id, 1)),
+                        ft.IconButton(ft.Icons.CLOSE_ROUNDED, icon_size=16, tooltip="移除",
+                                      on_click=lambda e, job_id=job.job_id: self.remove_queued_job(job_id)),
+                    ],
+                    spacing=0
+                ))
+            if len(pending) > max_rows:
+                rows.append(ft.Text(f"… 还有 {len(pending) - max_rows} 个等待中的任务", style=queue_text_style))
+            unexpanded = self.download_queue.unexpanded_count()
+            if unexpanded:
+                rows.append(ft.Text(f"… 消息范围中还有 {unexpanded} 条消息待展开", style=queue_text_style))
+            if not rows:
+                rows.append(ft.Text("队列为空", style=queue_text_style, color=ft.Colors.GREY_600))
+            self.renderer.set(self.tasks_container.content, controls=rows)
+        except Exception as e:
+            print(f"刷新下载队列时出错: {str(e)}")
+    
+    def move_queued_job(self, job_id, offset):
+        """调整等待中任务的顺序"""
+        if self.download_queue.move(job_id, offset):
+            self.refresh_queue_view()
+    
+    def remove_queued_job(self, job_id):
+        """从队列中移除等待中的任务"""
+        job = self.download_queue.remove(job_id)
+        if job is not None:
+            self.manifest.record([job.link], JOB_REMOVED)
+            self.add_log(f"已从队列移除任务 #{job_id}")
+            self.refresh_queue_view()
+            self._update_total_download_progress()
+    
+    def clear_download_queue(self, e=None):
+        """清空所有等待中的任务"""
+        jobs = self.download_queue.clear_pending()
+        self.manifest.record([job.link for job in jobs], JOB_REMOVED)
+        self.add_log(f"已清空等待队列，移除 {len(jobs)} 个任务")
+        self.refresh_queue_view()
+        self._update_total_download_progress()
+    
+    def resume_unfinished_downloads(self, e=None):
+        """把下载清单中未完成的链接重新加入队列，已完成和已在队列中的链接会被跳过"""
+        queued = {job.link for job in self.download_queue.pending() + self.download_queue.running()}
+        queued.update(source.remainder for source in self.range_sources if source.remainder)
+        # 清单中既有单个链接，也有尚未展开的消息范围
+        links, ranges, _, _ = normalize_links(
+            [link for link in self.manifest.unfinished() if link not in queued], exclude=queued
+        )
+        page = e.page if e is not None else self.download_page
+        if not links and not ranges:
+            self.add_log("下载清单中没有需要恢复的链接")
+            if page:
+                self.show_snackbar(page, "没有需要恢复的链接")
+            return
+        self.add_log(f"从下载清单恢复 {len(links)} 个未完成的链接")
+        if ranges:
+            self.add_log(f"以及 {len(ranges)} 个尚未展开完的消息范围，共 {sum(len(r) for r in ranges)} 条消息")
+        partial = sum(1 for link in links if link in self.partial_files)
+        if partial:
+            self.add_log(f"其中 {partial} 个链接已有未完成的临时文件，将从中断处续传")
+        threads, concurrent, shards = self.last_download_settings
+        self.enqueue_downloads(links, threads, concurrent, page, shards, ranges=ranges, resume=True)
 
     def check_temp_files(self):
-        """检查并处理临时文件"""
+        """检查并处理临时文件（在维护服务的后台线程中执行）
+
+        只有 tdl 输出过完成行、且大小与完成行一致的临时文件才改为正式文件名，
+        其余的保留为临时文件，对应链接在下载清单中记为失败，恢复任务时从中断处续传。
+        """
         try:
             self.add_log("\n开始检查临时文件...")
-            temp_files = [f for f in os.listdir(self.downloads_dir) if f.endswith('.tmp')]
             
-            if not temp_files:
+            def restore(entry):
+                # 队列中有新的下载开始时，临时文件可能正在写入，不再处理，留到这一轮下载结束后再检查
+                if not self.download_queue.is_idle():
+                    return entry.name, None, None, "deferred", None
+                # scandir 条目缓存的 stat 结果，Windows 上不需要额外的系统调用
+                file_size = entry.stat().st_size
+                if file_size <= 0:
+                    return entry.name, file_size, None, "empty", None
+                # 获取不带.tmp的文件名，查找对应的下载链接
+                original_filename = entry.name[:-4]
+                link = self.link_index.lookup(original_filename)
+                if link is None or not self.download_runner.is_complete(link, file_size):
+                    return entry.name, file_size, link, "partial", None
+                try:
+                    os.rename(entry.path, os.path.join(self.downloads_dir, original_filename))
+                except Exception as e:
+                    return entry.name, file_size, link, "error", str(e)
+                return entry.name, file_size, link, "restored", None
+            
+            processed, results, stopped = self.maintenance.process(
+                self.downloads_dir, restore, suffix='.tmp',
+                on_progress=self._maintenance_progress("检查临时文件"),
+                should_stop=lambda: not self.download_queue.is_idle()
+            )
+            
+            if not processed:
                 self.add_log("未发现临时文件")
                 return
             
-            self.add_log(f"发现 {len(temp_files)} 个临时文件，开始处理...")
+            self.add_log(f"发现 {processed} 个临时文件，处理结果如下:")
             
             # 创建结果记录文件
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -1933,50 +2362,65 @@ class TDLDownloaderApp:
             # 用于记录处理结果的列表
             process_results = []
             process_results.append(f"临时文件处理记录 - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            process_results.append(f"发现 {len(temp_files)} 个临时文件\n")
-            
-            for temp_file in temp_files:
-                temp_path = os.path.join(self.downloads_dir, temp_file)
-                file_size = os.path.getsize(temp_path)
-                
-                if file_size > 0:
-                    try:
-                        # 获取不带.tmp的文件名
-                        original_filename = temp_file[:-4]  # 移除.tmp后缀
-                        new_path = os.path.join(self.downloads_dir, original_filename)
-                        
-                        # 重命名文件
-                        os.rename(temp_path, new_path)
-                        
-                        # 查找并记录对应的下载链接
-                        original_link = None
-                        for filename, link in self.download_links_map.items():
-                            if filename in original_filename:  # 使用in而不是完全匹配，因为文件名可能有额外的数字等
-                                original_link = link
-                                break
-                        
-                        # 记录处理结果
-                        result_entry = f"文件: {temp_file} -> {original_filename}"
-                        if original_link:
-                            result_entry += f"\n下载链接: {original_link}"
-                            self.add_log(f"已恢复临时文件: {temp_file} -> {original_filename}")
-                            self.add_log(f"对应的下载链接: {original_link}")
-                        else:
-                            result_entry += "\n下载链接: 未找到对应链接"
-                            self.add_log(f"已恢复临时文件: {temp_file} -> {original_filename}")
-                            self.add_log("无法找到对应的下载链接")
-                        
-                        result_entry += f"\n文件大小: {self._format_file_size(file_size)}\n"
-                        process_results.append(result_entry)
-                        
-                    except Exception as e:
-                        error_msg = f"处理临时文件 {temp_file} 时出错: {str(e)}"
-                        self.add_log(error_msg)
-                        process_results.append(f"错误: {error_msg}\n")
-                else:
+            process_results.append(f"发现 {processed} 个临时文件\n")
+            
+            # 文件很多时只在日志中逐个列出前面的文件，完整结果见记录文件
+            shown = 0
+            partial_links = []
+            deferred = 0
+            for temp_file, file_size, link, status, error in results:
+                if status == "deferred":
+                    deferred += 1
+                    process_results.append(f"暂不处理（有新的下载正在进行）: {temp_file}\n")
+                    continue
+                show = shown < 50
+                shown += 1
+                if status == "empty":
                     skip_msg = f"跳过空临时文件: {temp_file}"
-                    self.add_log(skip_msg)
+                    if show:
+                        self.add_log(skip_msg)
                     process_results.append(f"{skip_msg}\n")
+                    continue
+                if status == "error":
+                    error_msg = f"处理临时文件 {temp_file} 时出错: {error}"
+                    self.add_log(error_msg)
+                    process_results.append(f"错误: {error_msg}\n")
+                    continue
+                link_text = link or "未找到对应链接"
+                if status == "partial":
+                    expected = self.download_bytes.expected_size(link) if link else None
+                    size_text = self._format_file_size(file_size)
+                    if expected:
+                        size_text += f" / {self._format_file_size(expected)}"
+                    if show:
+                        self.add_log(f"保留未完成的临时文件: {temp_file} ({size_text})")
+                    process_results.append(
+                        f"保留未完成的临时文件: {temp_file}\n下载链接: {link_text}\n已下载: {size_text}\n"
+                    )
+                    if link is not None:
+                        partial_links.append(link)
+                        self.partial_files[link] = (temp_file, file_size)
+                    continue
+                
+                original_filename = temp_file[:-4]
+                self.partial_files.pop(link, None)
+                if show:
+                    self.add_log(f"已恢复临时文件: {temp_file} -> {original_filename}")
+                    self.add_log(f"对应的下载链接: {link_text}")
+                process_results.append(
+                    f"文件: {temp_file} -> {original_filename}\n下载链接: {link_text}\n"
+                    f"文件大小: {self._format_file_size(file_size)}\n"
+                )
+            if shown > 50:
+                self.add_log(f"其余 {shown - 50} 个临时文件的处理结果见记录文件")
+            if partial_links:
+                # 进程正常退出时清单中已记为完成，改为失败以便恢复任务时续传
+                self.manifest.record(partial_links, JOB_FAILED)
+                self.add_log(f"{len(partial_links)} 个文件未下载完整，已保留临时文件，点击「恢复未完成任务」可从中断处续传")
+            if deferred:
+                self.add_log(f"有新的下载正在进行，{deferred} 个临时文件暂不处理，将在这一轮下载结束后再检查")
+            if stopped:
+                self.add_log("有新的下载任务开始，停止处理剩余临时文件")
             
             # 写入处理结果到文件
             try:
@@ -1991,6 +2435,89 @@ class TDLDownloaderApp:
         except Exception as e:
             self.add_log(f"检查临时文件时出错: {str(e)}")
     
+    def _verify_downloaded_files(self, completed_files):
+        """校验一轮下载完成的文件，并把结果写入下载目录中的记录文件（在维护服务的后台线程中执行）
+        Args:
+            completed_files: [(tdl 输出的路径, tdl 记录的大小, 链接), ...]
+        """
+        items = []
+        for path, expected, link in completed_files:
+            # tdl 输出的可能是相对路径，找不到时按文件名在下载目录中查找
+            if not os.path.exists(path):
+                candidate = os.path.join(self.downloads_dir, os.path.basename(path.replace("\\", "/")))
+                if os.path.exists(candidate):
+                    path = candidate
+            items.append((path, expected, link))
+        self.add_log(f"开始校验本轮下载的 {len(items)} 个文件...")
+        results = verify_files(items, algorithm=self.verify_algorithm)
+        
+        counts = summarize(results)
+        failed = [result for result in results if result["status"] not in (VERIFY_OK, VERIFY_UNKNOWN_SIZE)]
+        for result in failed[:20]:
+            self.add_log(f"× 校验未通过: {os.path.basename(result['path'])} ({STATUS_TEXT[result['status']]})")
+        failed_links = [result["info"] for result in failed if result["info"]]
+        if failed_links:
+            # 校验未通过的链接记为失败，恢复任务时重新下载
+            self.manifest.record(failed_links, JOB_FAILED)
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        report_file = os.path.join(self.downloads_dir, f"verify_{timestamp}.txt")
+        try:
+            write_report(report_file, results, algorithm=self.verify_algorithm or "",
+                         format_size=self._format_file_size)
+        except Exception as e:
+            self.add_log(f"保存校验结果到文件时出错: {str(e)}")
+            report_file = None
+        summary = f"校验完成: 通过 {counts.get(VERIFY_OK, 0)} 个，未通过 {len(failed)} 个"
+        if counts.get(VERIFY_UNKNOWN_SIZE):
+            summary += f"，没有记录大小 {counts[VERIFY_UNKNOWN_SIZE]} 个"
+        self.add_log(summary)
+        if report_file:
+            self.add_log(f"校验结果已保存到文件: {report_file}")
+    
+    def _maintenance_progress(self, action):
+        """返回维护任务的进度回调，每两秒最多输出一次进度日志"""
+        last_report = [time.monotonic()]
+        
+        def report(processed):
+            now = time.monotonic()
+            if now - last_report[0] >= 2:
+                last_report[0] = now
+                self.add_log(f"{action}: 已处理 {processed} 个临时文件")
+        return report
+    
+    def _scan_partial_files(self):
+        """找出上次运行留下的 .tmp 文件对应的未完成链接（在维护服务的后台线程中执行）"""
+        unfinished = LinkIndex(self.manifest.unfinished())
+        
+        def inspect(entry):
+            size = entry.stat().st_size
+            if size <= 0:
+                return None
+            return entry.name, size, unfinished.lookup(entry.name[:-4])
+        
+        try:
+            processed, results, _ = self.maintenance.process(
+                self.downloads_dir, inspect, suffix='.tmp',
+                on_progress=self._maintenance_progress("扫描未完成的临时文件")
+            )
+        except Exception as e:
+            self.add_log(f"扫描下载目录中的临时文件时出错: {e}")
+            return
+        if not results:
+            return
+        matched = 0
+        for name, size, link in results:
+            if link is not None:
+                self.partial_files[link] = (name, size)
+                matched += 1
+        total_size = sum(size for _, size, _ in results)
+        self.add_log(f"下载目录中保留了 {len(results)} 个未完成的临时文件（共 {self._format_file_size(total_size)}）")
+        if matched:
+            self.add_log(f"其中 {matched} 个对应下载清单中未完成的链接，点击「恢复未完成任务」将从中断处续传")
+        if len(results) > matched:
+            self.add_log(f"{len(results) - matched} 个临时文件没有找到对应的链接，已保留未做处理")
+    
     def _format_file_size(self, size_in_bytes):
         """格式化文件大小显示"""
         for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
@@ -1999,6 +2526,21 @@ class TDLDownloaderApp:
             size_in_bytes /= 1024.0
         return f"{size_in_bytes:.2f} PB"
 
+    def _format_eta(self, seconds):
+        """格式化剩余时间显示"""
+        seconds = int(seconds)
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        if hours:
+            return f"{hours}:{minutes:02d}:{seconds:02d}"
+        return f"{minutes:02d}:{seconds:02d}"
+
+    def _format_progress(self, progress, eta=None):
+        """格式化总体进度，速度已知时附带剩余时间"""
+        if eta is None or progress >= 100:
+            return f"{progress:.1f}%"
+        return f"{progress:.1f}%  剩余 {self._format_eta(eta)}"
+
     def _format_speed(self, speed_in_bytes):
         """格式化网络速度显示
         Args:
@@ -2015,6 +2557,49 @@ class TDLDownloaderApp:
         else:
             return f"{speed_in_bytes/(1024*1024*1024):.2f} GB/s"
 
+    def _register_metrics(self):
+        """注册运行指标，数据直接取自下载、上传过程中已经维护的状态"""
+        def directions(download, upload):
+            return {(("direction", "download"),): download(), (("direction", "upload"),): upload()}
+        self.metrics.register(
+            "transferred_bytes", "gauge", "本轮下载或上传已传输的字节数",
+            lambda: directions(lambda: self.download_bytes.done_bytes, lambda: self.upload_bytes.done_bytes)
+        )
+        self.metrics.register(
+            "files_completed_total", "counter", "已完成的文件数",
+            lambda: directions(lambda: self.files_completed["download"], lambda: self.files_completed["upload"])
+        )
+        self.metrics.register(
+            "speed_bytes_per_second", "gauge", "当前总速度（字节每秒）",
+            lambda: directions(lambda: self.download_throughput.current, lambda: self.upload_throughput.current)
+        )
+        self.metrics.register("active_processes", "gauge", "正在运行的 tdl 进程数", lambda: len(self.running_processes))
+        self.metrics.register("queue_pending", "gauge", "下载队列中等待的链接数", self.download_queue.pending_count)
+        self.metrics.register("queue_running", "gauge", "正在下载的链接数", lambda: len(self.download_queue.running()))
+
+        def job_speeds():
+            with self._job_lock:
+                return {(("job", str(key)),): speed for key, speed in self._job_speed.items()}
+        self.metrics.register("job_speed_bytes_per_second", "gauge", "每个下载进程的速度（字节每秒）", job_speeds)
+        self.metrics.register(
+            "stalled_files", "gauge", "超过停滞时间没有进度的文件数",
+            lambda: sum(1 for task in self.progress_board.snapshot() if self.progress_board.is_stalled(task))
+        )
+        self.metrics.register(
+            "parsed_lines_total", "counter", "已解析的 tdl 输出行数",
+            lambda: directions(lambda: self.download_lines.total, lambda: self.upload_lines.total)
+        )
+        self.metrics.register(
+            "parsed_lines_per_second", "gauge", "最近几秒每秒解析的 tdl 输出行数",
+            lambda: directions(self.download_lines.rate, self.upload_lines.rate)
+        )
+        self.metrics.register(
+            "ui_flush_seconds", "gauge", "最近一次界面刷新的耗时（秒）", lambda: self.renderer.last_flush_duration
+        )
+        self.metrics.register(
+            "ui_flush_controls", "gauge", "最近一次界面刷新的控件数", lambda: self.renderer.last_flush_count
+        )
+
     def update_network_speed(self, speed_in_bytes, is_download=True):
         """更新网络速度显示
         Args:
@@ -2024,19 +2609,18 @@ class TDLDownloaderApp:
         try:
             formatted_speed = self._format_speed(speed_in_bytes)
             if is_download:
+                self.download_throughput.record(speed_in_bytes)
                 self.current_download_speed = formatted_speed
-                if self.download_speed_text:
-                    self.download_speed_text.value = formatted_speed
-                    self.download_speed_text.update()
+                self.renderer.set(self.download_speed_text, value=formatted_speed)
             else:
+                self.upload_throughput.record(speed_in_bytes)
                 self.current_upload_speed = formatted_speed
-                if self.upload_speed_text:
-                    self.upload_speed_text.value = formatted_speed
-                    self.upload_speed_text.update()
+                self.renderer.set(self.upload_speed_text, value=formatted_speed)
         except Exception as e:
             print(f"更新网络速度显示时出错: {str(e)}")
 
-    def _upload_thread(self, files, chat, threads, concurrent, as_photo, delete_after, page, enable_multi_upload=False):
+    def _upload_thread(self, files, chat, threads, concurrent, as_photo, delete_after, page, enable_multi_upload=False,
+                       skip_uploaded=True):
         try:
             last_bytes = 0
             last_time = time.time()
@@ -2044,10 +2628,31 @@ class TDLDownloaderApp:
             self.upload_complete_text.visible = False
             self.upload_complete_text.update()
             
-            total_files = len(files)
+            # 跳过已经上传到该聊天的文件，路径、大小、修改时间都没变的文件只需一次 stat
+            if skip_uploaded:
+                self.update_upload_progress(text="检查已上传的文件")
+                upload_entries, skipped = self.upload_cache.plan(
+                    [file.path for file in files], chat, hash_all=delete_after
+                )
+                for entry in skipped:
+                    self.add_upload_log(f"跳过已上传到该聊天的文件: {files[entry.index].name}")
+                if skipped:
+                    self.add_upload_log(f"共跳过 {len(skipped)} 个已上传的文件")
+                files = [files[entry.index] for entry in upload_entries]
+                if not files:
+                    self.update_upload_progress(current_value=100, total_value=100, text="上传完成")
+                    self.add_upload_log("所选文件都已上传到该聊天，没有需要上传的文件")
+                    self.upload_complete_text.value = "所选文件都已上传过，继续上传请重新选择文件"
+                    self.upload_complete_text.visible = True
+                    self.upload_complete_text.update()
+                    return
+            else:
+                # 不跳过时也记录本次上传，之后开启跳过时可以用上
+                upload_entries = [UploadFile(i, file.path) for i, file in enumerate(files)]
             
+            total_files = len(files)
             if enable_multi_upload:
-                # 多任务上传：直接使用Python subprocess调用tdl.exe
+                # 多任务上传：一个tdl进程上传所有文件
                 self.add_upload_log(f"开始多任务上传（共{total_files}个文件）")
                 
                 # 立即设置上传状态
@@ -2069,388 +2674,35 @@ class TDLDownloaderApp:
                     self.add_upload_log("上传模式: 作为照片")
                 if delete_after:
                     self.add_upload_log("上传后删除原文件")
-                
-                # 构建tdl.exe命令参数
-                cmd = ["tdl.exe", "up", "-t", str(threads), "-l", str(concurrent)]
-                
-                # 添加文件路径参数
-                for file in files:
-                    cmd.extend(["-p", file.path])
-                
-                # 添加其他参数
-                if chat:
-                    cmd.extend(["-c", chat])
-                if as_photo:
-                    cmd.append("--photo")
-                if delete_after:
-                    cmd.append("--rm")
-                
-                self.add_upload_log(f"执行命令: {' '.join(cmd)}")
-                
-                # 设置环境变量
-                env = dict(os.environ)
-                env['PYTHONIOENCODING'] = 'utf-8'
-                # 添加tdl所需的环境变量
-                for var_name, var_value in self.env_vars.items():
-                    env[var_name] = var_value
-                
-                # 设置启动信息
-                startupinfo = None
-                if os.name == 'nt':
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                
-                # 启动进程
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    bufsize=1,
-                    universal_newlines=True,
-                    encoding='utf-8',
-                    errors='replace',
-                    startupinfo=startupinfo,
-                    env=env
-                )
-                
-                # 将进程添加到列表中
-                self.running_processes.append(process)
-                
-                # 处理输出
-                current_file_index = 0
-                completed_files = 0
-                is_uploading = False
-                last_progress = 0
-                current_progress_line = None  # 当前进度输出行
-                progress_bar_width = 30  # 进度条宽度
-                
-                def make_progress_bar(progress):
-                    filled = int(progress_bar_width * progress / 100)
-                    bar = '█' * filled + '░' * (progress_bar_width - filled)
-                    return f"[{bar}] {progress:.1f}%"
-                
-                while True:
-                    line = process.stdout.readline()
-                    if not line and process.poll() is not None:
-                        break
-                    if line:
-                        try:
-                            if isinstance(line, bytes):
-                                line = line.decode('utf-8', errors='replace')
-                            line = line.strip()
-                            
-                            # 检测上传开始 - 当看到百分比信息时认为开始上传
-                            if ("%" in line and ("MB" in line or "KB" in line) and 
-                                ("ETA" in line or "MB/s" in line or "KB/s" in line) and
-                                not is_uploading):
-                                last_bytes = 0
-                                last_time = time.time()
-                                self.update_network_speed(0, False)
-                                is_uploading = True
-                                self.add_upload_log(f"正在多任务上传（共{total_files}个文件）")
-                                self.update_upload_progress(
-                                    current_value=0,
-                                    text=f"多任务上传 1/{total_files}"
-                                )
-                                total_progress = (completed_files / total_files) * 100
-                                self.update_upload_progress(total_value=total_progress)
-                                last_progress = 0
-                            
-                            # 检测上传完成
-                            elif ("完成上传" in line or 
-                                  "upload completed" in line.lower() or 
-                                  "successfully uploaded" in line.lower() or 
-                                  "upload finished" in line.lower() or
-                                  "upload done" in line.lower()):
-                                self.update_network_speed(0, False)
-                                completed_files += 1
-                                is_uploading = False
-                                self.add_upload_log(f"完成多任务上传（{completed_files}/{total_files}）")
-                                self.update_upload_progress(current_value=100)
-                                total_progress = (completed_files / total_files) * 100
-                                self.update_upload_progress(total_value=total_progress)
-                                last_progress = 100
-                            
-                            # 处理进度条和速度信息
-                            elif is_uploading:
-                                # 多任务上传时，优先使用总体进度条：[##########################.......................................] [8s; 6.54 MB/s]
-                                bar_speed_pattern = re.compile(r'^\[([#\. ]+)\]\s*\[(\d+)s;\s*([\d\.]+)\s*([KMGT]?B)/s\]$', re.I)
-                                if bar_speed_pattern.match(line):
-                                    # 解析总体进度条
-                                    bar_content = bar_speed_pattern.match(line).group(1)
-                                    time_elapsed = int(bar_speed_pattern.match(line).group(2))
-                                    speed_value = float(bar_speed_pattern.match(line).group(3))
-                                    speed_unit = bar_speed_pattern.match(line).group(4).upper()
-                                    
-                                    # 计算总体进度百分比
-                                    filled_count = bar_content.count('#')
-                                    total_count = len(bar_content)
-                                    if total_count > 0:
-                                        progress = (filled_count / total_count) * 100
-                                        self.update_upload_progress(current_value=progress)
-                                        self.update_upload_progress(total_value=progress)
-                                    
-                                    # 更新速度
-                                    multiplier = {
-                                        'B': 1,
-                                        'KB': 1024,
-                                        'MB': 1024 * 1024,
-                                        'GB': 1024 * 1024 * 1024,
-                                        'TB': 1024 * 1024 * 1024 * 1024
-                                    }.get(speed_unit, 1)
-                                    speed_in_bytes = speed_value * multiplier
-                                    self.update_network_speed(speed_in_bytes, False)
-                                    continue
-                                
-                                # 如果没有总体进度条，则使用百分比进度信息作为备选
-                                percent_match = re.search(r'(\d+\.?\d*)%', line)
-                                if percent_match:
-                                    progress = float(percent_match.group(1))
-                                    # 只有当进度变化超过1%时才更新，避免频繁闪烁
-                                    if abs(progress - last_progress) >= 1.0:
-                                        self.update_upload_progress(current_value=progress)
-                                        total_progress = ((completed_files + progress / 100) / total_files) * 100
-                                        self.update_upload_progress(total_value=total_progress)
-                                        last_progress = progress
-                                
-                                # 检测速度信息
-                                speed_match = re.search(r'([\d\.]+)\s*([KMGT]?B)/s', line, re.IGNORECASE)
-                                if speed_match:
-                                    value = float(speed_match.group(1))
-                                    unit = speed_match.group(2).upper()
-                                    multiplier = {
-                                        'B': 1,
-                                        'KB': 1024,
-                                        'MB': 1024 * 1024,
-                                        'GB': 1024 * 1024 * 1024,
-                                        'TB': 1024 * 1024 * 1024 * 1024
-                                    }.get(unit, 1)
-                                    speed_in_bytes = value * multiplier
-                                    self.update_network_speed(speed_in_bytes, False)
-                            
-                            # 过滤掉不需要显示的日志（在进度检测之后）
-                            if (line.startswith("Files count:") or 
-                                line.startswith("[.................................................]") or
-                                line.startswith("[") and "]" in line and "s" in line and not any(char in line for char in "0123456789") or
-                                # 过滤tdl.exe的详细进度输出 - 更宽泛的匹配
-                                (line.startswith("D:\\") and "%" in line and ("MB" in line or "KB" in line or "B" in line)) or
-                                # 过滤CPU和内存信息
-                                line.startswith("CPU:") or
-                                # 过滤单个文件的进度条格式：[####........] [10.00 MB in 8.1s; ~ETA: 13s; 1.23 MB/s]
-                                (line.startswith("[") and line.endswith("]") and "ETA" in line)):
-                                continue
-                            
-                            # 输出其他日志
-                            elif not line.startswith("[TDLGUI_MARKER]"):
-                                self.add_upload_log(line)
-                        except Exception as e:
-                            self.add_upload_log(f"[日志解析错误: {str(e)}]")
-                
-                return_code = process.poll()
-                if return_code == 0:
+            
+            # 单任务上传逐个文件启动tdl，按每个文件的返回码确认是否上传成功
+            self.upload_runner = UploadRunner(
+                self.event_channel, AppUploadListener(self, enable_multi_upload), self.upload_bytes,
+                processes=self.running_processes, lines=self.upload_lines
+            )
+            batch = self.upload_runner.run(
+                [file.path for file in files], self.tdl_path, tdl_environment(self.env_vars),
+                chat=chat, threads=threads, concurrent=concurrent, as_photo=as_photo, delete_after=delete_after,
+                per_file=not enable_multi_upload
+            )
+            # 只记录确认上传成功的文件
+            self.upload_cache.record_uploaded(chat, [upload_entries[i] for i in batch.succeeded])
+            succeeded = len(batch.succeeded)
+            if enable_multi_upload:
+                if batch.return_code == 0:
                     self.add_upload_log("多任务上传成功!")
                     self.show_snackbar(page, "上传完成！")
                 else:
-                    self.add_upload_log(f"多任务上传过程中出现错误，返回码: {return_code}")
-                    self.show_snackbar(page, f"上传出现错误，返回码: {return_code}")
-                
-                # 从列表中移除已完成的进程
-                if process in self.running_processes:
-                    self.running_processes.remove(process)
-                    
+                    self.add_upload_log(f"多任务上传过程中出现错误，返回码: {batch.return_code}")
+                    self.show_snackbar(page, f"上传出现错误，返回码: {batch.return_code}")
+            elif batch.return_code == 0 and succeeded == total_files:
+                self.add_upload_log("所有文件上传成功!")
+                self.show_snackbar(page, "上传完成！")
             else:
-                # 单任务上传：保持原有的批处理文件方式
-                batch_content = "@echo off\n"
-                batch_content += "chcp 65001\n"
-                batch_content += "set PYTHONIOENCODING=utf-8\n"
-                for var_name, var_value in self.env_vars.items():
-                    batch_content += f"set {var_name}={var_value}\n"
-                
-                for i, file in enumerate(files):
-                    up_cmd = f"tdl.exe up -p \"{file.path}\""
-                    if chat:
-                        up_cmd += f" -c {chat}"
-                    if as_photo:
-                        up_cmd += " --photo"
-                    if delete_after:
-                        up_cmd += " --rm"
-                    batch_content += f"echo [TDLGUI_MARKER] 开始上传 {i+1}/{total_files}: {file.name}\n"
-                    batch_content += f"{up_cmd}\n"
-                    batch_content += f"echo [TDLGUI_MARKER] 完成上传 {i+1}/{total_files}\n"
-                    self.add_upload_log(f"添加上传命令: {up_cmd}")
-                
-                # 创建临时批处理文件
-                batch_file = os.path.join(self.base_path, "tdl_upload.bat")
-                with open(batch_file, "w", encoding="utf-8") as f:
-                    f.write(batch_content)
-                
-                self.add_upload_log(f"已创建批处理文件: {batch_file}")
-                
-                # 执行批处理文件
-                startupinfo = None
-                if os.name == 'nt':
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                
-                process = subprocess.Popen(
-                    batch_file,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    bufsize=1,
-                    universal_newlines=True,
-                    encoding='utf-8',
-                    errors='replace',
-                    shell=True,
-                    startupinfo=startupinfo,
-                    env=dict(os.environ, PYTHONIOENCODING='utf-8')  # 设置Python输出编码
+                self.add_upload_log(
+                    f"上传过程中出现错误，成功 {succeeded}/{total_files} 个文件，返回码: {batch.return_code}"
                 )
-                
-                # 将进程添加到列表中
-                self.running_processes.append(process)
-                
-                # 在进度解析部分进行优化
-                current_file_index = 0
-                completed_files = 0
-                is_uploading = False
-                last_progress = 0
-                current_progress_line = None  # 当前进度输出行
-                progress_bar_width = 30  # 进度条宽度
-                
-                def make_progress_bar(progress):
-                    filled = int(progress_bar_width * progress / 100)
-                    bar = '█' * filled + '░' * (progress_bar_width - filled)
-                    return f"[{bar}] {progress:.1f}%"
-                
-                while True:
-                    line = process.stdout.readline()
-                    if not line and process.poll() is not None:
-                        break
-                    if line:
-                        try:
-                            if isinstance(line, bytes):
-                                line = line.decode('utf-8', errors='replace')
-                            line = line.strip()
-                            # 检测我们的特殊标记
-                            if "[TDLGUI_MARKER] 开始上传" in line:
-                                last_bytes = 0
-                                last_time = time.time()
-                                self.update_network_speed(0, False)
-                                match = re.search(r'开始上传 (\d+)/(\d+): (.+)$', line)
-                                if match:
-                                    current_file_index = int(match.group(1)) - 1
-                                    file_name = match.group(3)
-                                    is_uploading = True
-                                    if enable_multi_upload:
-                                        self.add_upload_log(f"正在多任务上传（共{total_files}个文件）")
-                                    else:
-                                        self.add_upload_log(f"正在上传: {file_name}")
-                                    self.update_upload_progress(
-                                        current_value=0,
-                                        text=f"上传文件 {current_file_index+1}/{total_files}"
-                                    )
-                                    total_progress = (completed_files / total_files) * 100
-                                    self.update_upload_progress(total_value=total_progress)
-                                    last_progress = 0
-                                else:
-                                    # 多任务上传时，file_name为"多任务"
-                                    is_uploading = True
-                                    self.add_upload_log(f"正在多任务上传（共{total_files}个文件）")
-                                    self.update_upload_progress(
-                                        current_value=0,
-                                        text=f"多任务上传 1/{total_files}"
-                                    )
-                                    total_progress = (completed_files / total_files) * 100
-                                    self.update_upload_progress(total_value=total_progress)
-                                    last_progress = 0
-                            elif "[TDLGUI_MARKER] 完成上传" in line:
-                                self.update_network_speed(0, False)
-                                completed_files += 1
-                                is_uploading = False
-                                # 输出完成日志
-                                if enable_multi_upload:
-                                    self.add_upload_log(f"完成多任务上传（{total_files}/{total_files}）")
-                                else:
-                                    if current_file_index < len(files):
-                                        file_name = files[current_file_index].name if current_file_index < len(files) else ""
-                                        self.add_upload_log(f"完成上传: {file_name}")
-                                self.update_upload_progress(current_value=100)
-                                total_progress = (completed_files / total_files) * 100
-                                self.update_upload_progress(total_value=total_progress)
-                                last_progress = 100
-                            elif is_uploading:
-                                # 只刷新卡片，不进日志
-                                bar_speed_pattern = re.compile(r'^\[#+[\. ]*\]\s*\[\d+s;\s*[\d\.]+\s*[KMGT]?B/s\]$', re.I)
-                                if bar_speed_pattern.match(line):
-                                    # 解析进度和速度
-                                    bar_only_pattern = re.compile(r'\[(#+)([\. ]+)\]')
-                                    bar_match = bar_only_pattern.search(line)
-                                    if bar_match:
-                                        bar_count = len(bar_match.group(1))
-                                        total_count = bar_count + len(bar_match.group(2))
-                                        progress = (bar_count / total_count) * 100 if total_count > 0 else 0
-                                    else:
-                                        progress = None
-                                    speed_match = re.search(r'([\d\.]+)\s*([KMGT]?B)/s', line, re.IGNORECASE)
-                                    if speed_match:
-                                        value = float(speed_match.group(1))
-                                        unit = speed_match.group(2).upper()
-                                        multiplier = {
-                                            'B': 1,
-                                            'KB': 1024,
-                                            'MB': 1024 * 1024,
-                                            'GB': 1024 * 1024 * 1024,
-                                            'TB': 1024 * 1024 * 1024 * 1024
-                                        }.get(unit, 1)
-                                        speed_in_bytes = value * multiplier
-                                        self.update_network_speed(speed_in_bytes, False)
-                                    if progress is not None:
-                                        self.update_upload_progress(current_value=progress)
-                                        total_progress = ((completed_files + progress / 100) / total_files) * 100
-                                        self.update_upload_progress(total_value=total_progress)
-                                    continue
-                                # 其它行不进日志
-                                continue
-                            
-                            # 处理速度信息
-                            speed_match = re.search(r'(\d+(?:\.\d+)?)\s*([KMGT]?B)/s', line, re.IGNORECASE)
-                            if speed_match:
-                                value = float(speed_match.group(1))
-                                unit = speed_match.group(2).upper()
-                                multiplier = {
-                                    'B': 1,
-                                    'KB': 1024,
-                                    'MB': 1024 * 1024,
-                                    'GB': 1024 * 1024 * 1024,
-                                    'TB': 1024 * 1024 * 1024 * 1024
-                                }.get(unit, 1)
-                                speed_in_bytes = value * multiplier
-                                self.update_network_speed(speed_in_bytes, False)
-                            
-                            # 输出其他日志
-                            elif not line.startswith("[TDLGUI_MARKER]"):
-                                self.add_upload_log(line)
-                                
-                        except Exception as e:
-                            self.add_upload_log(f"[日志解析错误: {str(e)}]")
-                
-                # 删除临时批处理文件
-                try:
-                    os.remove(batch_file)
-                    self.add_upload_log("已删除临时批处理文件")
-                except:
-                    self.add_upload_log("无法删除临时批处理文件")
-                
-                return_code = process.poll()
-                if return_code == 0:
-                    self.add_upload_log("所有文件上传成功!")
-                    self.show_snackbar(page, "上传完成！")
-                else:
-                    self.add_upload_log(f"上传过程中出现错误，返回码: {return_code}")
-                    self.show_snackbar(page, f"上传出现错误，返回码: {return_code}")
-                
-                # 从列表中移除已完成的进程
-                if process in self.running_processes:
-                    self.running_processes.remove(process)
+                self.show_snackbar(page, f"上传出现错误，成功 {succeeded}/{total_files} 个文件")
             
             # 完成所有上传
             self.update_upload_progress(current_value=100, total_value=100, text="上传完成")
@@ -2481,10 +2733,9 @@ class TDLDownloaderApp:
 
     def clear_upload_logs(self):
         """清空上传日志"""
-        if self.upload_log_view is not None:
-            self.upload_log_view.controls.clear()
-            self.add_upload_log("上传日志已清空")
-            self.add_upload_log("准备就绪，请选择要上传的文件")
+        self.upload_log_viewport.clear()
+        self.add_upload_log("上传日志已清空")
+        self.add_upload_log("准备就绪，请选择要上传的文件")
 
     def add_upload_log(self, text, replace_last=False):
         """添加上传日志
@@ -2494,92 +2745,40 @@ class TDLDownloaderApp:
         """
         try:
             # 处理可能的乱码和控制字符，参考下载日志
-            def decode_bytes(b):
-                import locale, re
-                control_chars_pattern = re.compile(r'\x1b\[[0-9;]*[a-zA-Z]|\[A\[K')
-                if isinstance(b, bytes):
-                    b = control_chars_pattern.sub(b'', b)
-                    try:
-                        return b.decode('utf-8')
-                    except UnicodeDecodeError:
-                        pass
-                    try:
-                        return b.decode('gbk')
-                    except UnicodeDecodeError:
-                        pass
-                    try:
-                        return b.decode(locale.getpreferredencoding())
-                    except UnicodeDecodeError:
-                        pass
-                    return b.decode('utf-8', errors='replace')
-                elif isinstance(b, str):
-                    b = re.sub(r'\x1b\[[0-9;]*[a-zA-Z]|\[A\[K', '', b)
-                    return b.encode('utf-8', errors='replace').decode('utf-8')
-                return str(b)
-            text = decode_bytes(text)
+            if isinstance(text, (bytes, str)):
+                text = decode_output(strip_control_chars(text))
+            else:
+                text = str(text)
             # 过滤掉系统信息行
-            import re
-            if re.search(r'CPU: \d+\.\d+% Memory: \d+\.\d+ MB Goroutines: \d+', text):
+            if is_sysinfo(text):
                 return
             timestamp = datetime.now().strftime("%H:%M:%S")
-            log_text_style = ft.TextStyle(
-                size=13,
-                weight=ft.FontWeight.W_400,
-                color=ft.Colors.GREY_800,
-                font_family="Consolas"
-            )
-            if replace_last and len(self.upload_log_view.controls) > 0:
-                self.upload_log_view.controls[-1].content.value = f"[{timestamp}] {text}"
-                self.run_on_ui(self.upload_log_view.page, lambda: self.upload_log_view.controls[-1].content.update())
-            else:
-                self.upload_log_view.controls.append(
-                    ft.Container(
-                        content=ft.Text(f"[{timestamp}] {text}", selectable=True, style=log_text_style),
-                        padding=ft.padding.symmetric(vertical=2)
-                    )
-                )
-            if len(self.upload_log_view.controls) > 1000:
-                self.upload_log_view.controls.pop(0)
-            if self.upload_log_view.page:
-                self.run_on_ui(self.upload_log_view.page, lambda: self.upload_log_view.update())
+            self.upload_log_viewport.append(f"[{timestamp}] {text}", replace_last)
+            self.session_log.write("upload", text)
         except Exception as e:
             print(f"添加上传日志时出错: {str(e)}")
 
-    def update_upload_progress(self, current_value=None, total_value=None, text=None):
-        """更新上传进度条"""
+    def update_upload_progress(self, current_value=None, total_value=None, text=None, eta=None):
+        """更新上传进度条（由刷新循环按帧合并刷新）"""
         try:
             if current_value is not None and self.upload_current_progress is not None:
                 current_value = max(0, min(100, current_value))
-                if abs(self.upload_current_progress.value * 100 - current_value) >= 0.01:
-                    self.upload_current_progress.value = current_value / 100
-                    new_text = f"{current_value:.1f}%"
-                    if self.upload_current_progress_text and self.upload_current_progress_text.value != new_text:
-                        self.upload_current_progress_text.value = new_text
-                        if self.upload_current_progress_text.page:
-                            self.update_control_safe(self.upload_current_progress_text.page, self.upload_current_progress_text)
-                    if self.upload_current_progress.page:
-                        self.update_control_safe(self.upload_current_progress.page, self.upload_current_progress)
+                self.renderer.set(self.upload_current_progress, value=current_value / 100)
+                self.renderer.set(self.upload_current_progress_text, value=f"{current_value:.1f}%")
             if total_value is not None and self.upload_total_progress is not None:
                 total_value = max(0, min(100, total_value))
-                if abs(self.upload_total_progress.value * 100 - total_value) >= 0.01:
-                    self.upload_total_progress.value = total_value / 100
-                    new_text = f"{total_value:.1f}%"
-                    if self.upload_total_progress_text and self.upload_total_progress_text.value != new_text:
-                        self.upload_total_progress_text.value = new_text
-                        if self.upload_total_progress_text.page:
-                            self.update_control_safe(self.upload_total_progress_text.page, self.upload_total_progress_text)
-                    if self.upload_total_progress.page:
-                        self.update_control_safe(self.upload_total_progress.page, self.upload_total_progress)
+                self.renderer.set(self.upload_total_progress, value=total_value / 100)
+                self.renderer.set(self.upload_total_progress_text, value=self._format_progress(total_value, eta))
             if text is not None and self.upload_current_task_text is not None:
-                if self.upload_current_task_text.value != text:
-                    self.upload_current_task_text.value = text
-                    if self.upload_current_task_text.page:
-                        self.update_control_safe(self.upload_current_task_text.page, self.upload_current_task_text)
+                self.renderer.set(self.upload_current_task_text, value=text)
         except Exception as e:
             print(f"更新上传进度条时出错: {str(e)}")
     
     def kill_tdl_processes(self):
         """终止所有tdl进程"""
+        # 逐个上传时不再启动后面的文件
+        if self.upload_runner is not None:
+            self.upload_runner.cancel()
         # 先尝试终止我们启动的进程
         for process in self.running_processes:
             try:
@@ -2588,8 +2787,9 @@ class TDLDownloaderApp:
             except:
                 pass
         
-        # 然后查找并终止所有tdl进程
+        # 然后查找并终止所有tdl进程，psutil 只在这里用到，用到时才导入
         try:
+            import psutil
             for proc in psutil.process_iter(['pid', 'name']):
                 if 'tdl' in proc.info['name'].lower():
                     try:
@@ -2630,49 +2830,46 @@ class TDLDownloaderApp:
         if confirmed:
             # 终止所有tdl进程
             self.kill_tdl_processes()
+            # 写完剩余的会话日志
+            self.session_log.close()
+            self.manifest.close()
+            self.upload_cache.close()
+            self.maintenance.close()
+            shutdown_pool()
+            for service in self.metrics_services:
+                service.close()
             # 关闭应用
             e.page.window_destroy()
 
     def reset_download_status(self):
         """重置下载状态显示"""
         try:
-            self.download_speed_text.value = "0 B/s"
             self.total_tasks = 0
             self.completed_tasks = 0
             self.current_task_progress = 0
-            self.total_progress_bar.value = 0
-            self.total_progress_text.value = "0%"
-            self.download_speed_text.update()
-            self.total_progress_bar.update()
-            self.total_progress_text.update()
+            self.download_throughput.record(0)
+            self.renderer.set(self.download_speed_text, value="0 B/s")
+            self.renderer.set(self.total_progress_bar, value=0)
+            self.renderer.set(self.total_progress_text, value="0%")
         except Exception as e:
             print(f"重置下载状态时出错: {str(e)}")
 
-    def update_download_progress(self, progress=None, speed=None):
-        """更新下载进度显示"""
+    def update_download_progress(self, progress=None, speed=None, eta=None):
+        """更新下载进度显示（由刷新循环按帧合并刷新）"""
         try:
             if progress is not None:
-                self.total_progress_bar.value = progress / 100
-                self.total_progress_text.value = f"{progress:.1f}%"
-                if self.total_progress_bar.page:
-                    self.update_control_safe(self.total_progress_bar.page, self.total_progress_bar)
-                if self.total_progress_text.page:
-                    self.update_control_safe(self.total_progress_text.page, self.total_progress_text)
+                self.renderer.set(self.total_progress_bar, value=progress / 100)
+                self.renderer.set(self.total_progress_text, value=self._format_progress(progress, eta))
             if speed is not None:
-                self.download_speed_text.value = speed
-                if self.download_speed_text.page:
-                    self.update_control_safe(self.download_speed_text.page, self.download_speed_text)
+                self.renderer.set(self.download_speed_text, value=speed)
         except Exception as e:
             print(f"更新下载进度显示时出错: {str(e)}")
 
     def _copy_logs_to_clipboard(self, e, page):
         """一键复制所有下载日志到剪贴板"""
         try:
-            logs = []
-            for c in self.log_view.controls:
-                if hasattr(c, 'content') and hasattr(c.content, 'value'):
-                    logs.append(str(c.content.value))
-            all_logs = '\n'.join(logs)
+            self.log_viewport.commit()
+            all_logs = '\n'.join(self.log_store.lines())
             page.set_clipboard(all_logs)
             self.show_snackbar(page, "日志已复制到剪贴板！")
         except Exception as ex:
@@ -2681,11 +2878,8 @@ class TDLDownloaderApp:
     # 新增上传日志复制方法
     def _copy_upload_logs_to_clipboard(self, e, page):
         try:
-            logs = []
-            for c in self.upload_log_view.controls:
-                if hasattr(c, 'content') and hasattr(c.content, 'value'):
-                    logs.append(str(c.content.value))
-            all_logs = '\n'.join(logs)
+            self.upload_log_viewport.commit()
+            all_logs = '\n'.join(self.upload_log_store.lines())
             page.set_clipboard(all_logs)
             self.show_snackbar(page, "上传日志已复制到剪贴板！")
         except Exception as ex:
@@ -2707,5 +2901,8 @@ class TDLDownloaderApp:
         self.run_on_ui(page, lambda: control.update())
 
 if __name__ == "__main__":
+    # 打包后的程序中，校验用的进程池需要先处理子进程的启动参数
+    import multiprocessing
+    multiprocessing.freeze_support()
     app = TDLDownloaderApp()
     ft.app(target=app.main) 
\ No newline at end of file
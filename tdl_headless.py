@@ -0,0 +1,508 @@
+"""无界面模式：不依赖 flet，在命令行中批量下载或上传
+
+用法:
+    python tdl_flet.py --headless dl links.txt [-d 目录] [-t 线程数] [-l 并发数] [--shards 分片进程数]
+    python tdl_flet.py --headless up 文件... [-c 聊天] [-t 线程数] [-l 并发数] [--photo] [--rm] [--force]
+
+进度默认以文本输出到控制台，加 --jsonl 时每个事件输出一行 JSON，便于其它程序读取。
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from tdl_engine import (
+    ByteProgress, DownloadListener, DownloadManifest, DownloadQueue, DownloadRunner, DownloadScheduler, EventChannel,
+    RangeProgress, UploadListener, UploadRunner, normalize_links, tdl_environment,
+    JOB_PENDING,
+)
+from tdl_logs import SessionLogWriter
+from tdl_metrics import MetricsRegistry, RateMeter, start_metrics
+from tdl_upload_cache import UploadCache, UploadFile
+from tdl_verify import STATUS_TEXT, VERIFY_OK, VERIFY_UNKNOWN_SIZE, shutdown_pool, summarize, verify_files, write_report
+from tdl_parser import EVENT_ERROR
+
+
+def _format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.2f} {unit}"
+        size /= 1024
+    return f"{size:.2f} TB"
+
+
+def _format_eta(seconds):
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+
+class Reporter:
+    """把事件输出到控制台：普通文本，或每行一个 JSON 对象
+
+    打包后的无控制台程序中 sys.stdout 为 None，此时不输出，事件仍记录在会话日志中。
+    """
+
+    def __init__(self, jsonl=False, stream=None):
+        self.jsonl = jsonl
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def emit(self, event, text, **fields):
+        """
+        Args:
+            event: 事件类型，如 started、done、progress、error
+            text: 文本模式下输出的内容
+            fields: JSONL 模式下附加的字段
+        """
+        if self.stream is None:
+            return
+        if self.jsonl:
+            record = {"time": time.time(), "event": event}
+            record.update(fields)
+            line = json.dumps(record, ensure_ascii=False)
+        else:
+            line = f"[{datetime.now().strftime('%H:%M:%S')}] {text}"
+        with self._lock:
+            try:
+                self.stream.write(line + "\n")
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+
+
+class HeadlessDownloadListener(DownloadListener):
+    """把下载任务的事件输出到控制台和会话日志"""
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def started(self, batch, name, link, first):
+        self.runner._log("download", "started", f"→ 开始下载: {name} ({link or '-'})", name=name, link=link)
+
+    def done(self, batch, event, link, position):
+        runner = self.runner
+        if position is not None:
+            link = batch.jobs[position].link
+        runner.files_completed += 1
+        if event.path:
+            runner.completed_files.append((event.path, event.done_bytes, link))
+        runner._log("download", "done", f"√ 完成下载: {event.name} ({link or '-'})",
+                    name=event.name, link=link, bytes=event.done_bytes)
+
+    def progress(self, batch, event, link):
+        if event.speed is not None:
+            with self.runner._job_lock:
+                self.runner._job_speed[batch.key] = event.speed
+
+    def error(self, batch, text):
+        self.runner._log("download", "error", text, line=text)
+
+    def failed(self, batch, error):
+        self.runner._log("download", "error", f"执行下载任务时出错: {str(error)}", error=str(error))
+
+    def exited(self, batch, return_code):
+        with self.runner._job_lock:
+            self.runner._job_speed.pop(batch.key, None)
+        if return_code != 0:
+            self.runner._log("download", "job_failed",
+                             f"tdl 进程异常退出，返回码: {return_code}，共 {len(batch)} 个链接",
+                             return_code=return_code, links=batch.links)
+
+
+class HeadlessUploadListener(UploadListener):
+    """把上传的事件输出到控制台和会话日志"""
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def done(self, batch, position, return_code):
+        self.runner.files_completed += 1
+        self.runner._log("upload", "done", f"√ 完成上传 ({batch.completed}/{len(batch)})",
+                         completed=batch.completed, total=len(batch))
+
+    def progress(self, batch, event, position):
+        if event.speed is not None:
+            with self.runner._job_lock:
+                self.runner._job_speed["upload"] = event.speed
+
+    def output(self, batch, event):
+        if event.kind == EVENT_ERROR:
+            self.runner._log("upload", "error", event.text, line=event.text)
+
+    def failed(self, batch, error):
+        self.runner._log("upload", "error", f"执行上传时出错: {str(error)}", error=str(error))
+
+    def exited(self, batch, return_code):
+        with self.runner._job_lock:
+            self.runner._job_speed.pop("upload", None)
+
+
+class HeadlessRunner:
+    """命令行模式的下载、上传执行器
+
+    使用与界面相同的下载队列、调度器、输出解析器和下载清单，
+    只是把界面刷新换成控制台输出，总体进度由单独的线程定期输出。
+    """
+
+    def __init__(self, tdl_path, downloads_dir, env_vars, reporter, logs_dir=None, progress_interval=2.0,
+                 upload_cache_path=None):
+        """
+        Args:
+            tdl_path: tdl 可执行文件路径
+            downloads_dir: 下载目录
+            env_vars: 传给 tdl 的环境变量
+            reporter: Reporter
+            logs_dir: 会话日志目录，为 None 时不写会话日志
+            progress_interval: 输出总体进度的间隔（秒）
+            upload_cache_path: 上传去重缓存文件，为 None 时不跳过也不记录已上传的文件
+        """
+        self.tdl_path = tdl_path
+        self.downloads_dir = downloads_dir
+        self.env_vars = env_vars
+        self.reporter = reporter
+        self.progress_interval = progress_interval
+        self.running_processes = []
+        self.session_log = SessionLogWriter(logs_dir, prefix="headless") if logs_dir else None
+        if self.session_log:
+            self.session_log.start()
+        self.download_queue = DownloadQueue()
+        self.download_bytes = ByteProgress()
+        self.upload_bytes = ByteProgress()
+        self.upload_cache = UploadCache(upload_cache_path) if upload_cache_path else None
+        self.lines = RateMeter()
+        self.files_completed = 0
+        # 本次下载完成的文件 (路径, tdl 记录的大小, 链接)，用于下载后的校验
+        self.completed_files = []
+        self._job_speed = {}
+        self._job_lock = threading.Lock()
+        self._idle = threading.Event()
+        self.manifest = None
+        # 输出事件在消费线程中处理，每处理完一批事件把下载清单落盘一次
+        self.event_channel = EventChannel(on_batch=self._flush_manifest)
+        self.event_channel.start()
+        self.upload_runner = UploadRunner(
+            self.event_channel, HeadlessUploadListener(self), self.upload_bytes,
+            processes=self.running_processes, lines=self.lines
+        )
+        self.metrics = MetricsRegistry()
+        self._register_metrics()
+        self.metrics_services = start_metrics(
+            self.metrics, os.environ.get("TDLGUI_METRICS_PORT"), os.environ.get("TDLGUI_METRICS_FILE")
+        )
+
+    def _register_metrics(self):
+        self.metrics.register(
+            "transferred_bytes", "gauge", "本轮下载或上传已传输的字节数",
+            lambda: {(("direction", "download"),): self.download_bytes.done_bytes,
+                     (("direction", "upload"),): self.upload_bytes.done_bytes}
+        )
+        self.metrics.register("files_completed_total", "counter", "已完成的文件数", lambda: self.files_completed)
+        self.metrics.register("active_processes", "gauge", "正在运行的 tdl 进程数", lambda: len(self.running_processes))
+        self.metrics.register("queue_pending", "gauge", "下载队列中等待的链接数", self.download_queue.pending_count)
+
+        def job_speeds():
+            with self._job_lock:
+                return {(("job", str(key)),): speed for key, speed in self._job_speed.items()}
+        self.metrics.register("job_speed_bytes_per_second", "gauge", "每个 tdl 进程的速度（字节每秒）", job_speeds)
+        self.metrics.register("parsed_lines_total", "counter", "已解析的 tdl 输出行数", lambda: self.lines.total)
+        self.metrics.register("parsed_lines_per_second", "gauge", "最近几秒每秒解析的 tdl 输出行数", self.lines.rate)
+
+    def _flush_manifest(self):
+        if self.manifest is not None:
+            self.manifest.flush()
+
+    def _log(self, source, event, text, **fields):
+        self.reporter.emit(event, text, **fields)
+        if self.session_log:
+            self.session_log.write(source, text, event=event, **fields)
+
+    def _speed(self):
+        with self._job_lock:
+            return sum(self._job_speed.values())
+
+    def download(self, lines, threads=1, concurrent=1, shards=1, manifest_path=None):
+        """下载链接
+        Args:
+            lines: 链接文本行，支持消息范围
+            threads: 每个任务的线程数
+            concurrent: 单进程模式下同时运行的 tdl 进程数，分片模式下每个进程的并发数
+            shards: 分片进程数，大于1时每个 tdl 进程领取一批链接
+            manifest_path: 下载清单路径，默认为下载目录中的 download_manifest.jsonl
+        Returns:
+            失败的链接数
+        """
+        os.makedirs(self.downloads_dir, exist_ok=True)
+        self.manifest = DownloadManifest(
+            manifest_path or os.path.join(self.downloads_dir, "download_manifest.jsonl")
+        )
+        self.download_runner = DownloadRunner(
+            self.event_channel, HeadlessDownloadListener(self), self.manifest, self.download_bytes,
+            processes=self.running_processes, lines=self.lines
+        )
+        links, ranges, duplicates, rejected = normalize_links(lines)
+        for line in rejected:
+            self._log("download", "rejected", f"忽略无法识别的链接: {line}", line=line)
+        if duplicates:
+            self._log("download", "duplicates", f"跳过 {duplicates} 个重复的链接", count=duplicates)
+        if not links and not ranges:
+            self._log("download", "error", "没有可下载的有效链接")
+            self.manifest.close()
+            return 0
+
+        shard_mode = shards > 1
+        limit = concurrent if shard_mode else 1
+        self.download_queue.add(links, threads=threads, limit=limit)
+        self.manifest.record(links, JOB_PENDING)
+        for link_range in ranges:
+            source = RangeProgress(self.manifest, link_range)
+            self.download_queue.add_source(
+                link_range, len(link_range), threads=threads, limit=limit,
+                on_expand=source.expanded, on_discard=source.discard
+            )
+        total = self.download_queue.pending_count()
+        self._log("download", "queued", f"已加入下载队列: {total} 个链接，保存到 {self.downloads_dir}",
+                  count=total, directory=self.downloads_dir)
+
+        self._idle.clear()
+        scheduler = DownloadScheduler(
+            self.download_queue, runner=self._run_download_job, on_idle=self._idle.set,
+            slots=shards if shard_mode else concurrent
+        )
+        scheduler.set_slots(shards if shard_mode else concurrent, shard=shard_mode)
+        reporter_thread = threading.Thread(target=self._report_download_progress, daemon=True)
+        reporter_thread.start()
+        # 带超时等待，Windows 上也能及时响应 Ctrl+C
+        while not self._idle.wait(0.5):
+            pass
+        reporter_thread.join()
+        self.download_queue.close()
+        self.manifest.close()
+
+        failed = self.download_queue.total_failed
+        finished = self.download_queue.total_finished
+        self._log("download", "finished", f"下载结束: 完成 {finished - failed} 个，失败 {failed} 个",
+                  finished=finished - failed, failed=failed)
+        return failed
+
+    def _report_download_progress(self):
+        """定期输出总体进度，直到队列空闲"""
+        while not self._idle.wait(self.progress_interval):
+            total = self.download_queue.total_added
+            finished = self.download_queue.total_finished
+            self.download_bytes.set_count(total)
+            fraction = self.download_bytes.fraction()
+            if fraction is None:
+                fraction = finished / total if total else 0
+            speed = self._speed()
+            eta = self.download_bytes.eta()
+            self.reporter.emit(
+                "progress",
+                f"总体进度 {fraction * 100:.1f}%  {finished}/{total}  {_format_size(speed)}/s  剩余 {_format_eta(eta)}",
+                percent=round(fraction * 100, 2), finished=finished, total=total,
+                done_bytes=self.download_bytes.done_bytes, speed=speed, eta=eta,
+                pending=self.download_queue.pending_count()
+            )
+
+    def _run_download_job(self, jobs):
+        """执行一组下载任务，返回 tdl 进程的返回码"""
+        return self.download_runner.run(jobs, self.tdl_path, self.downloads_dir, tdl_environment(self.env_vars))
+
+    def verify(self, algorithm="sha256"):
+        """用进程池校验本次下载完成的文件，结果写入下载目录
+        Returns:
+            未通过校验的文件数
+        """
+        items = []
+        for path, expected, link in self.completed_files:
+            if not os.path.exists(path):
+                candidate = os.path.join(self.downloads_dir, os.path.basename(path.replace("\\", "/")))
+                if os.path.exists(candidate):
+                    path = candidate
+            items.append((path, expected, link))
+        if not items:
+            return 0
+        self._log("download", "verify_started", f"开始校验 {len(items)} 个文件...", count=len(items))
+        results = verify_files(items, algorithm=algorithm)
+        failed = [result for result in results if result["status"] not in (VERIFY_OK, VERIFY_UNKNOWN_SIZE)]
+        for result in failed:
+            self._log("download", "verify_failed", f"× 校验未通过: {result['path']} ({STATUS_TEXT[result['status']]})",
+                      path=result["path"], status=result["status"], size=result["size"],
+                      expected=result["expected"], link=result["info"])
+        report_file = os.path.join(
+            self.downloads_dir, f"verify_headless_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        )
+        write_report(report_file, results, algorithm=algorithm or "", format_size=_format_size)
+        counts = summarize(results)
+        self._log("download", "verified",
+                  f"校验完成: 通过 {counts.get(VERIFY_OK, 0)} 个，未通过 {len(failed)} 个，结果已保存到 {report_file}",
+                  counts=counts, report=report_file)
+        return len(failed)
+
+    def upload(self, paths, chat=None, threads=1, concurrent=1, as_photo=False, delete_after=False,
+               skip_uploaded=True):
+        """用一个 tdl 进程上传所有文件
+        Args:
+            skip_uploaded: 跳过上传缓存中记录的、已上传到该聊天的文件
+        Returns:
+            tdl 进程的返回码
+        """
+        entries = []
+        if self.upload_cache is not None:
+            if skip_uploaded:
+                entries, skipped = self.upload_cache.plan(paths, chat, hash_all=delete_after)
+                for entry in skipped:
+                    self._log("upload", "skipped", f"跳过已上传到该聊天的文件: {entry.path}", path=entry.path)
+                paths = [entry.path for entry in entries]
+                if not paths:
+                    self._log("upload", "finished", "所有文件都已上传到该聊天，没有需要上传的文件", return_code=0)
+                    return 0
+            else:
+                entries = [UploadFile(i, path) for i, path in enumerate(paths)]
+        self._log("upload", "queued", f"开始上传 {len(paths)} 个文件", count=len(paths), chat=chat)
+        stop = threading.Event()
+        reporter_thread = threading.Thread(target=self._report_upload_progress, args=(stop,), daemon=True)
+        reporter_thread.start()
+        try:
+            batch = self.upload_runner.run(
+                paths, self.tdl_path, tdl_environment(self.env_vars), chat=chat, threads=threads,
+                concurrent=concurrent, as_photo=as_photo, delete_after=delete_after
+            )
+        finally:
+            stop.set()
+            reporter_thread.join()
+        return_code = batch.return_code
+        if return_code == 0:
+            if self.upload_cache is not None:
+                self.upload_cache.record_uploaded(chat, [entries[i] for i in batch.succeeded])
+            self._log("upload", "finished", "所有文件上传成功!", return_code=return_code)
+        else:
+            self._log("upload", "finished", f"上传过程中出现错误，返回码: {return_code}", return_code=return_code)
+        return return_code
+
+    def _report_upload_progress(self, stop):
+        while not stop.wait(self.progress_interval):
+            fraction = self.upload_bytes.fraction() or 0
+            speed = self._speed()
+            eta = self.upload_bytes.eta()
+            self.reporter.emit(
+                "progress",
+                f"总体进度 {fraction * 100:.1f}%  {_format_size(speed)}/s  剩余 {_format_eta(eta)}",
+                percent=round(fraction * 100, 2), done_bytes=self.upload_bytes.done_bytes, speed=speed, eta=eta
+            )
+
+    def terminate(self):
+        """终止本程序启动的所有 tdl 进程"""
+        self.upload_runner.cancel()
+        for process in list(self.running_processes):
+            try:
+                process.terminate()
+            except Exception:
+                pass
+
+    def close(self):
+        self.event_channel.stop()
+        if self.session_log:
+            self.session_log.close()
+        if self.upload_cache is not None:
+            self.upload_cache.close()
+        shutdown_pool()
+        for service in self.metrics_services:
+            service.close()
+
+
+def _default_base_path():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(os.path.abspath(sys.executable))
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def _default_tdl_path(base_path):
+    """优先使用程序目录中的 tdl.exe，其次是 PATH 中的 tdl"""
+    local = os.path.join(base_path, "tdl.exe")
+    if os.path.exists(local):
+        return local
+    return shutil.which("tdl") or local
+
+
+def build_arg_parser():
+    arg_parser = argparse.ArgumentParser(
+        prog="tdl_flet.py --headless", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument("--tdl", help="tdl 可执行文件路径")
+    arg_parser.add_argument("--ns", default="quickstart", help="tdl 命名空间（TDL_NS），默认 quickstart")
+    arg_parser.add_argument("--proxy", help="代理地址（TDL_PROXY），如 socks5://127.0.0.1:1080")
+    arg_parser.add_argument("--jsonl", action="store_true", help="每个事件输出一行 JSON")
+    arg_parser.add_argument("--interval", type=float, default=2.0, help="输出总体进度的间隔（秒）")
+    arg_parser.add_argument("--no-session-log", action="store_true", help="不在 logs 目录写会话日志")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    dl = commands.add_parser("dl", help="下载链接文件中的所有链接")
+    dl.add_argument("links_file", help="链接文件，每行一个链接或消息范围，- 表示标准输入")
+    dl.add_argument("-d", "--dir", help="下载目录，默认为程序目录下的 downloads")
+    dl.add_argument("-t", "--threads", type=int, default=4, help="每个任务的线程数")
+    dl.add_argument("-l", "--limit", type=int, default=2, help="同时运行的 tdl 进程数；分片模式下为每个进程的并发数")
+    dl.add_argument("--shards", type=int, default=1, help="分片进程数，大于1时每个 tdl 进程下载一批链接")
+    # shake 系列需要指定输出长度，不能直接用于校验
+    algorithms = sorted(name for name in hashlib.algorithms_guaranteed if not name.startswith("shake_"))
+    dl.add_argument("--verify", nargs="?", const="sha256", metavar="算法", choices=algorithms + ["size"],
+                    help="下载结束后用进程池校验文件大小和哈希（默认 sha256，size 表示只核对大小）")
+
+    up = commands.add_parser("up", help="上传文件")
+    up.add_argument("paths", nargs="+", help="要上传的文件")
+    up.add_argument("-c", "--chat", help="目标聊天，默认为收藏夹")
+    up.add_argument("-t", "--threads", type=int, default=4, help="线程数")
+    up.add_argument("-l", "--limit", type=int, default=2, help="并发数")
+    up.add_argument("--photo", action="store_true", help="作为照片上传")
+    up.add_argument("--rm", action="store_true", help="上传后删除原文件")
+    up.add_argument("--force", action="store_true", help="不跳过已上传到该聊天的文件")
+    return arg_parser
+
+
+def main(argv=None):
+    """命令行入口，返回进程退出码"""
+    args = build_arg_parser().parse_args(argv)
+    base_path = _default_base_path()
+    env_vars = {"TDL_NS": args.ns}
+    if args.proxy:
+        env_vars["TDL_PROXY"] = args.proxy
+    runner = HeadlessRunner(
+        args.tdl or _default_tdl_path(base_path),
+        os.path.abspath(getattr(args, "dir", None) or os.path.join(base_path, "downloads")),
+        env_vars,
+        Reporter(jsonl=args.jsonl),
+        logs_dir=None if args.no_session_log else os.path.join(base_path, "logs"),
+        progress_interval=args.interval,
+        upload_cache_path=os.path.join(base_path, "upload_cache.jsonl"),
+    )
+    try:
+        if args.command == "dl":
+            if args.links_file == "-":
+                lines = sys.stdin.read().splitlines()
+            else:
+                with open(args.links_file, encoding="utf-8-sig") as f:
+                    lines = f.read().splitlines()
+            failed = runner.download(lines, max(1, args.threads), max(1, args.limit), max(1, args.shards))
+            if args.verify:
+                failed += runner.verify(None if args.verify == "size" else args.verify)
+            return 1 if failed else 0
+        return_code = runner.upload(args.paths, args.chat, max(1, args.threads), max(1, args.limit), args.photo, args.rm,
+                                    not args.force)
+        return 0 if return_code == 0 else 1
+    except KeyboardInterrupt:
+        runner.terminate()
+        runner.reporter.emit("interrupted", "已中断，已终止 tdl 进程")
+        return 130
+    finally:
+        runner.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""日志存储：固定容量的环形缓冲区，以及写入磁盘的会话日志"""
+import os
+import gzip
+import json
+import time
+import queue
+import shutil
+import threading
+from datetime import datetime
+
+
+class LogStore:
+    """线程安全的环形日志缓冲区
+
+    追加和按位置读取都是 O(1)，写满后最旧的行被覆盖。
+    每一行有一个递增的绝对序号，视图用它记住滚动位置，不受旧行被覆盖的影响。
+    """
+
+    def __init__(self, capacity=100000):
+        """
+        Args:
+            capacity: 最多保留的行数
+        """
+        self.capacity = max(1, capacity)
+        self._lines = [None] * self.capacity
+        self._lock = threading.Lock()
+        # 最旧一行的绝对序号，以及下一行将要使用的绝对序号
+        self._first = 0
+        self._next = 0
+        # 每次修改递增，视图据此判断是否需要重绘
+        self.version = 0
+
+    def append(self, line):
+        with self._lock:
+            self._lines[self._next % self.capacity] = line
+            self._next += 1
+            if self._next - self._first > self.capacity:
+                self._first = self._next - self.capacity
+            self.version += 1
+
+    def extend(self, lines):
+        with self._lock:
+            for line in lines:
+                self._lines[self._next % self.capacity] = line
+                self._next += 1
+            if self._next - self._first > self.capacity:
+                self._first = self._next - self.capacity
+            self.version += 1
+
+    def replace_last(self, line):
+        """替换最后一行，没有日志时直接追加"""
+        with self._lock:
+            if self._next == self._first:
+                self._lines[self._next % self.capacity] = line
+                self._next += 1
+            else:
+                self._lines[(self._next - 1) % self.capacity] = line
+            self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._lines = [None] * self.capacity
+            self._first = self._next
+            self.version += 1
+
+    def __len__(self):
+        return self._next - self._first
+
+    @property
+    def first_index(self):
+        """最旧一行的绝对序号"""
+        return self._first
+
+    @property
+    def end_index(self):
+        """最新一行的绝对序号加一"""
+        return self._next
+
+    def window(self, start, count):
+        """读取从绝对序号 start 开始的最多 count 行
+        Returns:
+            (实际起始序号, 行列表)
+        """
+        with self._lock:
+            start = max(self._first, min(start, self._next))
+            end = min(self._next, start + max(0, count))
+            return start, [self._lines[i % self.capacity] for i in range(start, end)]
+
+    def lines(self):
+        """所有行的快照"""
+        return self.window(self._first, self.capacity)[1]
+
+
+class SessionLogWriter:
+    """会话日志：后台线程把事件逐条追加到 JSONL 文件
+
+    write() 只把记录放进队列，不做任何磁盘操作；
+    写入线程每次取出队列中的全部记录一起写入，
+    文件超过大小上限时轮转，轮转出的分段在后台压缩为 .gz。
+    """
+
+    def __init__(self, directory, prefix="session", max_bytes=10 * 1024 * 1024):
+        """
+        Args:
+            directory: 日志目录
+            prefix: 文件名前缀
+            max_bytes: 单个分段的最大字节数
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.session = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.base_name = f"{prefix}-{self.session}"
+        self.path = os.path.join(directory, f"{self.base_name}.jsonl")
+        self._queue = queue.Queue()
+        self._segment = 0
+        self._thread = None
+        self._closed = False
+
+    def start(self):
+        """启动写入线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def write(self, source, text, **fields):
+        """记录一条事件
+        Args:
+            source: 事件来源，如 download、upload
+            text: 日志文本
+            fields: 其它附加字段
+        """
+        if self._closed:
+            return
+        record = {"time": time.time(), "source": source, "text": text}
+        if fields:
+            record.update(fields)
+        self._queue.put(record)
+
+    def close(self, timeout=5):
+        """写完队列中剩余的记录后停止写入线程"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            f = open(self.path, "a", encoding="utf-8")
+        except Exception as e:
+            print(f"创建会话日志失败: {str(e)}")
+            return
+        size = f.tell()
+        running = True
+        while running:
+            records = [self._queue.get()]
+            try:
+                while True:
+                    records.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            lines = []
+            for record in records:
+                if record is None:
+                    running = False
+                    continue
+                lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+            try:
+                data = "".join(lines)
+                f.write(data)
+                f.flush()
+                size += len(data.encode("utf-8"))
+                if size >= self.max_bytes:
+                    f.close()
+                    self._rotate()
+                    f = open(self.path, "a", encoding="utf-8")
+                    size = 0
+            except Exception as e:
+                print(f"写入会话日志失败: {str(e)}")
+        f.close()
+
+    def _rotate(self):
+        """把当前文件改名为编号分段，并在后台压缩"""
+        self._segment += 1
+        segment_path = os.path.join(self.directory, f"{self.base_name}.{self._segment:03d}.jsonl")
+        os.replace(self.path, segment_path)
+        threading.Thread(target=self._compress, args=(segment_path,), daemon=True).start()
+
+    @staticmethod
+    def _compress(path):
+        try:
+            with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.remove(path)
+        except Exception as e:
+            print(f"压缩会话日志失败: {str(e)}")
@@ -0,0 +1,151 @@
+"""下载目录维护：后台线程中流式扫描目录，分批并行处理其中的文件"""
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MaintenanceService:
+    """下载目录的后台维护服务
+
+    维护任务（清理、检查临时文件等）在单独的线程中依次执行，启动流程和下载线程只负责提交。
+    目录用 os.scandir 流式遍历，条目按批交给线程池处理，扫描和处理同时进行；
+    处理函数直接使用 DirEntry 缓存的类型和 stat 结果，
+    下载目录在网络共享上、有数十万个文件时也不会阻塞界面或下一个下载任务。
+    """
+
+    def __init__(self, workers=4, batch_size=256, on_error=None):
+        """
+        Args:
+            workers: 处理文件的线程数（重命名、删除等以 I/O 为主）
+            batch_size: 每批交给线程池的条目数
+            on_error: 任务出错时的回调，参数为任务名和异常
+        """
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.on_error = on_error
+        self._tasks = queue.Queue()
+        self._thread = None
+        self._pool = None
+        self._lock = threading.Lock()
+        # 关闭时设置，正在执行的 process() 在下一批之前停止
+        self._cancel = threading.Event()
+        self._closed = False
+        # 正在执行的任务名，空闲时为 None
+        self.current = None
+
+    def submit(self, name, task, *args):
+        """提交一个维护任务，按提交顺序在后台线程中执行
+        Args:
+            name: 任务名，用于日志
+            task: 任务函数
+            args: 任务参数
+        """
+        with self._lock:
+            if self._closed:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._tasks.put((name, task, args))
+
+    def close(self):
+        """停止后台线程，正在执行的任务会被请求中止"""
+        with self._lock:
+            self._closed = True
+        self._cancel.set()
+        self._tasks.put(None)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def _run(self):
+        while True:
+            item = self._tasks.get()
+            if item is None:
+                return
+            name, task, args = item
+            with self._lock:
+                if self._closed:
+                    # 关闭后排在后面的任务不再执行，取消标记也不能被清除
+                    continue
+                self._cancel.clear()
+            self.current = name
+            try:
+                task(*args)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(name, e)
+                else:
+                    print(f"维护任务 {name} 出错: {str(e)}")
+            finally:
+                self.current = None
+
+    def scan(self, directory, suffix=None):
+        """流式扫描目录中的文件，每次产生一批 DirEntry
+        Args:
+            directory: 目录
+            suffix: 只保留以此结尾的文件名，为 None 时保留全部文件
+        """
+        batch = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if suffix is not None and not entry.name.endswith(suffix):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                batch.append(entry)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def process(self, directory, handler, suffix=None, on_progress=None, should_stop=None):
+        """扫描目录并用线程池分批处理文件
+        Args:
+            directory: 目录
+            handler: 处理单个 DirEntry 的函数，返回值不为 None 时收集到结果中
+            suffix: 只处理以此结尾的文件
+            on_progress: 每处理完一批调用一次，参数为已处理的文件数
+            should_stop: 返回 True 时停止提交新的批次
+        Returns:
+            (已处理的文件数, 结果列表, 是否中途停止)
+        """
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="maintenance")
+        pending = deque()
+        processed = 0
+        results = []
+        stopped = False
+
+        def run_batch(batch):
+            output = []
+            for entry in batch:
+                result = handler(entry)
+                if result is not None:
+                    output.append(result)
+            return len(batch), output
+
+        def collect(future):
+            nonlocal processed
+            count, output = future.result()
+            processed += count
+            results.extend(output)
+            if on_progress:
+                on_progress(processed)
+
+        for batch in self.scan(directory, suffix):
+            if self._cancel.is_set() or (should_stop is not None and should_stop()):
+                stopped = True
+                break
+            pending.append(self._pool.submit(run_batch, batch))
+            # 限制同时在途的批次数，扫描速度远快于处理时不会把整个目录读进内存
+            while len(pending) >= self.workers * 2:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+        return processed, results, stopped
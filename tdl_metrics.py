@@ -0,0 +1,247 @@
+"""运行指标：可选的本机 Prometheus 文本接口和定期重写的 JSON 文件"""
+import os
+import json
+import time
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RateMeter:
+    """按秒分桶统计最近一段时间内的平均速率，如每秒解析的行数"""
+
+    def __init__(self, window=5):
+        """
+        Args:
+            window: 统计窗口（秒）
+        """
+        self.window = window
+        self.total = 0
+        self._buckets = deque()
+        self._lock = threading.Lock()
+
+    def add(self, count=1):
+        second = int(time.monotonic())
+        with self._lock:
+            self.total += count
+            if self._buckets and self._buckets[-1][0] == second:
+                self._buckets[-1][1] += count
+            else:
+                self._buckets.append([second, count])
+                while self._buckets and self._buckets[0][0] <= second - self.window:
+                    self._buckets.popleft()
+
+    def rate(self):
+        """最近 window 秒内的每秒平均值"""
+        now = int(time.monotonic())
+        with self._lock:
+            count = sum(c for second, c in self._buckets if second > now - self.window)
+        return count / self.window
+
+
+class MetricsRegistry:
+    """指标注册表
+
+    每个指标由一个采集函数提供当前值，函数返回一个数值，
+    或者返回 {标签字典的元组: 数值} 表示一组带标签的值。
+    取值时才调用采集函数，平时不产生任何额外开销。
+    """
+
+    def __init__(self, prefix="tdl"):
+        self.prefix = prefix
+        # 名称 -> (类型, 说明, 采集函数)
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, kind, help_text, collect):
+        """注册一个指标
+        Args:
+            name: 指标名（不含前缀）
+            kind: gauge 或 counter
+            help_text: 指标说明
+            collect: 采集函数
+        """
+        with self._lock:
+            self._metrics[f"{self.prefix}_{name}"] = (kind, help_text, collect)
+
+    def collect(self):
+        """采集所有指标
+        Returns:
+            [(名称, 类型, 说明, [(标签字典, 数值), ...]), ...]
+        """
+        with self._lock:
+            metrics = list(self._metrics.items())
+        result = []
+        for name, (kind, help_text, collect) in metrics:
+            try:
+                value = collect()
+            except Exception as e:
+                print(f"采集指标 {name} 时出错: {str(e)}")
+                continue
+            if isinstance(value, dict):
+                samples = [(dict(labels), v) for labels, v in value.items()]
+            else:
+                samples = [({}, value)]
+            result.append((name, kind, help_text, samples))
+        return result
+
+    def render_prometheus(self):
+        """Prometheus 文本格式"""
+        lines = []
+        for name, kind, help_text, samples in self.collect():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if labels:
+                    label_text = ",".join(
+                        f'{key}="{_escape_label(str(label))}"' for key, label in labels.items()
+                    )
+                    lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def render_json(self):
+        """JSON 格式，带采集时间"""
+        metrics = {}
+        for name, kind, help_text, samples in self.collect():
+            metrics[name] = {
+                "type": kind,
+                "help": help_text,
+                "values": [{"labels": labels, "value": value} for labels, value in samples],
+            }
+        return json.dumps({"time": time.time(), "metrics": metrics}, ensure_ascii=False, indent=1)
+
+
+def _format_value(value):
+    """整数不带小数点输出，大的字节数不会被写成科学计数法而丢失精度"""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _escape_label(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsServer:
+    """在本机端口上提供 /metrics（Prometheus 文本）和 /metrics.json"""
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        """
+        Args:
+            registry: MetricsRegistry
+            port: 监听端口
+            host: 监听地址，默认只监听本机
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/metrics":
+                    body = registry.render_prometheus().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif path == "/metrics.json":
+                    body = registry.render_json().encode("utf-8")
+                    content_type = "application/json; charset=utf-8"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # 不把每次抓取写到控制台
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class MetricsFileWriter:
+    """后台线程定期把指标重写到 JSON 文件
+
+    先写入同目录的临时文件再替换，读取方不会读到写了一半的文件。
+    """
+
+    def __init__(self, registry, path, interval=5):
+        """
+        Args:
+            registry: MetricsRegistry
+            path: JSON 文件路径
+            interval: 重写间隔（秒）
+        """
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.registry.render_json())
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        """停止后台线程并写入最后一次"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval + 1)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                print(f"写入指标文件失败: {str(e)}")
+            if self._stop.wait(self.interval):
+                break
+        try:
+            self.write()
+        except Exception as e:
+            print(f"写入指标文件失败: {str(e)}")
+
+
+def start_metrics(registry, port=None, path=None, interval=5):
+    """按配置启动指标接口和指标文件，都未配置时什么也不做
+    Returns:
+        已启动的服务列表，退出时逐个 close()
+    """
+    services = []
+    if port:
+        try:
+            server = MetricsServer(registry, int(port))
+            server.start()
+            services.append(server)
+        except Exception as e:
+            print(f"启动指标接口失败: {str(e)}")
+    if path:
+        writer = MetricsFileWriter(registry, path, interval)
+        writer.start()
+        services.append(writer)
+    return services
@@ -0,0 +1,288 @@
+"""tdl 输出解析：下载和上传共用的预编译解析器和输出读取器"""
+import re
+import locale
+
+# 事件类型
+EVENT_STARTED = "started"
+EVENT_PROGRESS = "progress"
+EVENT_SPEED = "speed"
+EVENT_DONE = "done"
+EVENT_ERROR = "error"
+EVENT_SYSINFO = "sysinfo"
+EVENT_LOG = "log"
+
+# 速度单位换算
+UNIT_MULTIPLIERS = {
+    b'B': 1,
+    b'KB': 1024,
+    b'MB': 1024 * 1024,
+    b'GB': 1024 * 1024 * 1024,
+    b'TB': 1024 * 1024 * 1024 * 1024,
+}
+
+# 控制字符（光标移动、清行等）
+CONTROL_CHARS_PATTERN = re.compile(rb'\x1b\[[0-9;]*[a-zA-Z]|\[A\[K')
+CONTROL_CHARS_TEXT_PATTERN = re.compile(r'\x1b\[[0-9;]*[a-zA-Z]|\[A\[K')
+
+_SYSINFO_PATTERN = re.compile(rb'CPU: \d+\.\d+% Memory: \d+\.\d+ MB Goroutines: \d+')
+_SYSINFO_TEXT_PATTERN = re.compile(r'CPU: \d+\.\d+% Memory: \d+\.\d+ MB Goroutines: \d+')
+_START_PATTERN = re.compile(rb'Downloading\s+(.+?)\s+to\s+')
+_DONE_PATTERN = re.compile(rb'(.+?)\s*->\s*(.+?)\s*(?:\.\.\.\s*)?done!')
+_MARKER_PATTERN = re.compile(
+    rb'\[TDLGUI_MARKER\] (' + '开始上传'.encode('utf-8') + rb'|' + '完成上传'.encode('utf-8') +
+    rb') (\d+)/(\d+)(?: rc=(-?\d+))?(?::\s*(.+))?$'
+)
+# 进度行的所有字段用一个模式一次扫描：百分比、进度条、速度、已传输量（"6.00 MB in 1.2s"）
+_PROGRESS_TOKENS_PATTERN = re.compile(
+    rb'(\d+(?:\.\d+)?)%'
+    rb'|\[(#*)([. ]*)\]'
+    rb'|(\d+(?:\.\d+)?)\s*([KMGT]?B)/s'
+    rb'|(\d+(?:\.\d+)?)\s*([KMGT]?B)\s+in\b',
+    re.I
+)
+_TRANSFERRED_PATTERN = re.compile(rb'(\d+(?:\.\d+)?)\s*([KMGT]?B)\s+in\b', re.I)
+# 帧分隔符：tdl 用 \r 原地重绘进度条，用 \n 输出普通日志
+_FRAME_SEPARATOR_PATTERN = re.compile(rb'[\r\n]+')
+_ERROR_PATTERN = re.compile(rb'\b(?:error|panic|fatal|failed)\b', re.I)
+_UPLOAD_DONE_WORDS = (b'upload completed', b'successfully uploaded', b'upload finished', b'upload done')
+_MARKER_STARTED = '开始上传'.encode('utf-8')
+_UPLOAD_DONE_TEXT = '完成上传'.encode('utf-8')
+
+
+def decode_output(b):
+    """解码字节流，优先utf-8，再gbk，再系统默认编码，最后替换无法解码的字符"""
+    if isinstance(b, str):
+        return b
+    for encoding in ('utf-8', 'gbk', locale.getpreferredencoding()):
+        try:
+            return b.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            pass
+    return b.decode('utf-8', errors='replace')
+
+
+def strip_control_chars(text):
+    """移除字符串或字节串中的终端控制字符"""
+    if isinstance(text, bytes):
+        return CONTROL_CHARS_PATTERN.sub(b'', text)
+    return CONTROL_CHARS_TEXT_PATTERN.sub('', text)
+
+
+def is_sysinfo(text):
+    """是否为 tdl 定期输出的 CPU/内存 系统信息行"""
+    if isinstance(text, bytes):
+        return b'Goroutines:' in text and _SYSINFO_PATTERN.search(text) is not None
+    return 'Goroutines:' in text and _SYSINFO_TEXT_PATTERN.search(text) is not None
+
+
+def _parse_transferred(line, start=0):
+    """解析行中 "6.00 MB in 1.2s" 形式的已传输字节数，没有时返回 None"""
+    match = _TRANSFERRED_PATTERN.search(line, start)
+    if match is None:
+        return None
+    return float(match.group(1)) * UNIT_MULTIPLIERS.get(match.group(2).upper(), 1)
+
+
+class TdlEvent:
+    """tdl 输出的一行解析结果"""
+    __slots__ = ("kind", "text", "name", "percent", "speed", "aggregate", "index", "total", "done_bytes", "path",
+                 "return_code")
+
+    def __init__(self, kind, text=None, name=None, percent=None, speed=None,
+                 aggregate=False, index=None, total=None, done_bytes=None, path=None, return_code=None):
+        self.kind = kind
+        # 原始行（已解码）
+        self.text = text
+        # 开始/完成事件的文件名
+        self.name = name
+        # 进度百分比（0-100）
+        self.percent = percent
+        # 速度（字节每秒）
+        self.speed = speed
+        # 是否为整个进程的总体进度条，如 [#####....] [8s; 6.54 MB/s]
+        self.aggregate = aggregate
+        # 上传标记中的序号（从1开始）和总数
+        self.index = index
+        self.total = total
+        # 进度行中已传输的字节数
+        self.done_bytes = done_bytes
+        # 完成事件中文件的保存路径
+        self.path = path
+        # 上传完成标记中该文件 tdl 命令的返回码
+        self.return_code = return_code
+
+    def __repr__(self):
+        fields = ", ".join(f"{k}={getattr(self, k)!r}" for k in self.__slots__
+                           if getattr(self, k) is not None and getattr(self, k) is not False)
+        return f"TdlEvent({fields})"
+
+
+class TdlOutputParser:
+    """把 tdl 的一行输出归类为一个事件
+
+    先用字节级的子串判断确定行的类别，再只执行该类别对应的一个预编译模式，
+    进度行的百分比、进度条和速度由同一个模式一次扫描得到。
+    """
+
+    def parse(self, line):
+        """解析一行输出
+        Args:
+            line: 一行输出（bytes 或 str，可以带换行符和控制字符）
+        Returns:
+            TdlEvent，空行返回 None
+        """
+        if isinstance(line, str):
+            line = line.encode('utf-8', errors='replace')
+        if b'\x1b' in line or b'[A[K' in line:
+            line = CONTROL_CHARS_PATTERN.sub(b'', line)
+        line = line.strip()
+        if not line:
+            return None
+
+        # 系统信息
+        if is_sysinfo(line):
+            return TdlEvent(EVENT_SYSINFO)
+
+        # 上传批处理中的标记
+        if line.startswith(b'[TDLGUI_MARKER]'):
+            match = _MARKER_PATTERN.match(line)
+            if match:
+                kind = EVENT_STARTED if match.group(1) == _MARKER_STARTED else EVENT_DONE
+                name = match.group(5)
+                return TdlEvent(
+                    kind,
+                    text=decode_output(line),
+                    name=decode_output(name) if name else None,
+                    index=int(match.group(2)),
+                    total=int(match.group(3)),
+                    return_code=int(match.group(4)) if match.group(4) is not None else None,
+                )
+            return TdlEvent(EVENT_LOG, text=decode_output(line))
+
+        # 任务完成
+        if b'done!' in line:
+            match = _DONE_PATTERN.search(line)
+            if match:
+                # 完成行末尾的 "[48.00 MB in 8.1s; ...]" 即文件大小
+                return TdlEvent(EVENT_DONE, text=decode_output(line), name=decode_output(match.group(1)),
+                                done_bytes=_parse_transferred(line, match.end()), path=decode_output(match.group(2)))
+
+        # 任务开始
+        if b'Downloading' in line:
+            match = _START_PATTERN.search(line)
+            if match:
+                return TdlEvent(EVENT_STARTED, text=decode_output(line), name=decode_output(match.group(1)))
+
+        # 上传完成提示
+        lowered = line.lower()
+        if _UPLOAD_DONE_TEXT in line or any(word in lowered for word in _UPLOAD_DONE_WORDS):
+            return TdlEvent(EVENT_DONE, text=decode_output(line))
+
+        # 进度和速度
+        if b'%' in line or b'/s' in lowered or b'[#' in line:
+            event = self._parse_progress(line)
+            if event is not None:
+                return event
+
+        if _ERROR_PATTERN.search(line):
+            return TdlEvent(EVENT_ERROR, text=decode_output(line))
+        return TdlEvent(EVENT_LOG, text=decode_output(line))
+
+    def _parse_progress(self, line):
+        percent = None
+        bar_percent = None
+        speed = None
+        done_bytes = None
+        for match in _PROGRESS_TOKENS_PATTERN.finditer(line):
+            if match.group(1) is not None:
+                if percent is None:
+                    percent = float(match.group(1))
+            elif match.group(2) is not None:
+                if bar_percent is None:
+                    filled = len(match.group(2))
+                    total = filled + len(match.group(3))
+                    if total > 0:
+                        bar_percent = filled / total * 100
+            elif match.group(4) is not None:
+                if speed is None:
+                    unit = match.group(5).upper()
+                    speed = float(match.group(4)) * UNIT_MULTIPLIERS.get(unit, 1)
+            elif done_bytes is None:
+                unit = match.group(7).upper()
+                done_bytes = float(match.group(6)) * UNIT_MULTIPLIERS.get(unit, 1)
+        if percent is None and bar_percent is None:
+            if speed is None:
+                return None
+            return TdlEvent(EVENT_SPEED, speed=speed)
+        # 以进度条开头且没有百分比的行是整个进程的总体进度
+        aggregate = percent is None and line.startswith(b'[')
+        # 单个文件的进度行以 "会话(ID):消息ID -> 路径 ..." 或 "路径 ..." 开头
+        name = None
+        if not aggregate:
+            if b' -> ' in line:
+                name = decode_output(line.split(b' -> ', 1)[0])
+            elif b' ... ' in line:
+                name = decode_output(line.split(b' ... ', 1)[0])
+        return TdlEvent(
+            EVENT_PROGRESS,
+            name=name,
+            percent=percent if percent is not None else bar_percent,
+            speed=speed,
+            aggregate=aggregate,
+            done_bytes=done_bytes,
+        )
+
+
+class TdlOutputReader:
+    """按块读取 tdl 的输出，同时以 \\r 和 \\n 切分出每一帧
+
+    readline() 只认 \\n，tdl 用 \\r 重绘的进度帧会堆积到下一个换行才一起到达。
+    这里每次把一大块数据直接读进复用的缓冲区，再按分隔符切帧，
+    进度帧一到就能被处理，也不会因为一直没有换行而拼出超长的"行"。
+    """
+
+    def __init__(self, stream, chunk_size=64 * 1024, max_frame_size=1024 * 1024):
+        """
+        Args:
+            stream: 子进程的 stdout（二进制模式）
+            chunk_size: 每次读取的最大字节数
+            max_frame_size: 单帧最大长度，超过时直接输出，避免缓冲区无限增长
+        """
+        # 绕过 BufferedReader，直接读底层文件，每次读取只做一次系统调用
+        self._raw = getattr(stream, 'raw', stream)
+        self._buffer = bytearray(chunk_size)
+        self._view = memoryview(self._buffer)
+        self._partial = bytearray()
+        self._max_frame_size = max_frame_size
+
+    def __iter__(self):
+        view = self._view
+        partial = self._partial
+        while True:
+            try:
+                size = self._raw.readinto(view)
+            except InterruptedError:
+                continue
+            if not size:
+                break
+            start = 0
+            for match in _FRAME_SEPARATOR_PATTERN.finditer(view, 0, size):
+                if partial:
+                    partial += view[start:match.start()]
+                    frame = bytes(partial)
+                    partial.clear()
+                else:
+                    frame = bytes(view[start:match.start()])
+                start = match.end()
+                if frame:
+                    yield frame
+            if start < size:
+                partial += view[start:size]
+                if len(partial) >= self._max_frame_size:
+                    frame = bytes(partial)
+                    partial.clear()
+                    yield frame
+        if partial:
+            frame = bytes(partial)
+            partial.clear()
+            yield frame
@@ -0,0 +1,88 @@
+"""界面刷新：按固定帧率合并刷新进度、速度等控件"""
+import threading
+import time
+
+
+class RenderLoop:
+    """固定帧率的控件刷新循环
+
+    工作线程只通过 set() 记录控件最新的属性值并标记为脏，
+    刷新线程按固定频率把所有脏控件的最新值写回控件，
+    再用一次 page.update() 推送到界面，同一帧内的多次修改只推送最后一次。
+    """
+
+    def __init__(self, fps=10):
+        """
+        Args:
+            fps: 每秒刷新次数
+        """
+        self.fps = fps
+        self.page = None
+        self._lock = threading.Lock()
+        # id(control) -> (control, {属性: 最新值})
+        self._dirty = {}
+        self._running = False
+        # 每帧刷新前调用的回调，用于把暂存的数据一次性写入控件
+        self._hooks = []
+        # 最近一次刷新的耗时（秒）和刷新的控件数
+        self.last_flush_duration = 0.0
+        self.last_flush_count = 0
+
+    def attach(self, page):
+        """绑定页面并启动刷新线程"""
+        self.page = page
+        if not self._running:
+            self._running = True
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._running = False
+
+    def set(self, control, **attrs):
+        """记录控件的最新属性值，在下一帧统一写回并刷新"""
+        if control is None:
+            return
+        with self._lock:
+            entry = self._dirty.get(id(control))
+            if entry is None:
+                self._dirty[id(control)] = (control, dict(attrs))
+            else:
+                entry[1].update(attrs)
+
+    def add_hook(self, callback):
+        """注册每帧刷新前调用的回调"""
+        self._hooks.append(callback)
+
+    def flush(self):
+        """把脏控件的最新值写回控件并一次性刷新"""
+        for hook in self._hooks:
+            try:
+                hook()
+            except Exception as e:
+                print(f"刷新界面时出错: {str(e)}")
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+        start = time.perf_counter()
+        controls = []
+        for control, attrs in dirty.values():
+            for name, value in attrs.items():
+                setattr(control, name, value)
+            if control.page is not None:
+                controls.append(control)
+        if controls and self.page is not None:
+            try:
+                self.page.update(*controls)
+            except Exception as e:
+                print(f"刷新界面时出错: {str(e)}")
+        self.last_flush_duration = time.perf_counter() - start
+        self.last_flush_count = len(controls)
+
+    def _run(self):
+        while self._running:
+            time.sleep(1.0 / max(1, self.fps))
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"刷新界面时出错: {str(e)}")
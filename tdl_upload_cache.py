@@ -0,0 +1,245 @@
+"""上传去重缓存：按聊天记录已上传过的文件，再次上传时跳过内容相同的文件"""
+import os
+import json
+import time
+import threading
+from tdl_verify import verify_files
+
+
+class UploadFile:
+    """待上传文件的指纹"""
+
+    __slots__ = ("index", "path", "key", "size", "mtime", "hash")
+
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.key = os.path.normcase(os.path.abspath(path))
+        self.hash = None
+        try:
+            stat = os.stat(path)
+            self.size = stat.st_size
+            self.mtime = stat.st_mtime_ns
+        except OSError:
+            self.size = None
+            self.mtime = None
+
+
+class UploadCache:
+    """按内容去重的上传缓存
+
+    以追加写入的 JSONL 日志记录两类信息：
+    每个聊天上传成功的文件（路径、大小、修改时间），以及算过的文件内容哈希。
+    再次上传时，路径、大小、修改时间都没变的文件只需一次 stat 即可跳过；
+    只有大小与该聊天已上传的某个文件相同时才读取文件计算哈希（进程池并行），
+    改名或移动过的文件也能按内容识别出来。
+    """
+
+    def __init__(self, path, algorithm="sha256"):
+        """
+        Args:
+            path: 缓存文件路径
+            algorithm: 内容哈希算法
+        """
+        self.path = path
+        self.algorithm = algorithm
+        self._lock = threading.Lock()
+        # 规范化路径 -> (大小, 修改时间, 哈希)
+        self._hashes = {}
+        # 聊天 -> {规范化路径: [大小, 修改时间, 哈希或 None]}
+        self._uploads = {}
+        # 聊天 -> 已上传内容的哈希集合
+        self._uploaded_hashes = {}
+        self._file = None
+        self._loaded = False
+
+    @staticmethod
+    def chat_key(chat):
+        """聊天为空时表示收藏夹"""
+        return (chat or "").strip()
+
+    def load(self):
+        """重放缓存日志，已加载时什么也不做"""
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        records = 0
+        with open(self.path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    key, size, mtime = record["path"], record["size"], record["mtime"]
+                    if "chat" in record:
+                        self._uploads.setdefault(record["chat"], {})[key] = [size, mtime, record.get("hash")]
+                    else:
+                        self._hashes[key] = (size, mtime, record["hash"])
+                    records += 1
+                except (ValueError, KeyError, TypeError):
+                    # 崩溃时可能留下写了一半的最后一行
+                    continue
+        for chat, uploads in self._uploads.items():
+            hashes = self._uploaded_hashes.setdefault(chat, set())
+            for key, upload in uploads.items():
+                upload[2] = upload[2] or self._cached_hash(key, upload[0], upload[1])
+                if upload[2]:
+                    hashes.add(upload[2])
+        if records > 2 * (len(self._hashes) + sum(len(u) for u in self._uploads.values())) + 1000:
+            self._compact()
+
+    def _compact(self):
+        """把日志重写为每个文件一条记录"""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for key, (size, mtime, digest) in self._hashes.items():
+                f.write(self._dumps({"path": key, "size": size, "mtime": mtime, "hash": digest}))
+            for chat, uploads in self._uploads.items():
+                for key, (size, mtime, digest) in uploads.items():
+                    f.write(self._dumps({"chat": chat, "path": key, "size": size, "mtime": mtime, "hash": digest}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _dumps(record):
+        return json.dumps(record, ensure_ascii=False) + "\n"
+
+    def _append(self, records):
+        """追加一批记录并立即落盘（调用方持有锁）"""
+        if not records:
+            return
+        lines = [self._dumps(record) for record in records]
+        try:
+            if self._file is None:
+                new_line = self._needs_newline()
+                self._file = open(self.path, "a", encoding="utf-8")
+                # 上次崩溃留下的半行不能和新记录拼在一起
+                if new_line:
+                    lines.insert(0, "\n")
+            self._file.write("".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            print(f"写入上传缓存失败: {str(e)}")
+
+    def _needs_newline(self):
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() == 0:
+                    return False
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) != b"\n"
+        except OSError:
+            return False
+
+    def _cached_hash(self, key, size, mtime):
+        cached = self._hashes.get(key)
+        if cached and cached[0] == size and cached[1] == mtime:
+            return cached[2]
+        return None
+
+    def _hash(self, files):
+        """用进程池并行计算一组文件的哈希，结果写入缓存"""
+        if not files:
+            return
+        results = verify_files([(file.path, None, file) for file in files], algorithm=self.algorithm)
+        records = []
+        with self._lock:
+            for result in results:
+                file = result["info"]
+                if not result["hash"] or result["size"] != file.size:
+                    # 读取失败或计算期间文件被改写，这次不使用
+                    continue
+                file.hash = result["hash"]
+                self._hashes[file.key] = (file.size, file.mtime, file.hash)
+                records.append({"path": file.key, "size": file.size, "mtime": file.mtime, "hash": file.hash})
+            self._append(records)
+
+    def plan(self, paths, chat, hash_all=False):
+        """找出已经上传到该聊天的文件
+        Args:
+            paths: 待上传的文件路径
+            chat: 目标聊天
+            hash_all: 为 True 时为所有文件计算哈希（上传后删除原文件时，之后就没有机会再算了）
+        Returns:
+            (需要上传的 UploadFile 列表, 跳过的 UploadFile 列表)，都保持 paths 中的顺序
+        """
+        self.load()
+        chat = self.chat_key(chat)
+        files = [UploadFile(index, path) for index, path in enumerate(paths)]
+        with self._lock:
+            uploads = self._uploads.get(chat, {})
+            sizes = {upload[0] for upload in uploads.values()}
+            skipped = set()
+            need_hash = []
+            for file in files:
+                if file.size is None:
+                    # 读不到的文件交给 tdl 报错
+                    continue
+                upload = uploads.get(file.key)
+                if upload and upload[0] == file.size and upload[1] == file.mtime:
+                    skipped.add(file.index)
+                    continue
+                file.hash = self._cached_hash(file.key, file.size, file.mtime)
+                if file.hash is None and (hash_all or file.size in sizes):
+                    need_hash.append(file)
+            # 之前上传时没有算哈希的同样大小的文件，如果还在原处且没有改动，现在一起算
+            candidate_sizes = {file.size for file in files if file.size is not None and file.index not in skipped}
+            previous = []
+            for key, upload in uploads.items():
+                if upload[2] is None and upload[0] in candidate_sizes:
+                    file = UploadFile(None, key)
+                    if file.size == upload[0] and file.mtime == upload[1]:
+                        previous.append((file, upload))
+        self._hash(need_hash + [file for file, _ in previous])
+
+        with self._lock:
+            hashes = self._uploaded_hashes.setdefault(chat, set())
+            for file, upload in previous:
+                if file.hash:
+                    upload[2] = file.hash
+                    hashes.add(file.hash)
+            pending = []
+            seen = set()
+            for file in files:
+                if file.index in skipped or (file.hash and (file.hash in hashes or file.hash in seen)):
+                    skipped.add(file.index)
+                    continue
+                if file.hash:
+                    # 同一批中内容相同的文件只上传一次
+                    seen.add(file.hash)
+                pending.append(file)
+        return pending, [file for file in files if file.index in skipped]
+
+    def record_uploaded(self, chat, files):
+        """记录上传成功的文件
+        Args:
+            chat: 目标聊天
+            files: plan() 返回的 UploadFile 列表
+        """
+        self.load()
+        chat = self.chat_key(chat)
+        records = []
+        with self._lock:
+            uploads = self._uploads.setdefault(chat, {})
+            hashes = self._uploaded_hashes.setdefault(chat, set())
+            for file in files:
+                if file.size is None:
+                    continue
+                uploads[file.key] = [file.size, file.mtime, file.hash]
+                if file.hash:
+                    hashes.add(file.hash)
+                records.append({"chat": chat, "path": file.key, "size": file.size, "mtime": file.mtime,
+                                "hash": file.hash, "time": int(time.time())})
+            self._append(records)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,216 @@
+"""下载完整性校验：用进程池并行计算文件哈希并核对文件大小"""
+import os
+import mmap
+import hashlib
+import threading
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from tdl_engine import size_tolerance
+
+# 校验结果
+VERIFY_OK = "ok"
+VERIFY_SIZE_MISMATCH = "size_mismatch"
+VERIFY_UNKNOWN_SIZE = "unknown_size"
+VERIFY_MISSING = "missing"
+VERIFY_ERROR = "error"
+
+STATUS_TEXT = {
+    VERIFY_OK: "通过",
+    VERIFY_SIZE_MISMATCH: "大小不符",
+    VERIFY_UNKNOWN_SIZE: "没有记录大小，仅计算哈希",
+    VERIFY_MISSING: "文件不存在",
+    VERIFY_ERROR: "读取出错",
+}
+
+# 共用的进程池，第一次需要计算哈希时创建，之后一直复用；
+# Windows 上每个新进程都要重新导入程序模块，不能每批文件都新建一个进程池
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        return _pool
+
+
+def _discard_pool(pool):
+    """丢弃已损坏的进程池（如工作进程被结束），下次使用时重新创建"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def shutdown_pool():
+    """关闭共用的进程池，程序退出时调用"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def hash_file(path, algorithm="sha256", buffer_size=8 * 1024 * 1024):
+    """计算文件哈希
+
+    优先把文件映射到内存，按块把映射的视图直接交给哈希函数，不产生中间拷贝；
+    无法映射时（如空文件、地址空间不足）改用复用缓冲区的 readinto 读取。
+    Returns:
+        (文件大小, 十六进制哈希)
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        for offset in range(0, size, buffer_size):
+                            digest.update(view[offset:offset + buffer_size])
+                    finally:
+                        view.release()
+                return size, digest.hexdigest()
+            except (OSError, ValueError, OverflowError):
+                digest = hashlib.new(algorithm)
+                f.seek(0)
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                digest.update(view[:count])
+    return size, digest.hexdigest()
+
+
+def verify_file(path, expected_size=None, algorithm="sha256"):
+    """校验单个文件（在进程池中执行）
+    Args:
+        path: 文件路径
+        expected_size: tdl 输出中记录的文件大小，为 None 时只计算哈希
+        algorithm: 哈希算法，为 None 时只核对大小
+    Returns:
+        {"path", "size", "expected", "status", "hash", "error"}
+    """
+    result = {"path": path, "size": None, "expected": expected_size, "status": VERIFY_OK, "hash": None, "error": None}
+    try:
+        if algorithm:
+            result["size"], result["hash"] = hash_file(path, algorithm)
+        else:
+            result["size"] = os.stat(path).st_size
+    except FileNotFoundError:
+        result["status"] = VERIFY_MISSING
+        return result
+    except OSError as e:
+        result["status"] = VERIFY_ERROR
+        result["error"] = str(e)
+        return result
+    if expected_size is None:
+        result["status"] = VERIFY_UNKNOWN_SIZE
+    elif abs(result["size"] - expected_size) > size_tolerance(expected_size):
+        result["status"] = VERIFY_SIZE_MISMATCH
+    return result
+
+
+def verify_files(items, algorithm="sha256", workers=None, on_progress=None):
+    """用共用的进程池并行校验一组文件
+    Args:
+        items: [(路径, 预期大小或 None, 附加信息), ...]，附加信息（如下载链接）原样放进结果的 "info"
+        algorithm: 哈希算法，为 None 时只核对大小（不启动进程池）
+        workers: 进程池创建时的进程数，默认为 CPU 核数
+        on_progress: 每校验完一个文件调用一次，参数为 (已完成数, 总数)
+    Returns:
+        与 items 顺序一致的结果列表
+    Raises:
+        ValueError: 不支持的哈希算法
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
+    if not algorithm:
+        # 只核对大小时每个文件只有一次 stat，不值得启动进程
+        for index, (path, expected, info) in enumerate(items):
+            results[index] = verify_file(path, expected, None)
+            results[index]["info"] = info
+            if on_progress:
+                on_progress(index + 1, len(items))
+        return results
+    # 算法名无效时在这里直接报错，而不是让每个文件都在工作进程中失败
+    hashlib.new(algorithm)
+    pool = _get_pool(workers)
+    try:
+        futures = {
+            pool.submit(verify_file, path, expected, algorithm): index
+            for index, (path, expected, _) in enumerate(items)
+        }
+    except (BrokenProcessPool, RuntimeError):
+        # 进程池已损坏或已关闭，换一个新的重试一次
+        _discard_pool(pool)
+        pool = _get_pool(workers)
+        futures = {
+            pool.submit(verify_file, path, expected, algorithm): index
+            for index, (path, expected, _) in enumerate(items)
+        }
+    broken = False
+    for done, future in enumerate(as_completed(futures), 1):
+        index = futures[future]
+        try:
+            results[index] = future.result()
+        except Exception as e:
+            broken = broken or isinstance(e, BrokenProcessPool)
+            results[index] = {"path": items[index][0], "size": None, "expected": items[index][1],
+                              "status": VERIFY_ERROR, "hash": None, "error": str(e)}
+        results[index]["info"] = items[index][2]
+        if on_progress:
+            on_progress(done, len(items))
+    if broken:
+        _discard_pool(pool)
+    return results
+
+
+def summarize(results):
+    """按校验结果计数"""
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return counts
+
+
+def write_report(path, results, title="下载校验记录", algorithm="sha256", format_size=None):
+    """把校验结果写成文本记录，格式与临时文件处理记录一致
+    Args:
+        path: 记录文件路径
+        results: verify_files() 的结果
+        title: 标题
+        algorithm: 使用的哈希算法，用于标注哈希值
+        format_size: 格式化文件大小的函数
+    """
+    format_size = format_size or (lambda size: f"{size} B")
+    counts = summarize(results)
+    lines = [f"{title} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"]
+    lines.append(f"共 {len(results)} 个文件，" + "，".join(
+        f"{STATUS_TEXT[status]} {count} 个" for status, count in counts.items()
+    ) + "\n")
+    for result in results:
+        entry = f"文件: {result['path']}"
+        if result.get("info"):
+            entry += f"\n下载链接: {result['info']}"
+        if result["size"] is not None:
+            entry += f"\n文件大小: {format_size(result['size'])}"
+        if result["expected"] is not None:
+            entry += f"（tdl 记录: {format_size(result['expected'])}）"
+        entry += f"\n结果: {STATUS_TEXT[result['status']]}"
+        if result["hash"]:
+            entry += f"\n{algorithm.upper()}: {result['hash']}"
+        if result["error"]:
+            entry += f"\n错误: {result['error']}"
+        lines.append(entry + "\n")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))